@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    # Raised instead of queueing (status_code 429) or after waiting too long
+    # (503); retry_after is a hint in seconds for the Retry-After header
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    # Limits the number of upstream calls in flight. Callers beyond the limit
+    # wait in a bounded queue, highest priority first (FIFO within a
+    # priority), for at most queue_timeout seconds. A released slot is handed
+    # directly to the next waiter, so queued callers can't be overtaken.
+
+    def __init__(self, max_in_flight, max_queue=100, queue_timeout=30.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters = []  # heap of (-priority, sequence, future)
+        self._sequence = itertools.count()
+        self._service_time = None  # moving average of how long a slot is held
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def acquire(self, priority=0):
+        # Waits for a slot and returns a function releasing it (safe to call
+        # more than once), or raises AdmissionRejected
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return self._releaser()
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("Too many requests waiting for the upstream", 429, self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._sequence), future))
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self._release(None)
+            else:
+                # Dropped from the queue; _release skips cancelled entries
+                self.queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise AdmissionRejected("Timed out waiting for the upstream", 503, self.retry_after())
+            raise
+        self.admitted += 1
+        return self._releaser()
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        release = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            release()
+
+    def retry_after(self):
+        # Rough time until a new request would get a slot
+        per_call = self._service_time or 1.0
+        return max(1, math.ceil(per_call * (self.queued + 1) / self.max_in_flight))
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    def _releaser(self):
+        start = time.monotonic()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._release(time.monotonic() - start)
+        return release
+
+    def _release(self, held):
+        if held is not None:
+            self._service_time = held if self._service_time is None else 0.9 * self._service_time + 0.1 * held
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.queued -= 1
+                future.set_result(None)
+                return
+        self.in_flight -= 1
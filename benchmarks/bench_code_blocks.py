@@ -0,0 +1,96 @@
+# Microbenchmark: code block post-processing of a large, code-heavy answer
+# with the previous regex substitutions vs. the single-pass
+# process_code_blocks and the incremental CodeBlockNormalizer fed one
+# streamed delta at a time.
+#
+#   python -m benchmarks.bench_code_blocks [--blocks 200] [--chunk-size 16] [--repeat 20] [--fuzz 20000]
+#
+# --fuzz also checks the normalizer against the legacy function on that many
+# random fence-heavy strings fed in random chunks.
+
+import argparse
+import random
+import re
+import time
+
+from code_blocks import CodeBlockNormalizer, process_code_blocks
+
+def build_answer(blocks, lines_per_block):
+    parts = []
+    for i in range(blocks):
+        parts.append(f"Step {i}: here is how the `helper_{i}` function works, with some prose around it.\n")
+        language = ("python", "js", "", "bash")[i % 4]
+        code = "\n".join(f"    value_{j} = compute({j}, 'x' * {j})  # line {j}" for j in range(lines_per_block))
+        # Alternate fences glued to the prose with fences on their own lines
+        separator = "\n" if i % 2 else ""
+        parts.append(f"{separator}```{language}\n{code}\n```{separator}")
+    parts.append("\nThat's all.")
+    return "".join(parts)
+
+def legacy_process_code_blocks(text):
+    # process_code_blocks as it was in server.py
+    def replace_code_block(match):
+        language = match.group(1) or ""
+        code = match.group(2)
+        return f"\n```{language}\n{code}\n```\n"
+
+    text = re.sub(r'```(\w*)\n(.*?)\n```', replace_code_block, text, flags=re.DOTALL)
+    text = re.sub(r'(\n```[\w]*\n.*?\n```)\n?', r'\1\n\n', text, flags=re.DOTALL)
+    return text
+
+def normalizer_chunked(chunks):
+    normalizer = CodeBlockNormalizer()
+    parts = [normalizer.feed(chunk) for chunk in chunks]
+    parts.append(normalizer.finish())
+    return ''.join(parts)
+
+def fuzz(cases):
+    alphabet = ["`", "`", "```", "\n", "\n", "a", "py", " ", "x", "-"]
+    rng = random.Random(0)
+    for _ in range(cases):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        chunks, i = [], 0
+        while i < len(text):
+            size = rng.randint(1, 8)
+            chunks.append(text[i:i + size])
+            i += size
+        expected = legacy_process_code_blocks(text)
+        assert process_code_blocks(text) == expected, repr(text)
+        assert normalizer_chunked(chunks) == expected, repr(text)
+
+def measure(label, func, arg, repeat, size):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<36} {best * 1000:9.2f} ms   {size / best / 1e6:8.1f} MB/s")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--lines-per-block", type=int, default=40)
+    parser.add_argument("--chunk-size", type=int, default=16, help="characters per streamed delta")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--fuzz", type=int, default=20000, help="random strings checked for identical output")
+    args = parser.parse_args()
+
+    answer = build_answer(args.blocks, args.lines_per_block)
+    chunks = [answer[i:i + args.chunk_size] for i in range(0, len(answer), args.chunk_size)]
+    expected = legacy_process_code_blocks(answer)
+    assert process_code_blocks(answer) == expected
+    assert normalizer_chunked([answer]) == expected
+    assert normalizer_chunked(chunks) == expected
+    if args.fuzz:
+        fuzz(args.fuzz)
+        print(f"{args.fuzz} random strings: identical output")
+
+    print(f"{args.blocks} code blocks, {len(answer) / 1024:.0f} KiB answer, {len(chunks)} deltas of {args.chunk_size} characters")
+    legacy = measure("legacy re.sub", legacy_process_code_blocks, answer, args.repeat, len(answer))
+    single_pass = measure("process_code_blocks", process_code_blocks, answer, args.repeat, len(answer))
+    streamed = measure("CodeBlockNormalizer (streamed)", normalizer_chunked, chunks, args.repeat, len(answer))
+    print(f"speedup vs legacy: {legacy / single_pass:.2f}x; streamed cost {streamed / len(chunks) * 1e6:.2f} us per delta")
+
+if __name__ == "__main__":
+    main()
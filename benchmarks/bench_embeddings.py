@@ -0,0 +1,82 @@
+# Benchmark: embedding backends on the CPU. Encodes the same texts with the
+# SentenceTransformer (PyTorch, float32) reference and the ONNX Runtime
+# backends, and reports throughput and how closely each backend's vectors
+# agree with the reference (cosine similarity, and overlap of the top-k
+# nearest neighbours of each text).
+#
+#   python -m benchmarks.bench_embeddings [--model all-MiniLM-L6-v2] [--texts 2000] [--threads 4]
+#
+# Needs sentence-transformers, onnxruntime and onnx installed; the ONNX models
+# are exported to --onnx-dir on the first run.
+
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+from embeddings import BACKENDS
+
+WORDS = ("proxy latency stream token cache conversation upstream request model answer vector "
+         "embedding server client batch queue cancel retry circuit memory thread cpu quantized").split()
+
+def build_texts(count, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 60))) for _ in range(count)]
+
+def normalized(vectors):
+    return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+def neighbours(vectors, k):
+    similarities = vectors @ vectors.T
+    np.fill_diagonal(similarities, -np.inf)
+    return np.argsort(-similarities, axis=1)[:, :k]
+
+def agreement(reference, vectors, k):
+    reference, vectors = normalized(reference), normalized(vectors)
+    cosine = (reference * vectors).sum(axis=1)
+    expected, found = neighbours(reference, k), neighbours(vectors, k)
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(expected, found)])
+    return cosine.mean(), cosine.min(), overlap
+
+def measure(model, texts, batch_size, repeat):
+    model.encode(texts[:batch_size], batch_size=batch_size)  # Warm up
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vectors = model.encode(texts, batch_size=batch_size)
+        best = min(best, time.perf_counter() - start)
+    return np.asarray(vectors, dtype=np.float32), best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--backends", default="sentence-transformers,onnx,onnx-int8", help="the first one is the reference")
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads per backend, 0 = runtime default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--onnx-dir", default=os.path.join("onnx_models", "bench"))
+    args = parser.parse_args()
+
+    texts = build_texts(args.texts)
+    directory = os.path.join(args.onnx_dir, args.model.replace('/', '--'))
+    print(f"{args.texts} texts, batch size {args.batch_size}, threads {args.threads or 'default'}")
+    reference = None
+    reference_time = None
+    for backend in args.backends.split(','):
+        model = BACKENDS[backend](args.model, args.threads or None, directory)()
+        vectors, elapsed = measure(model, texts, args.batch_size, args.repeat)
+        line = f"{backend:<24} {elapsed:8.2f} s   {args.texts / elapsed:8.1f} texts/s"
+        if reference is None:
+            reference, reference_time = vectors, elapsed
+        else:
+            mean_cosine, min_cosine, overlap = agreement(reference, vectors, args.top_k)
+            line += (f"   {reference_time / elapsed:5.2f}x   cosine mean {mean_cosine:.4f} min {min_cosine:.4f}"
+                     f"   top-{args.top_k} overlap {overlap:.3f}")
+        print(line)
+
+if __name__ == "__main__":
+    main()
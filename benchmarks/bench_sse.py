@@ -0,0 +1,94 @@
+# Microbenchmark: parsing a completion event stream with the previous
+# decode/split/json.loads approach vs. the incremental CompletionParser.
+#
+#   python -m benchmarks.bench_sse [--events 5000] [--chunk-size 1024] [--repeat 20] [--debug-logging]
+#
+# --debug-logging writes the DEBUG records (to /dev/null), as the old client
+# did by default, to include the cost of logging every payload.
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from sse import CompletionParser
+
+logger = logging.getLogger("bench_sse")
+
+def build_stream(events, delta_size):
+    parts = []
+    delta = ("lorem ipsum " * (delta_size // 12 + 1))[:delta_size]
+    for i in range(events):
+        if i % 50 == 0:
+            parts.append(b"event: ping\r\ndata: {\"type\": \"ping\"}\r\n\r\n")
+        payload = {"type": "completion", "completion": delta, "stop_reason": None, "model": "claude-3-5-sonnet-20240620"}
+        parts.append(b"event: completion\r\ndata: " + json.dumps(payload).encode() + b"\r\n\r\n")
+    final = {"type": "completion", "completion": "", "stop_reason": "stop_sequence", "model": "claude-3-5-sonnet-20240620"}
+    parts.append(b"event: completion\r\ndata: " + json.dumps(final).encode() + b"\r\n\r\n")
+    return b"".join(parts)
+
+def legacy_parse(body):
+    # What Client.send_message did before the parser was introduced,
+    # including its (disabled, but still formatted) debug logging
+    decoded_data = body.decode("utf-8")
+    logger.debug(f"Decoded response data: {decoded_data}")
+    completions = []
+    for line in decoded_data.split('\n'):
+        if line.startswith('data: '):
+            try:
+                data = json.loads(line[6:])
+                if data['type'] == 'completion' and 'completion' in data:
+                    completions.append(data['completion'])
+                    logger.debug(f"Added completion: {data['completion']}")
+            except json.JSONDecodeError:
+                logger.warning(f"Failed to parse JSON: {line[6:]}")
+    return ''.join(completions)
+
+def parser_whole(body):
+    parser = CompletionParser()
+    return ''.join(parser.feed(body) + parser.flush())
+
+def parser_chunked(chunks):
+    parser = CompletionParser()
+    completions = []
+    for chunk in chunks:
+        completions.extend(parser.feed(chunk))
+    completions.extend(parser.flush())
+    return ''.join(completions)
+
+def measure(label, func, arg, repeat, body_size):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<32} {best * 1000:9.2f} ms   {body_size / best / 1e6:8.1f} MB/s")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--delta-size", type=int, default=24, help="characters per completion event")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="bytes per network chunk for the incremental run")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--debug-logging", action="store_true", help="emit DEBUG records to /dev/null")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    logging.basicConfig(level=logging.DEBUG if args.debug_logging else logging.WARNING, stream=devnull)
+    body = build_stream(args.events, args.delta_size)
+    chunks = [body[i:i + args.chunk_size] for i in range(0, len(body), args.chunk_size)]
+
+    expected = legacy_parse(body)
+    assert parser_whole(body) == expected
+    assert parser_chunked(chunks) == expected
+
+    print(f"{args.events} events, {len(body) / 1024:.0f} KiB body, {len(chunks)} chunks of {args.chunk_size} bytes")
+    legacy = measure("legacy decode/split/loads", legacy_parse, body, args.repeat, len(body))
+    whole = measure("CompletionParser (whole body)", parser_whole, body, args.repeat, len(body))
+    chunked = measure("CompletionParser (chunked)", parser_chunked, chunks, args.repeat, len(body))
+    print(f"speedup vs legacy: whole body {legacy / whole:.2f}x, chunked {legacy / chunked:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# Load test for server.py: drives /v1/chat/completions (streaming and
+# non-streaming) and /v1/embeddings at a fixed concurrency and reports
+# latency percentiles, time to first token and requests per second.
+#
+#   python -m benchmarks.load_test --spawn --concurrency 50 --requests 500
+#
+# --spawn starts benchmarks.mock_upstream and server.py (pointed at the mock,
+# with human-like delays off) as subprocesses; without it the harness targets
+# an already running server given by --url.
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from curl_cffi import requests
+
+from sse import SSEParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+class Result:
+    __slots__ = ('ok', 'latency', 'ttft', 'status')
+
+    def __init__(self, ok, latency, ttft=None, status=None):
+        self.ok = ok
+        self.latency = latency
+        self.ttft = ttft
+        self.status = status
+
+async def chat_request(session, args, stream, index):
+    # Each request asks something different unless --identical-prompts, so
+    # the server's coalescing and response cache don't answer them together
+    prompt = args.prompt if args.identical_prompts else f"{args.prompt} ({index})"
+    payload = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": stream,
+    }
+    start = time.perf_counter()
+    try:
+        response = await session.post(f"{args.url}/v1/chat/completions", json=payload, stream=stream, timeout=args.timeout)
+        if not stream:
+            ok = response.status_code == 200
+            latency = time.perf_counter() - start
+            return Result(ok, latency, latency if ok else None, response.status_code)
+
+        ttft = None
+        parser = SSEParser()
+        try:
+            async for chunk in response.aiter_content():
+                if ttft is not None:
+                    continue
+                for event in parser.feed(chunk):
+                    if event.data == "[DONE]":
+                        continue
+                    delta = json.loads(event.data)["choices"][0]["delta"]
+                    if delta.get("content"):
+                        ttft = time.perf_counter() - start
+                        break
+        finally:
+            await response.aclose()
+        return Result(response.status_code == 200, time.perf_counter() - start, ttft, response.status_code)
+    except requests.RequestsError:
+        return Result(False, time.perf_counter() - start)
+
+async def embedding_request(session, args, index):
+    payload = {"model": "all-MiniLM-L6-v2", "input": [f"{args.prompt} {i}" for i in range(args.embedding_batch)]}
+    start = time.perf_counter()
+    try:
+        response = await session.post(f"{args.url}/v1/embeddings", json=payload, timeout=args.timeout)
+        latency = time.perf_counter() - start
+        return Result(response.status_code == 200, latency, status=response.status_code)
+    except requests.RequestsError:
+        return Result(False, time.perf_counter() - start)
+
+async def run_scenario(name, make_request, args):
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    results = []
+    remaining = iter(range(args.requests))
+
+    async with requests.AsyncSession(headers=headers, max_clients=args.concurrency) as session:
+        async def worker():
+            for index in remaining:
+                results.append(await make_request(session, index))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    report(name, results, elapsed)
+
+def report(name, results, elapsed):
+    succeeded = [result for result in results if result.ok]
+    latencies = [result.latency for result in succeeded]
+    ttfts = [result.ttft for result in succeeded if result.ttft is not None]
+    statuses = {}
+    for result in results:
+        if not result.ok:
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+
+    print(f"\n== {name}: {len(succeeded)}/{len(results)} ok in {elapsed:.2f}s, {len(succeeded) / elapsed:.1f} req/s")
+    if statuses:
+        print(f"   failures by status: {statuses}")
+    print(f"   latency  p50 {percentile(latencies, .5) * 1000:8.1f} ms  p95 {percentile(latencies, .95) * 1000:8.1f} ms  p99 {percentile(latencies, .99) * 1000:8.1f} ms")
+    if ttfts:
+        print(f"   ttft     p50 {percentile(ttfts, .5) * 1000:8.1f} ms  p95 {percentile(ttfts, .95) * 1000:8.1f} ms  p99 {percentile(ttfts, .99) * 1000:8.1f} ms")
+
+def wait_for(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestsError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+def spawn(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_upstream", "--port", str(args.mock_port),
+        "--first-token-latency", str(args.first_token_latency),
+        "--token-rate", str(args.token_rate), "--tokens", str(args.tokens),
+    ], cwd=ROOT)
+    env = dict(os.environ, CLAUDE_BASE_URL=mock_url, CLAUDE_API_URL=mock_url, HUMAN_DELAYS="false",
+               API_KEY=args.api_key, PORT=str(args.port), COOKIE=os.getenv("COOKIE", "mock-cookie"))
+    server = subprocess.Popen([sys.executable, "server.py"], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processes = [mock, server]
+    try:
+        wait_for(f"{mock_url}/api/organizations")
+        wait_for(f"{args.url}/health")
+    except Exception:
+        for process in processes:
+            process.terminate()
+        raise
+    return processes
+
+async def main_async(args):
+    scenarios = args.scenarios.split(",")
+    if "chat" in scenarios:
+        await run_scenario("chat completions", lambda session, index: chat_request(session, args, False, index), args)
+    if "stream" in scenarios:
+        await run_scenario("streaming chat completions", lambda session, index: chat_request(session, args, True, index), args)
+    if "embeddings" in scenarios:
+        await run_scenario(f"embeddings (batch of {args.embedding_batch})", lambda session, index: embedding_request(session, args, index), args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the OpenAI-compatible server")
+    parser.add_argument("--url", default=None, help="server URL (default http://127.0.0.1:<port>)")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY", "benchmark-key"))
+    parser.add_argument("--scenarios", default="chat,stream,embeddings", help="comma separated: chat, stream, embeddings")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--model", default="claude-3-5-sonnet-20240620")
+    parser.add_argument("--prompt", default="Write a short poem about load testing.")
+    parser.add_argument("--identical-prompts", action="store_true",
+                        help="send the same prompt every time, measuring request coalescing and the response cache")
+    parser.add_argument("--embedding-batch", type=int, default=8, help="texts per embeddings request")
+    parser.add_argument("--spawn", action="store_true", help="start the mock upstream and server.py")
+    parser.add_argument("--port", type=int, default=8008, help="server port")
+    parser.add_argument("--mock-port", type=int, default=8100)
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="mock upstream setting (with --spawn)")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="mock upstream setting (with --spawn)")
+    parser.add_argument("--tokens", type=int, default=100, help="mock upstream setting (with --spawn)")
+    args = parser.parse_args()
+    args.url = (args.url or f"http://127.0.0.1:{args.port}").rstrip("/")
+
+    processes = spawn(args) if args.spawn else []
+    try:
+        asyncio.run(main_async(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+if __name__ == "__main__":
+    main()
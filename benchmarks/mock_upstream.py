@@ -0,0 +1,161 @@
+# Local stand-in for the claude.ai endpoints used by claude_api.Client, for
+# measuring this project without hitting the real service. Completions stream
+# canned text with a configurable time to first token and token rate.
+#
+#   python -m benchmarks.mock_upstream [--port 8100] [--first-token-latency 0.2] [--token-rate 50] [--tokens 100]
+#
+# Point the client or server at it with:
+#
+#   CLAUDE_BASE_URL=http://127.0.0.1:8100 CLAUDE_API_URL=http://127.0.0.1:8100 HUMAN_DELAYS=false
+
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from starlette.responses import StreamingResponse
+
+WORDS = ("the quick brown fox jumps over the lazy dog while a proxy measures "
+         "latency throughput and time to first token for every request").split()
+
+app = FastAPI(title="Mock Claude upstream")
+app.state.first_token_latency = 0.2
+app.state.token_rate = 50.0
+app.state.tokens = 100
+app.state.error_rate = 0.0
+app.state.request_latency = 0.01
+conversations = {}
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+async def simulate_latency():
+    if app.state.request_latency:
+        await asyncio.sleep(app.state.request_latency)
+
+def get_conversation_or_404(conversation_id):
+    conversation = conversations.get(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation
+
+@app.get("/api/organizations")
+async def organizations():
+    await simulate_latency()
+    return [{"uuid": "mock-organization", "name": "Mock organization"}]
+
+@app.get("/api/organizations/{organization_id}/chat_conversations")
+async def list_conversations(organization_id: str, limit: Optional[int] = None, offset: int = 0):
+    await simulate_latency()
+    # Most recently updated first, paged with limit/offset
+    ordered = sorted(conversations.values(), key=lambda conversation: conversation["updated_at"], reverse=True)
+    page = ordered[offset:offset + limit] if limit else ordered[offset:]
+    return [{key: value for key, value in conversation.items() if key != "chat_messages"} for conversation in page]
+
+@app.post("/api/organizations/{organization_id}/chat_conversations")
+async def create_conversation(organization_id: str, request: Request):
+    await simulate_latency()
+    body = await request.json()
+    conversation_id = body.get("uuid") or str(uuid.uuid4())
+    timestamp = now()
+    conversations[conversation_id] = {
+        "uuid": conversation_id,
+        "name": body.get("name", ""),
+        "model": body.get("model"),
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "chat_messages": [],
+    }
+    return {key: value for key, value in conversations[conversation_id].items() if key != "chat_messages"}
+
+@app.get("/api/organizations/{organization_id}/chat_conversations/{conversation_id}")
+async def conversation_history(organization_id: str, conversation_id: str):
+    await simulate_latency()
+    return get_conversation_or_404(conversation_id)
+
+@app.delete("/api/organizations/{organization_id}/chat_conversations/{conversation_id}")
+async def delete_conversation(organization_id: str, conversation_id: str):
+    await simulate_latency()
+    get_conversation_or_404(conversation_id)
+    del conversations[conversation_id]
+    return Response(status_code=204)
+
+@app.post("/api/rename_chat")
+async def rename_chat(request: Request):
+    await simulate_latency()
+    body = await request.json()
+    conversation = get_conversation_or_404(body.get("conversation_uuid"))
+    conversation["name"] = body.get("title", "")
+    conversation["updated_at"] = now()
+    return {}
+
+@app.post("/api/convert_document")
+async def convert_document(request: Request):
+    body = await request.body()
+    await simulate_latency()
+    return {
+        "file_name": "document",
+        "file_type": request.headers.get("content-type", "application/octet-stream"),
+        "file_size": len(body),
+        "extracted_content": f"Extracted text of a {len(body)} byte multipart upload",
+    }
+
+def sse_event(event, payload):
+    return f"event: {event}\r\ndata: {json.dumps(payload)}\r\n\r\n"
+
+@app.post("/api/organizations/{organization_id}/chat_conversations/{conversation_id}/completion")
+async def completion(organization_id: str, conversation_id: str, request: Request):
+    body = await request.json()
+    if app.state.error_rate and random.random() < app.state.error_rate:
+        raise HTTPException(status_code=503, detail="Simulated upstream failure")
+    conversation = get_conversation_or_404(conversation_id)
+
+    async def stream():
+        await asyncio.sleep(app.state.first_token_latency)
+        interval = 1 / app.state.token_rate if app.state.token_rate > 0 else 0
+        words = []
+        for i in range(app.state.tokens):
+            if i % 25 == 0:
+                yield sse_event("ping", {"type": "ping"})
+            word = ("" if i == 0 else " ") + WORDS[i % len(WORDS)]
+            words.append(word)
+            yield sse_event("completion", {"type": "completion", "completion": word, "stop_reason": None, "model": body.get("model")})
+            if interval:
+                await asyncio.sleep(interval)
+        yield sse_event("completion", {"type": "completion", "completion": "", "stop_reason": "stop_sequence", "model": body.get("model")})
+
+        timestamp = now()
+        messages = conversation["chat_messages"]
+        for sender, text, attachments in (("human", body.get("prompt", ""), body.get("attachments", [])), ("assistant", "".join(words), [])):
+            messages.append({"uuid": str(uuid.uuid4()), "index": len(messages), "sender": sender, "text": text,
+                             "attachments": attachments, "created_at": timestamp})
+        conversation["updated_at"] = timestamp
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Claude upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="seconds before the first completion event")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="completion events per second (0 = as fast as possible)")
+    parser.add_argument("--tokens", type=int, default=100, help="completion events per answer")
+    parser.add_argument("--request-latency", type=float, default=0.01, help="seconds added to non-completion endpoints")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of completions failing with 503")
+    args = parser.parse_args()
+
+    app.state.first_token_latency = args.first_token_latency
+    app.state.token_rate = args.token_rate
+    app.state.tokens = args.tokens
+    app.state.request_latency = args.request_latency
+    app.state.error_rate = args.error_rate
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
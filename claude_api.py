@@ -1,56 +1,330 @@
+import asyncio
 import json
 import os
 import uuid
 from curl_cffi import requests
-import requests as req
+from curl_cffi import CurlMime, CurlOpt, CurlHttpVersion
 import re
+import threading
 import time
 import logging
 import random
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime
 from dotenv import load_dotenv
+from sse import CompletionParser
+from metrics import Counter, Gauge, Histogram, timed
+from log_config import redact, truncate
+from upload_cache import UploadCache, file_digest
+from history_store import HistoryStore
+from retry import CircuitBreaker, CircuitOpenError, RetryPolicy
 
 # Load environment variables from .env file
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class Client:
+CLIENT_CALL_DURATION = Histogram("claude_client_call_duration_seconds", "Duration of client calls, including retries and simulated human delays", ["method"])
+CLIENT_CALLS_IN_FLIGHT = Gauge("claude_client_calls_in_flight", "Client calls currently running", ["method"])
+CLIENT_RETRIES = Counter("claude_client_retries_total", "Upstream requests retried by the client", ["method"])
+UPSTREAM_RESPONSES = Counter("claude_upstream_responses_total", "Upstream HTTP responses by status code", ["status"])
+UPSTREAM_REQUEST_ERRORS = Counter("claude_upstream_request_errors_total", "Upstream requests that failed without a response")
 
-    def __init__(self, cookie, model="claude-3-5-sonnet-20240620"):
+def parse_timestamp(value):
+    # ISO 8601 timestamp from the API (e.g. created_at) -> epoch seconds
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class UpstreamError(str):
+    # Error text that send_message and stream_message return or yield when the
+    # upstream fails (for streams, possibly after some deltas). It is a str so
+    # callers can show it as it is, but tells a failure apart from an answer
+    # that happens to start with "Error:".
+    pass
+
+
+class RateLimiter:
+    # Spaces operations out to at most rate per second, across all threads or
+    # tasks sharing the limiter. A falsy rate means no limit.
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+            return start - now
+
+    def wait(self):
+        if self.interval:
+            delay = self._reserve()
+            if delay > 0:
+                time.sleep(delay)
+
+    async def wait_async(self):
+        if self.interval:
+            delay = self._reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+class BaseClient:
+    # Request building and other helpers shared by the blocking Client and the
+    # asyncio AsyncClient. Subclasses only differ in how requests are sent.
+
+    def __init__(self, cookie, model="claude-3-5-sonnet-20240620", max_connections=None, max_concurrency=None, keep_alive=True, http2=True,
+                 base_url=None, api_url=None, human_delays=None, upload_cache=None, retry_policy=None, circuit_breaker=None,
+                 history_store=None, history_max_age=None):
         self.cookie = cookie
-        self.organization_id = os.getenv('ORGANIZATION_ID') 
+        self.organization_id = os.getenv('ORGANIZATION_ID')
         self.model = model
-        logger.debug(f"Initialized Client with organization_id: {self.organization_id} and model: {self.model}")
+        # Overridable so the client can be pointed at a local mock upstream
+        self.base_url = (base_url or os.getenv('CLAUDE_BASE_URL', 'https://claude.ai')).rstrip('/')
+        self.api_url = (api_url or os.getenv('CLAUDE_API_URL', 'https://api.claude.ai')).rstrip('/')
+        if human_delays is None:
+            human_delays = os.getenv('HUMAN_DELAYS', 'true').lower() in ('1', 'true', 'yes')
+        self.human_delays = human_delays
+        # max_connections idle connections are kept for reuse; max_concurrency
+        # requests (each holding a curl handle, a stream until it ends) can be
+        # in flight at once
+        self.max_connections = max_connections or int(os.getenv('CLAUDE_MAX_CONNECTIONS', 10))
+        self.max_concurrency = max_concurrency or int(os.getenv('CLAUDE_MAX_CONCURRENCY', 100))
+        self.keep_alive = keep_alive
+        self.http2 = http2
+        self._session = None
+        self._slots = None  # Semaphore of the max_concurrency request slots
+        self._stats_lock = threading.Lock()
+        # waiting: requests queued for a slot; in_flight: requests upstream
+        self._stats = {"requests": 0, "errors": 0, "waiting": 0, "peak_waiting": 0, "in_flight": 0, "peak_in_flight": 0}
+        if upload_cache is None and os.getenv('UPLOAD_CACHE_DIR'):
+            upload_cache = UploadCache(os.getenv('UPLOAD_CACHE_DIR'), max_bytes=int(os.getenv('UPLOAD_CACHE_MAX_MB', 256)) * 1024 * 1024)
+        self.upload_cache = upload_cache
+        # With a history store, list_all_conversations and
+        # chat_conversation_history are answered from it while it is at most
+        # history_max_age seconds old
+        if history_store is None and os.getenv('HISTORY_DB_PATH'):
+            history_store = HistoryStore(os.getenv('HISTORY_DB_PATH'))
+        self.history_store = history_store
+        self.history_max_age = history_max_age if history_max_age is not None else float(os.getenv('HISTORY_MAX_AGE', 300))
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', 3)),
+            base_delay=float(os.getenv('RETRY_BASE_DELAY', 0.5)),
+            max_delay=float(os.getenv('RETRY_MAX_DELAY', 30)),
+            deadline=float(os.getenv('RETRY_DEADLINE', 60)),
+        )
+        # Shared by every call made by this client; a threshold of 0 disables it
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(
+            failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),
+            reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30)),
+        )
+        logger.debug("Initialized %s with organization_id: %s and model: %s", type(self).__name__, self.organization_id, self.model)
 
-    def get_organization_id(self):
-        url = "https://claude.ai/api/organizations"
-        
+    def _session_options(self):
+        # Shared by the sync and async sessions. Connections are kept in the
+        # curl connection cache and reused by every call made by this client.
+        curl_options = {CurlOpt.MAXCONNECTS: self.max_connections}
+        if self.keep_alive:
+            curl_options[CurlOpt.TCP_KEEPALIVE] = 1
+            curl_options[CurlOpt.TCP_KEEPIDLE] = 60
+            curl_options[CurlOpt.TCP_KEEPINTVL] = 30
+        return {
+            "impersonate": "chrome110",
+            "http_version": CurlHttpVersion.V2TLS if self.http2 else CurlHttpVersion.V1_1,
+            "curl_options": curl_options,
+        }
+
+    def _count_waiting(self, change):
+        with self._stats_lock:
+            self._stats["waiting"] += change
+            self._stats["peak_waiting"] = max(self._stats["peak_waiting"], self._stats["waiting"])
+
+    def _begin_request(self):
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], self._stats["in_flight"])
+
+    def _end_request(self, failed=False):
+        with self._stats_lock:
+            self._stats["in_flight"] -= 1
+            if failed:
+                self._stats["errors"] += 1
+        self._slots.release()
+
+    def _retry_delay(self, operation, attempt, max_attempts, started, response=None, error=None):
+        # Seconds to wait before retrying a failed attempt, or None to give up
+        if isinstance(error, CircuitOpenError) or self.circuit_breaker.is_open():
+            return None
+        delay = self.retry_policy.next_delay(attempt, max_attempts, started, response)
+        if delay is not None:
+            CLIENT_RETRIES.inc(method=operation)
+            reason = f"status {response.status_code}" if response is not None else error
+            logger.warning("%s failed (%s), retrying in %.2f seconds (attempt %s/%s)",
+                           operation, reason, delay, attempt + 1, max_attempts)
+        return delay
+
+    def _record_outcome(self, response=None, error=None):
+        # Feeds the circuit breaker; anything but an Exception (e.g. a
+        # cancellation) just frees a half-open probe without counting
+        if response is not None:
+            self.circuit_breaker.record(response.status_code)
+        elif isinstance(error, Exception):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.cancel()
+
+    def pool_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            "max_connections": self.max_connections,
+            "max_concurrency": self.max_concurrency,
+            "keep_alive": self.keep_alive,
+            "http2": self.http2,
+            "session_open": self._session is not None,
+        })
+        return stats
+
+    def _build_headers(self, accept='*/*', referer='https://claude.ai/chats', content_type='application/json', keep_alive=True):
         headers = {
             'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
+            'Accept': accept,
             'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Referer': 'https://claude.ai/chats',
-            'Content-Type': 'application/json',
+            'Referer': referer,
             'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
             'Cookie': f'{self.cookie}'
         }
+        if content_type:
+            headers['Content-Type'] = content_type
+        if keep_alive:
+            headers['Connection'] = 'keep-alive'
+        return headers
 
-        try:
-            logger.info("Human-like behavior: Fetching organization ID")
-            time.sleep(random.uniform(0.5, 1.5))  # Simulate human delay
-            response = requests.get(url, headers=headers, impersonate="chrome110")
-            res = json.loads(response.text)
-            logger.debug(f"API response for organizations: {res}")
-            uuid = self.organization_id  # Using the hardcoded value
-            logger.debug(f"Returning organization UUID: {uuid}")
-            logger.info("Human-like behavior: Retrieved organization ID")
-            return uuid
-        except Exception as e:
-            logger.error(f"Error in get_organization_id: {str(e)}")
-            return None
+    def _build_completion_request(self, prompt, conversation_id, model=None, attachments=None):
+        url = f"{self.api_url}/api/organizations/{self.organization_id}/chat_conversations/{conversation_id}/completion"
+
+        payload = json.dumps({
+            "prompt": prompt,
+            "timezone": "Atlantic/Canary",
+            "model": model or self.model,
+            "attachments": attachments or [],
+            "files": [],
+            "rendering_mode": "raw"
+        })
+
+        headers = self._build_headers(accept='text/event-stream, text/event-stream', referer='https://claude.ai/', keep_alive=False)
+        return url, headers, payload
+
+    def _build_create_chat_request(self, model=None, name=None):
+        url = f"{self.api_url}/api/organizations/{self.organization_id}/chat_conversations"
+        uuid = self.generate_uuid()
+
+        payload = json.dumps({
+            "uuid": uuid,
+            "name": name or "",
+            "model": model or self.model
+        })
+        headers = self._build_headers(referer='https://claude.ai/')
+        return url, headers, payload
+
+    def _build_rename_chat_request(self, title, conversation_id):
+        url = f"{self.base_url}/api/rename_chat"
+
+        payload = json.dumps({
+            "organization_uuid": f"{self.organization_id}",
+            "conversation_uuid": f"{conversation_id}",
+            "title": f"{title}"
+        })
+        return url, self._build_headers(), payload
+
+    def _build_upload_multipart(self, file_path):
+        file_name = os.path.basename(file_path)
+        multipart = CurlMime()
+        multipart.addpart(name='file', content_type=self.get_content_type(file_path), filename=file_name, local_path=file_path)
+        multipart.addpart(name='orgUuid', data=f"{self.organization_id}".encode('utf-8'))
+        return multipart
+
+    def _conversations_url(self, conversation_id=None):
+        url = f"{self.base_url}/api/organizations/{self.organization_id}/chat_conversations"
+        if conversation_id:
+            url = f"{url}/{conversation_id}"
+        return url
+
+    @staticmethod
+    def conversation_matches(conversation, name=None, older_than=None, idle_for=None, now=None):
+        # Filters for list_conversations: exact name, created more than
+        # older_than seconds ago, last updated more than idle_for seconds ago
+        if name is not None and conversation.get('name') != name:
+            return False
+        now = now or time.time()
+        for field, age in (('created_at', older_than), ('updated_at', idle_for)):
+            if age is not None:
+                timestamp = parse_timestamp(conversation.get(field))
+                if timestamp is None or now - timestamp < age:
+                    return False
+        return True
+
+    def _filter_page(self, page, seen, filters, now):
+        # Returns (matching conversations, number of conversations not seen on
+        # an earlier page) for one page of list_conversations
+        new = [conversation for conversation in page if conversation.get('uuid') not in seen]
+        seen.update(conversation.get('uuid') for conversation in new)
+        return [conversation for conversation in new if self.conversation_matches(conversation, now=now, **filters)], len(new)
+
+    def _store_history(self, conversation_id, response):
+        # Records a fetched conversation in the history store; True if the
+        # store now agrees with upstream
+        if response.status_code == 200:
+            self.history_store.save_history(response.json())
+            return True
+        if response.status_code == 404:
+            self.history_store.remove(conversation_id)
+            return True
+        logger.error("Failed to fetch conversation %s: %s", conversation_id, response.status_code)
+        return False
+
+    @staticmethod
+    def _attachment_items(attachment, attachments):
+        # send_message takes a single attachment (the original argument) and/or
+        # a list; each item is a file path or a prepared attachment dict
+        items = [attachment] if attachment else []
+        return items + list(attachments or [])
+
+    def _cached_upload(self, file_path):
+        # Returns (content hash, prior convert_document result or None); the
+        # hash is None when there is no upload cache
+        if self.upload_cache is None:
+            return None, None
+        digest = file_digest(file_path)
+        result = self.upload_cache.get(digest)
+        if result is not None:
+            logger.info("Reusing converted document %s for %s", digest[:12], os.path.basename(file_path))
+            # Same contents, possibly under another name
+            result = dict(result, file_name=os.path.basename(file_path))
+        return digest, result
+
+    def _read_text_attachment(self, file_path):
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'r', encoding='utf-8') as file:
+            file_content = file.read()
+
+        logger.info("Human-like behavior: Uploaded text file %s", file_name)
+        return {
+            "file_name": file_name,
+            "file_type": "text/plain",
+            "file_size": file_size,
+            "extracted_content": file_content
+        }
 
     def get_content_type(self, file_path):
         extension = os.path.splitext(file_path)[-1].lower()
@@ -63,324 +337,895 @@ class Client:
         else:
             return 'application/octet-stream'
 
-    def list_all_conversations(self):
-        url = f"https://claude.ai/api/organizations/{self.organization_id}/chat_conversations"
+    def generate_uuid(self):
+        random_uuid = uuid.uuid4()
+        random_uuid_str = str(random_uuid)
+        formatted_uuid = f"{random_uuid_str[0:8]}-{random_uuid_str[9:13]}-{random_uuid_str[14:18]}-{random_uuid_str[19:23]}-{random_uuid_str[24:]}"
+        return formatted_uuid
 
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Referer': 'https://claude.ai/chats',
-            'Content-Type': 'application/json',
-            'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
-            'Cookie': f'{self.cookie}'
-        }
+    def get_random_user_agent(self):
+        user_agents = [
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+            'Mozilla/5.0 (X11; Linux x86_64; rv:89.0) Gecko/20100101 Firefox/89.0',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36',
+            'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Mobile/15E148 Safari/604.1'
+        ]
+        return random.choice(user_agents)
+
+    def get_available_models(self):
+        # This is a placeholder method. In a real implementation, you would fetch this from the API.
+        # For now, we'll return a list of known Claude models.
+        return [
+            "claude-3-opus-20240229",
+            "claude-3-sonnet-20240229",
+            "claude-3-haiku-20240307",
+            "claude-3-5-sonnet-20240620",
+            "claude-2.1",
+            "claude-2.0"
+        ]
+
+    def validate_model(self, model):
+        available_models = self.get_available_models()
+        if model not in available_models:
+            logger.error("Invalid model: %s. Available models are: %s", model, ', '.join(available_models))
+            raise ValueError(f"Invalid model: {model}")
+        return model
+
+    def set_model(self, model):
+        self.model = self.validate_model(model)
+        logger.info("Model set to: %s", self.model)
+
+    def get_current_model(self):
+        return self.model
+
+
+class Client(BaseClient):
+
+    def _human_pause(self, seconds):
+        if self.human_delays:
+            time.sleep(seconds)
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session(**self._session_options())
+        return self._session
+
+    def _acquire_slot(self):
+        with self._stats_lock:
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        if self._slots.acquire(blocking=False):
+            return
+        self._count_waiting(1)
+        try:
+            self._slots.acquire()
+        finally:
+            self._count_waiting(-1)
+
+    def _request(self, method, url, stream=False, operation="request", max_attempts=None, **kwargs):
+        # Every call goes through the pooled session. Failed attempts are
+        # retried per retry_policy; the response of the last attempt is
+        # returned, and the last transport error raised. Streamed responses
+        # stay counted as in flight until the caller closes them via
+        # _close_stream.
+        max_attempts = max_attempts or self.retry_policy.max_attempts
+        started = time.monotonic()
+        for attempt in range(max_attempts):
+            try:
+                response = self._send(method, url, stream, **kwargs)
+            except requests.RequestsError as e:
+                delay = self._retry_delay(operation, attempt, max_attempts, started, error=e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            delay = self._retry_delay(operation, attempt, max_attempts, started, response=response)
+            if delay is None:
+                return response
+            if stream:
+                self._close_stream(response)
+            time.sleep(delay)
+
+    def _send(self, method, url, stream, **kwargs):
+        self.circuit_breaker.before_request()
+        try:
+            self._acquire_slot()
+        except BaseException as e:
+            self._record_outcome(error=e)
+            raise
+        self._begin_request()
+        try:
+            response = self.session.request(method, url, stream=stream, **kwargs)
+        except BaseException as e:
+            UPSTREAM_REQUEST_ERRORS.inc()
+            self._end_request(failed=True)
+            self._record_outcome(error=e)
+            raise
+        UPSTREAM_RESPONSES.inc(status=str(response.status_code))
+        self._record_outcome(response)
+        if not stream:
+            self._end_request(failed=response.status_code >= 400)
+        return response
+
+    def _close_stream(self, response):
+        response.close()
+        self._end_request(failed=response.status_code >= 400)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="get_organization_id")
+    def get_organization_id(self):
+        url = f"{self.base_url}/api/organizations"
+        headers = self._build_headers()
+
+        try:
+            logger.info("Human-like behavior: Fetching organization ID")
+            self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+            response = self._request("GET", url, operation="get_organization_id", headers=headers)
+            res = json.loads(response.text)
+            logger.debug("API response for organizations: %s", truncate(res))
+            uuid = self.organization_id  # Using the hardcoded value
+            logger.debug("Returning organization UUID: %s", uuid)
+            logger.info("Human-like behavior: Retrieved organization ID")
+            return uuid
+        except Exception as e:
+            logger.error("Error in get_organization_id: %s", e)
+            return None
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="list_all_conversations")
+    def list_all_conversations(self, max_age=None):
+        if self.history_store is not None:
+            # Only the list is refreshed; changed conversations are fetched
+            # when their history is read (or by sync_history)
+            if not self.history_store.is_fresh(self.history_max_age if max_age is None else max_age):
+                conversations = self.list_conversations()
+                if conversations is None:
+                    return None
+                self.history_store.save_listing(conversations)
+            return self.history_store.conversations()
+        url = self._conversations_url()
+        headers = self._build_headers()
 
         logger.info("Human-like behavior: Listing conversations")
-        time.sleep(random.uniform(1, 2))  # Simulate human delay
-        response = requests.get(url, headers=headers, impersonate="chrome110")
+        self._human_pause(random.uniform(1, 2))  # Simulate human delay
+        response = self._request("GET", url, operation="list_all_conversations", headers=headers)
         conversations = response.json()
 
         if response.status_code == 200:
-            logger.info(f"Human-like behavior: Retrieved {len(conversations)} conversations")
+            logger.info("Human-like behavior: Retrieved %s conversations", len(conversations))
             return conversations
         else:
-            logger.error(f"Error: {response.status_code} - {response.text}")
+            logger.error("Error: %s - %s", response.status_code, truncate(response.content))
             return None
 
-    def send_message(self, prompt, conversation_id, attachment=None, timeout=500, max_retries=3):
-        logger.info(f"Human-like behavior: Composing message for conversation {conversation_id}")
-        url = f"https://api.claude.ai/api/organizations/{self.organization_id}/chat_conversations/{conversation_id}/completion"
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="send_message")
+    def send_message(self, prompt, conversation_id, attachment=None, timeout=500, max_retries=3, model=None, attachments=None):
+        logger.info("Human-like behavior: Composing message for conversation %s", conversation_id)
 
         # Simulate human typing speed
         typing_delay = len(prompt) * 0.00005  # 50ms per character
-        logger.info(f"Human-like behavior: Typing message (simulated delay: {typing_delay:.2f} seconds)")
-        time.sleep(typing_delay)
+        logger.info("Human-like behavior: Typing message (simulated delay: %.2f seconds)", typing_delay)
+        self._human_pause(typing_delay)
 
-        payload = json.dumps({
-            "prompt": prompt,
-            "timezone": "Atlantic/Canary",
-            "model": self.model,
-            "attachments": [],
-            "files": [],
-            "rendering_mode": "raw"
-        })
-        logger.debug(f"Request payload: {payload}")
+        attachments = self.prepare_attachments(self._attachment_items(attachment, attachments))
+        if attachments is None:
+            return UpstreamError("Error: Failed to upload attachments")
 
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': 'text/event-stream, text/event-stream',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Referer': 'https://claude.ai/',
-            'Content-Type': 'application/json',
-            'Origin': 'https://claude.ai',
-            'Cookie': f'{self.cookie}'
-        }
-        logger.debug(f"Request headers: {headers}")
+        url, headers, payload = self._build_completion_request(prompt, conversation_id, model, attachments)
+        logger.debug("Request payload: %s", truncate(payload))
+        logger.debug("Request headers: %s", redact(headers))
 
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"Human-like behavior: Sending message (Attempt {attempt + 1}/{max_retries})")
-                response = requests.post(url, headers=headers, data=payload, impersonate="chrome110", timeout=timeout)
-                logger.info(f"Received response with status code: {response.status_code}")
-                logger.debug(f"Response headers: {response.headers}")
-                logger.debug(f"Raw response content: {response.content}")
-
-                if response.status_code != 200:
-                    logger.error(f"Received non-200 status code: {response.status_code}")
-                    if attempt < max_retries - 1:
-                        retry_delay = random.uniform(1, 3)
-                        logger.warning(f"Human-like behavior: Retrying in {retry_delay:.2f} seconds...")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        return f"Error: Received status code {response.status_code} after {max_retries} attempts"
-
-                decoded_data = response.content.decode("utf-8")
-                logger.debug(f"Decoded response data: {decoded_data}")
-
-                completions = []
-                for line in decoded_data.split('\n'):
-                    if line.startswith('data: '):
-                        try:
-                            data = json.loads(line[6:])
-                            if data['type'] == 'completion' and 'completion' in data:
-                                completions.append(data['completion'])
-                                logger.debug(f"Added completion: {data['completion']}")
-                        except json.JSONDecodeError:
-                            logger.warning(f"Failed to parse JSON: {line[6:]}")
-
-                answer = ''.join(completions)
-                logger.info(f"Human-like behavior: Received answer (length: {len(answer)})")
-                
-                # Simulate human reading time
-                reading_time = len(answer) * 0.005  # 10ms per character
-                logger.info(f"Human-like behavior: Reading response (simulated delay: {reading_time:.2f} seconds)")
-                time.sleep(reading_time)
-                
-                logger.debug(f"Final answer: {answer}")
-                return answer
-
-            except requests.RequestException as e:
-                logger.error(f"Request failed: {str(e)}")
-                if attempt < max_retries - 1:
-                    retry_delay = random.uniform(1, 3)
-                    logger.warning(f"Human-like behavior: Retrying in {retry_delay:.2f} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    return f"Error: Request failed after {max_retries} attempts - {str(e)}"
-
-        logger.error("Failed to get a valid response after all retries")
-        return "Error: Failed to get a valid response from the API"
+        try:
+            logger.info("Human-like behavior: Sending message")
+            response = self._request("POST", url, operation="send_message", max_attempts=max_retries,
+                                     headers=headers, data=payload, timeout=timeout)
+        except requests.RequestsError as e:
+            logger.error("Request failed: %s", e)
+            return UpstreamError(f"Error: Request failed - {str(e)}")
+        logger.info("Received response with status code: %s", response.status_code)
+        logger.debug("Response headers: %s", redact(response.headers))
+
+        if response.status_code != 200:
+            logger.error("Received non-200 status code: %s", response.status_code)
+            return UpstreamError(f"Error: Received status code {response.status_code}")
+
+        parser = CompletionParser()
+        completions = parser.feed(response.content) + parser.flush()
+        if parser.error:
+            return UpstreamError(f"Error: {parser.error}")
+
+        answer = ''.join(completions)
+        logger.info("Human-like behavior: Received answer (length: %s, stop reason: %s)", len(answer), parser.stop_reason)
+
+        # Simulate human reading time
+        reading_time = len(answer) * 0.005  # 10ms per character
+        logger.info("Human-like behavior: Reading response (simulated delay: %.2f seconds)", reading_time)
+        self._human_pause(reading_time)
+
+        logger.debug("Final answer: %s", truncate(answer))
+        return answer
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="stream_message")
+    def stream_message(self, prompt, conversation_id, attachment=None, timeout=500, max_retries=3, model=None, attachments=None):
+        # Same request as send_message, but completion deltas are yielded as the
+        # SSE events arrive instead of after the whole body has been read.
+        # Retries only happen before the first delta has been yielded.
+        logger.info("Human-like behavior: Composing message for conversation %s", conversation_id)
 
+        typing_delay = len(prompt) * 0.00005
+        logger.info("Human-like behavior: Typing message (simulated delay: %.2f seconds)", typing_delay)
+        self._human_pause(typing_delay)
+
+        attachments = self.prepare_attachments(self._attachment_items(attachment, attachments))
+        if attachments is None:
+            yield UpstreamError("Error: Failed to upload attachments")
+            return
+
+        url, headers, payload = self._build_completion_request(prompt, conversation_id, model, attachments)
+        logger.debug("Request payload: %s", truncate(payload))
+
+        try:
+            logger.info("Human-like behavior: Streaming message")
+            response = self._request("POST", url, operation="stream_message", max_attempts=max_retries,
+                                     headers=headers, data=payload, timeout=timeout, stream=True)
+        except requests.RequestsError as e:
+            logger.error("Request failed: %s", e)
+            yield UpstreamError(f"Error: Request failed - {str(e)}")
+            return
+
+        try:
+            logger.info("Received response with status code: %s", response.status_code)
+            if response.status_code != 200:
+                logger.error("Received non-200 status code: %s", response.status_code)
+                yield UpstreamError(f"Error: Received status code {response.status_code}")
+                return
+
+            parser = CompletionParser()
+            length = 0
+            for chunk in response.iter_content():
+                for completion in parser.feed(chunk):
+                    length += len(completion)
+                    yield completion
+            for completion in parser.flush():
+                length += len(completion)
+                yield completion
+            if parser.error:
+                yield UpstreamError(f"Error: {parser.error}")
+            logger.info("Human-like behavior: Received streamed answer (length: %s, stop reason: %s)", length, parser.stop_reason)
+            return
+        except requests.RequestsError as e:
+            logger.error("Stream interrupted: %s", e)
+            yield UpstreamError(f"Error: Stream interrupted - {str(e)}")
+            return
+        finally:
+            self._close_stream(response)
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="delete_conversation")
     def delete_conversation(self, conversation_id):
-        url = f"https://claude.ai/api/organizations/{self.organization_id}/chat_conversations/{conversation_id}"
+        url = self._conversations_url(conversation_id)
 
         payload = json.dumps(f"{conversation_id}")
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Content-Type': 'application/json',
-            'Referer': 'https://claude.ai/chats',
-            'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
-            'Cookie': f'{self.cookie}'
-        }
+        headers = self._build_headers()
 
-        logger.info(f"Human-like behavior: Deleting conversation {conversation_id}")
-        time.sleep(random.uniform(0.5, 1.5))  # Simulate human delay
-        response = requests.delete(url, headers=headers, data=payload, impersonate="chrome110")
+        logger.info("Human-like behavior: Deleting conversation %s", conversation_id)
+        self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+        response = self._request("DELETE", url, operation="delete_conversation", headers=headers, data=payload)
 
         if response.status_code == 204:
-            logger.info(f"Human-like behavior: Successfully deleted conversation {conversation_id}")
+            logger.info("Human-like behavior: Successfully deleted conversation %s", conversation_id)
         else:
-            logger.error(f"Failed to delete conversation {conversation_id}")
+            logger.error("Failed to delete conversation %s", conversation_id)
 
         return response.status_code == 204
 
-    def chat_conversation_history(self, conversation_id):
-        url = f"https://claude.ai/api/organizations/{self.organization_id}/chat_conversations/{conversation_id}"
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="chat_conversation_history")
+    def chat_conversation_history(self, conversation_id, max_age=None):
+        if self.history_store is not None:
+            history = self.history_store.history(conversation_id, self.history_max_age if max_age is None else max_age)
+            if history is not None:
+                return history
+        response = self._fetch_history(conversation_id)
+        if self.history_store is not None:
+            self._store_history(conversation_id, response)
+        return response.json()
 
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Referer': 'https://claude.ai/chats',
-            'Content-Type': 'application/json',
-            'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
-            'Cookie': f'{self.cookie}'
-        }
+    def _fetch_history(self, conversation_id):
+        url = self._conversations_url(conversation_id)
+        headers = self._build_headers()
 
-        logger.info(f"Human-like behavior: Fetching conversation history for {conversation_id}")
-        time.sleep(random.uniform(0.8, 1.8))  # Simulate human delay
-        response = requests.get(url, headers=headers, impersonate="chrome110")
-        logger.info(f"Human-like behavior: Retrieved conversation history")
-        return response.json()
+        logger.info("Human-like behavior: Fetching conversation history for %s", conversation_id)
+        self._human_pause(random.uniform(0.8, 1.8))  # Simulate human delay
+        response = self._request("GET", url, operation="chat_conversation_history", headers=headers)
+        logger.info("Human-like behavior: Retrieved conversation history")
+        return response
 
-    def generate_uuid(self):
-        random_uuid = uuid.uuid4()
-        random_uuid_str = str(random_uuid)
-        formatted_uuid = f"{random_uuid_str[0:8]}-{random_uuid_str[9:13]}-{random_uuid_str[14:18]}-{random_uuid_str[19:23]}-{random_uuid_str[24:]}"
-        return formatted_uuid
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="sync_history")
+    def sync_history(self, concurrency=4, rate=None):
+        # Brings history_store up to date: lists the conversations, then
+        # fetches only those whose updated_at changed since they were stored,
+        # with at most concurrency requests in flight and rate per second.
+        # Returns the number fetched, or None if the list couldn't be read.
+        conversations = self.list_conversations()
+        if conversations is None:
+            return None
+        stale = self.history_store.save_listing(conversations)
+        limiter = RateLimiter(rate)
 
-    def create_new_chat(self):
-        url = f"https://api.claude.ai/api/organizations/{self.organization_id}/chat_conversations"
-        uuid = self.generate_uuid()
-        
-        payload = json.dumps({
-            "uuid": uuid,
-            "name": "",
-            "model": self.model
-        })
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Content-Type': 'application/json',
-            'Origin': 'https://claude.ai',
-            'Referer': 'https://claude.ai/',
-            'Connection': 'keep-alive',
-            'Cookie': self.cookie
-        }
+        def fetch(conversation_id):
+            limiter.wait()
+            try:
+                return self._store_history(conversation_id, self._fetch_history(conversation_id))
+            except Exception as e:
+                logger.error("Failed to fetch conversation %s: %s", conversation_id, e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="claude-history") as executor:
+            fetched = sum(executor.map(fetch, stale))
+        # Conversations that failed stay stale and are fetched by the next sync
+        if fetched == len(stale):
+            self.history_store.mark_synced()
+        logger.info("History synced: fetched %s of %s changed conversations", fetched, len(stale))
+        return fetched
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="create_new_chat")
+    def create_new_chat(self, model=None, name=None):
+        url, headers, payload = self._build_create_chat_request(model, name)
 
         try:
             logger.info("Human-like behavior: Creating new chat")
-            time.sleep(random.uniform(0.5, 1.5))  # Simulate human delay
-            response = requests.post(url, headers=headers, data=payload, impersonate="chrome110")
-            logger.debug(f"Create new chat response status: {response.status_code}")
-            logger.debug(f"Create new chat response content: {response.text}")
+            self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+            response = self._request("POST", url, operation="create_new_chat", headers=headers, data=payload)
+            logger.debug("Create new chat response status: %s", response.status_code)
+            logger.debug("Create new chat response content: %s", truncate(response.content))
             logger.info("Human-like behavior: New chat created successfully")
             return response.json()
         except Exception as e:
-            logger.error(f"Error in create_new_chat: {str(e)}")
+            logger.error("Error in create_new_chat: %s", e)
             return None
 
-    def reset_all(self):
-        conversations = self.list_all_conversations()
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="list_conversations")
+    def list_conversations(self, page_size=100, name=None, older_than=None, idle_for=None):
+        # Pages through the conversation list and returns the conversations
+        # matching the filters (see conversation_matches), or None on error
+        url = self._conversations_url()
+        headers = self._build_headers()
+        filters = {"name": name, "older_than": older_than, "idle_for": idle_for}
+        now = time.time()
+        conversations, seen, offset = [], set(), 0
+
+        logger.info("Human-like behavior: Listing conversations")
+        while True:
+            response = self._request("GET", url, operation="list_conversations", headers=headers, params={"limit": page_size, "offset": offset})
+            if response.status_code != 200:
+                logger.error("Error: %s - %s", response.status_code, truncate(response.content))
+                return None
+            page = response.json()
+            matches, new = self._filter_page(page, seen, filters, now)
+            conversations.extend(matches)
+            # A short page is the last one; no new conversations means the
+            # upstream ignored the paging parameters and sent everything
+            if len(page) < page_size or not new:
+                logger.info("Human-like behavior: Retrieved %s matching conversations", len(conversations))
+                return conversations
+            offset += len(page)
+            self._human_pause(random.uniform(0.3, 0.7))  # Simulate human delay between pages
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="delete_conversations")
+    def delete_conversations(self, conversation_ids, concurrency=4, rate=None):
+        # Deletes conversations with at most concurrency requests in flight and
+        # at most rate deletions started per second. Returns {id: deleted}.
+        limiter = RateLimiter(rate)
+
+        def delete(conversation_id):
+            limiter.wait()
+            try:
+                return self.delete_conversation(conversation_id)
+            except Exception as e:
+                logger.error("Failed to delete conversation %s: %s", conversation_id, e)
+                return False
+
+        conversation_ids = list(conversation_ids)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="claude-delete") as executor:
+            results = dict(zip(conversation_ids, executor.map(delete, conversation_ids)))
+        logger.info("Deleted %s of %s conversations", sum(results.values()), len(results))
+        return results
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="reset_all")
+    def reset_all(self, concurrency=4, rate=None):
+        conversations = self.list_conversations()
         if conversations:
-            logger.info(f"Human-like behavior: Resetting all conversations")
-            for conversation in conversations:
-                conversation_id = conversation['uuid']
-                self.delete_conversation(conversation_id)
-                time.sleep(random.uniform(0.3, 0.7))  # Simulate human delay between deletions
+            logger.info("Human-like behavior: Resetting all conversations")
+            self.delete_conversations([conversation['uuid'] for conversation in conversations], concurrency, rate)
             logger.info("Human-like behavior: All conversations reset")
             return True
         logger.info("Human-like behavior: No conversations to reset")
         return False
 
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="upload_attachment")
     def upload_attachment(self, file_path):
-        logger.info(f"Human-like behavior: Preparing to upload attachment {file_path}")
+        logger.info("Human-like behavior: Preparing to upload attachment %s", file_path)
         if file_path.endswith('.txt'):
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            file_type = "text/plain"
-            with open(file_path, 'r', encoding='utf-8') as file:
-                file_content = file.read()
-
-            logger.info(f"Human-like behavior: Uploaded text file {file_name}")
-            return {
-                "file_name": file_name,
-                "file_type": file_type,
-                "file_size": file_size,
-                "extracted_content": file_content
-            }
-        url = 'https://claude.ai/api/convert_document'
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Referer': 'https://claude.ai/chats',
-            'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
-            'Cookie': f'{self.cookie}'
-        }
+            return self._read_text_attachment(file_path)
 
-        file_name = os.path.basename(file_path)
-        content_type = self.get_content_type(file_path)
+        digest, cached = self._cached_upload(file_path)
+        if cached is not None:
+            return cached
 
-        files = {
-            'file': (file_name, open(file_path, 'rb'), content_type),
-            'orgUuid': (None, self.organization_id)
-        }
+        url = f"{self.base_url}/api/convert_document"
+        headers = self._build_headers(content_type=None)
+        file_name = os.path.basename(file_path)
+        # The file is streamed from disk by curl rather than read into memory
+        multipart = self._build_upload_multipart(file_path)
 
-        logger.info(f"Human-like behavior: Uploading file {file_name}")
-        time.sleep(random.uniform(1, 3))  # Simulate human delay for file upload
-        response = req.post(url, headers=headers, files=files)
+        logger.info("Human-like behavior: Uploading file %s", file_name)
+        self._human_pause(random.uniform(1, 3))  # Simulate human delay for file upload
+        try:
+            response = self._request("POST", url, operation="upload_attachment", headers=headers, multipart=multipart)
+        finally:
+            multipart.close()
         if response.status_code == 200:
-            logger.info(f"Human-like behavior: Successfully uploaded file {file_name}")
-            return response.json()
+            logger.info("Human-like behavior: Successfully uploaded file %s", file_name)
+            result = response.json()
+            if digest:
+                self.upload_cache.put(digest, result)
+            return result
         else:
-            logger.error(f"Failed to upload file {file_name}")
+            logger.error("Failed to upload file %s", file_name)
             return False
 
-    def rename_chat(self, title, conversation_id):
-        url = "https://claude.ai/api/rename_chat"
+    def prepare_attachments(self, items):
+        # Uploads the file paths among items in parallel (prepared attachment
+        # dicts are kept as they are) and returns the attachments in order,
+        # or None if any upload failed
+        paths = [item for item in items if not isinstance(item, dict)]
+        if not paths:
+            return list(items)
+        with ThreadPoolExecutor(max_workers=min(len(paths), self.max_concurrency), thread_name_prefix="claude-upload") as executor:
+            uploaded = dict(zip(paths, executor.map(self.upload_attachment, paths)))
+        if not all(uploaded.values()):
+            logger.error("Failed to upload %s of %s attachments", sum(not result for result in uploaded.values()), len(paths))
+            return None
+        return [item if isinstance(item, dict) else uploaded[item] for item in items]
 
-        payload = json.dumps({
-            "organization_uuid": f"{self.organization_id}",
-            "conversation_uuid": f"{conversation_id}",
-            "title": f"{title}"
-        })
-        headers = {
-            'User-Agent': self.get_random_user_agent(),
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9,ar;q=0.8',
-            'Content-Type': 'application/json',
-            'Referer': 'https://claude.ai/chats',
-            'Origin': 'https://claude.ai',
-            'Connection': 'keep-alive',
-            'Cookie': f'{self.cookie}'
-        }
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="rename_chat")
+    def rename_chat(self, title, conversation_id):
+        url, headers, payload = self._build_rename_chat_request(title, conversation_id)
 
-        logger.info(f"Human-like behavior: Renaming conversation {conversation_id} to '{title}'")
-        time.sleep(random.uniform(0.5, 1.5))  # Simulate human delay
-        response = requests.post(url, headers=headers, data=payload, impersonate="chrome110")
+        logger.info("Human-like behavior: Renaming conversation %s to '%s'", conversation_id, title)
+        self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+        response = self._request("POST", url, operation="rename_chat", headers=headers, data=payload)
 
         if response.status_code == 200:
-            logger.info(f"Human-like behavior: Successfully renamed conversation to '{title}'")
+            logger.info("Human-like behavior: Successfully renamed conversation to '%s'", title)
         else:
-            logger.error(f"Failed to rename conversation {conversation_id}")
+            logger.error("Failed to rename conversation %s", conversation_id)
 
         return response.status_code == 200
 
-    def get_random_user_agent(self):
-        user_agents = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
-            'Mozilla/5.0 (X11; Linux x86_64; rv:89.0) Gecko/20100101 Firefox/89.0',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36',
-            'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Mobile/15E148 Safari/604.1'
-        ]
-        return random.choice(user_agents)
+# End of Client class
 
-    def get_available_models(self):
-        # This is a placeholder method. In a real implementation, you would fetch this from the API.
-        # For now, we'll return a list of known Claude models.
-        return [
-            "claude-3-opus-20240229",
-            "claude-3-sonnet-20240229",
-            "claude-3-haiku-20240307",
-            "claude-3-5-sonnet-20240620",
-            "claude-2.1",
-            "claude-2.0"
-        ]
 
-    def set_model(self, model):
-        available_models = self.get_available_models()
-        if model in available_models:
-            self.model = model
-            logger.info(f"Model set to: {self.model}")
+class AsyncClient(BaseClient):
+    # asyncio counterpart of Client with the same methods, each returning a
+    # coroutine (stream_message returns an async generator). Requests go
+    # through a curl_cffi AsyncSession, so many calls can be in flight at once
+    # on a single event loop without blocking it.
+
+    @property
+    def session(self):
+        # Created lazily so the session binds to the running event loop
+        if self._session is None:
+            self._session = requests.AsyncSession(max_clients=self.max_concurrency, **self._session_options())
+        return self._session
+
+    async def _acquire_slot(self):
+        # The session has a curl handle for every slot, so a request holding
+        # one never waits inside curl_cffi, where it couldn't be counted
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if not self._slots.locked():
+            await self._slots.acquire()  # Returns at once
+            return
+        self._count_waiting(1)
+        try:
+            await self._slots.acquire()
+        finally:
+            self._count_waiting(-1)
+
+    async def _human_pause(self, seconds):
+        if self.human_delays:
+            await asyncio.sleep(seconds)
+
+    async def _request(self, method, url, stream=False, operation="request", max_attempts=None, **kwargs):
+        max_attempts = max_attempts or self.retry_policy.max_attempts
+        started = time.monotonic()
+        for attempt in range(max_attempts):
+            try:
+                response = await self._send(method, url, stream, **kwargs)
+            except requests.RequestsError as e:
+                delay = self._retry_delay(operation, attempt, max_attempts, started, error=e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            delay = self._retry_delay(operation, attempt, max_attempts, started, response=response)
+            if delay is None:
+                return response
+            if stream:
+                await self._close_stream(response)
+            await asyncio.sleep(delay)
+
+    async def _send(self, method, url, stream, **kwargs):
+        self.circuit_breaker.before_request()
+        try:
+            await self._acquire_slot()
+        except BaseException as e:
+            self._record_outcome(error=e)
+            raise
+        self._begin_request()
+        try:
+            response = await self.session.request(method, url, stream=stream, **kwargs)
+        except BaseException as e:
+            UPSTREAM_REQUEST_ERRORS.inc()
+            self._end_request(failed=True)
+            self._record_outcome(error=e)
+            raise
+        UPSTREAM_RESPONSES.inc(status=str(response.status_code))
+        self._record_outcome(response)
+        if not stream:
+            self._end_request(failed=response.status_code >= 400)
+        return response
+
+    async def _close_stream(self, response, abort=False):
+        # curl_cffi 0.6 keeps the transfer task in stream_task, later versions in astream_task
+        task = getattr(response, "astream_task", None) or getattr(response, "stream_task", None)
+        try:
+            if abort and task and not task.done():
+                # Removing the handle cancels the transfer at once; the handle
+                # itself goes back to the session when the stream task ends
+                self.session.acurl.remove_handle(response.curl)
+            else:
+                await response.aclose()
+        finally:
+            self._end_request(failed=response.status_code >= 400)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="get_organization_id")
+    async def get_organization_id(self):
+        url = f"{self.base_url}/api/organizations"
+        headers = self._build_headers()
+
+        try:
+            logger.info("Human-like behavior: Fetching organization ID")
+            await self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+            response = await self._request("GET", url, operation="get_organization_id", headers=headers)
+            res = json.loads(response.text)
+            logger.debug("API response for organizations: %s", truncate(res))
+            uuid = self.organization_id  # Using the hardcoded value
+            logger.debug("Returning organization UUID: %s", uuid)
+            logger.info("Human-like behavior: Retrieved organization ID")
+            return uuid
+        except Exception as e:
+            logger.error("Error in get_organization_id: %s", e)
+            return None
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="list_all_conversations")
+    async def list_all_conversations(self, max_age=None):
+        if self.history_store is not None:
+            if not await self._in_store(self.history_store.is_fresh, self.history_max_age if max_age is None else max_age):
+                conversations = await self.list_conversations()
+                if conversations is None:
+                    return None
+                await self._in_store(self.history_store.save_listing, conversations)
+            return await self._in_store(self.history_store.conversations)
+        url = self._conversations_url()
+        headers = self._build_headers()
+
+        logger.info("Human-like behavior: Listing conversations")
+        await self._human_pause(random.uniform(1, 2))  # Simulate human delay
+        response = await self._request("GET", url, operation="list_all_conversations", headers=headers)
+        conversations = response.json()
+
+        if response.status_code == 200:
+            logger.info("Human-like behavior: Retrieved %s conversations", len(conversations))
+            return conversations
         else:
-            logger.error(f"Invalid model: {model}. Available models are: {', '.join(available_models)}")
-            raise ValueError(f"Invalid model: {model}")
+            logger.error("Error: %s - %s", response.status_code, truncate(response.content))
+            return None
 
-    def get_current_model(self):
-        return self.model
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="send_message")
+    async def send_message(self, prompt, conversation_id, attachment=None, timeout=500, max_retries=3, model=None, attachments=None):
+        completions = []
+        async for completion in self.stream_message(prompt, conversation_id, attachment, timeout, max_retries, model, attachments):
+            completions.append(completion)
 
-# End of Client class
+        answer = ''.join(completions)
+        if completions and isinstance(completions[-1], UpstreamError):
+            # A stream that failed partway: the deltas so far are not an answer
+            return UpstreamError(answer)
+
+        # Simulate human reading time
+        reading_time = len(answer) * 0.005  # 10ms per character
+        logger.info("Human-like behavior: Reading response (simulated delay: %.2f seconds)", reading_time)
+        await self._human_pause(reading_time)
+
+        logger.debug("Final answer: %s", truncate(answer))
+        return answer
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="stream_message")
+    async def stream_message(self, prompt, conversation_id, attachment=None, timeout=500, max_retries=3, model=None, attachments=None):
+        logger.info("Human-like behavior: Composing message for conversation %s", conversation_id)
+
+        typing_delay = len(prompt) * 0.00005
+        logger.info("Human-like behavior: Typing message (simulated delay: %.2f seconds)", typing_delay)
+        await self._human_pause(typing_delay)
+
+        attachments = await self.prepare_attachments(self._attachment_items(attachment, attachments))
+        if attachments is None:
+            yield UpstreamError("Error: Failed to upload attachments")
+            return
+
+        url, headers, payload = self._build_completion_request(prompt, conversation_id, model, attachments)
+        logger.debug("Request payload: %s", truncate(payload))
+
+        try:
+            logger.info("Human-like behavior: Streaming message")
+            response = await self._request("POST", url, operation="stream_message", max_attempts=max_retries,
+                                     headers=headers, data=payload, timeout=timeout, stream=True)
+        except requests.RequestsError as e:
+            logger.error("Request failed: %s", e)
+            yield UpstreamError(f"Error: Request failed - {str(e)}")
+            return
+
+        finished = False
+        try:
+            logger.info("Received response with status code: %s", response.status_code)
+            if response.status_code != 200:
+                logger.error("Received non-200 status code: %s", response.status_code)
+                yield UpstreamError(f"Error: Received status code {response.status_code}")
+                return
+
+            parser = CompletionParser()
+            length = 0
+            async for chunk in response.aiter_content():
+                for completion in parser.feed(chunk):
+                    length += len(completion)
+                    yield completion
+            finished = True
+            for completion in parser.flush():
+                length += len(completion)
+                yield completion
+            if parser.error:
+                yield UpstreamError(f"Error: {parser.error}")
+            logger.info("Human-like behavior: Received streamed answer (length: %s, stop reason: %s)", length, parser.stop_reason)
+            return
+        except requests.RequestsError as e:
+            logger.error("Stream interrupted: %s", e)
+            yield UpstreamError(f"Error: Stream interrupted - {str(e)}")
+            return
+        finally:
+            # Abandoned early (e.g. the caller was cancelled): drop the transfer
+            # rather than reading the rest of the answer
+            await self._close_stream(response, abort=not finished)
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="delete_conversation")
+    async def delete_conversation(self, conversation_id):
+        url = self._conversations_url(conversation_id)
+
+        payload = json.dumps(f"{conversation_id}")
+        headers = self._build_headers()
+
+        logger.info("Human-like behavior: Deleting conversation %s", conversation_id)
+        await self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+        response = await self._request("DELETE", url, operation="delete_conversation", headers=headers, data=payload)
+
+        if response.status_code == 204:
+            logger.info("Human-like behavior: Successfully deleted conversation %s", conversation_id)
+        else:
+            logger.error("Failed to delete conversation %s", conversation_id)
+
+        return response.status_code == 204
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="chat_conversation_history")
+    async def chat_conversation_history(self, conversation_id, max_age=None):
+        if self.history_store is not None:
+            history = await self._in_store(self.history_store.history, conversation_id, self.history_max_age if max_age is None else max_age)
+            if history is not None:
+                return history
+        response = await self._fetch_history(conversation_id)
+        if self.history_store is not None:
+            await self._in_store(self._store_history, conversation_id, response)
+        return response.json()
+
+    async def _in_store(self, func, *args):
+        # History store calls are SQLite (and FTS index) work; keep them off
+        # the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+    async def _fetch_history(self, conversation_id):
+        url = self._conversations_url(conversation_id)
+        headers = self._build_headers()
+
+        logger.info("Human-like behavior: Fetching conversation history for %s", conversation_id)
+        await self._human_pause(random.uniform(0.8, 1.8))  # Simulate human delay
+        response = await self._request("GET", url, operation="chat_conversation_history", headers=headers)
+        logger.info("Human-like behavior: Retrieved conversation history")
+        return response
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="sync_history")
+    async def sync_history(self, concurrency=4, rate=None):
+        conversations = await self.list_conversations()
+        if conversations is None:
+            return None
+        stale = await self._in_store(self.history_store.save_listing, conversations)
+        limiter = RateLimiter(rate)
+        slots = asyncio.Semaphore(max(1, concurrency))
+
+        async def fetch(conversation_id):
+            async with slots:
+                await limiter.wait_async()
+                try:
+                    return await self._in_store(self._store_history, conversation_id, await self._fetch_history(conversation_id))
+                except Exception as e:
+                    logger.error("Failed to fetch conversation %s: %s", conversation_id, e)
+                    return False
+
+        fetched = sum(await asyncio.gather(*(fetch(conversation_id) for conversation_id in stale)))
+        if fetched == len(stale):
+            await self._in_store(self.history_store.mark_synced)
+        logger.info("History synced: fetched %s of %s changed conversations", fetched, len(stale))
+        return fetched
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="create_new_chat")
+    async def create_new_chat(self, model=None, name=None):
+        url, headers, payload = self._build_create_chat_request(model, name)
+
+        try:
+            logger.info("Human-like behavior: Creating new chat")
+            await self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+            response = await self._request("POST", url, operation="create_new_chat", headers=headers, data=payload)
+            logger.debug("Create new chat response status: %s", response.status_code)
+            logger.debug("Create new chat response content: %s", truncate(response.content))
+            logger.info("Human-like behavior: New chat created successfully")
+            return response.json()
+        except Exception as e:
+            logger.error("Error in create_new_chat: %s", e)
+            return None
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="list_conversations")
+    async def list_conversations(self, page_size=100, name=None, older_than=None, idle_for=None):
+        url = self._conversations_url()
+        headers = self._build_headers()
+        filters = {"name": name, "older_than": older_than, "idle_for": idle_for}
+        now = time.time()
+        conversations, seen, offset = [], set(), 0
+
+        logger.info("Human-like behavior: Listing conversations")
+        while True:
+            response = await self._request("GET", url, operation="list_conversations", headers=headers, params={"limit": page_size, "offset": offset})
+            if response.status_code != 200:
+                logger.error("Error: %s - %s", response.status_code, truncate(response.content))
+                return None
+            page = response.json()
+            matches, new = self._filter_page(page, seen, filters, now)
+            conversations.extend(matches)
+            if len(page) < page_size or not new:
+                logger.info("Human-like behavior: Retrieved %s matching conversations", len(conversations))
+                return conversations
+            offset += len(page)
+            await self._human_pause(random.uniform(0.3, 0.7))  # Simulate human delay between pages
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="delete_conversations")
+    async def delete_conversations(self, conversation_ids, concurrency=4, rate=None):
+        limiter = RateLimiter(rate)
+        slots = asyncio.Semaphore(max(1, concurrency))
+
+        async def delete(conversation_id):
+            async with slots:
+                await limiter.wait_async()
+                try:
+                    return await self.delete_conversation(conversation_id)
+                except Exception as e:
+                    logger.error("Failed to delete conversation %s: %s", conversation_id, e)
+                    return False
+
+        conversation_ids = list(conversation_ids)
+        results = dict(zip(conversation_ids, await asyncio.gather(*(delete(conversation_id) for conversation_id in conversation_ids))))
+        logger.info("Deleted %s of %s conversations", sum(results.values()), len(results))
+        return results
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="reset_all")
+    async def reset_all(self, concurrency=4, rate=None):
+        conversations = await self.list_conversations()
+        if conversations:
+            logger.info("Human-like behavior: Resetting all conversations")
+            await self.delete_conversations([conversation['uuid'] for conversation in conversations], concurrency, rate)
+            logger.info("Human-like behavior: All conversations reset")
+            return True
+        logger.info("Human-like behavior: No conversations to reset")
+        return False
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="upload_attachment")
+    async def upload_attachment(self, file_path):
+        logger.info("Human-like behavior: Preparing to upload attachment %s", file_path)
+        if file_path.endswith('.txt'):
+            return await asyncio.get_running_loop().run_in_executor(None, self._read_text_attachment, file_path)
+
+        loop = asyncio.get_running_loop()
+        # Hashing and the cache lookup touch the disk, so run them off the loop
+        digest, cached = await loop.run_in_executor(None, self._cached_upload, file_path)
+        if cached is not None:
+            return cached
+
+        url = f"{self.base_url}/api/convert_document"
+        headers = self._build_headers(content_type=None)
+        file_name = os.path.basename(file_path)
+        multipart = self._build_upload_multipart(file_path)
+
+        logger.info("Human-like behavior: Uploading file %s", file_name)
+        await self._human_pause(random.uniform(1, 3))  # Simulate human delay for file upload
+        try:
+            response = await self._request("POST", url, operation="upload_attachment", headers=headers, multipart=multipart)
+        finally:
+            multipart.close()
+        if response.status_code == 200:
+            logger.info("Human-like behavior: Successfully uploaded file %s", file_name)
+            result = response.json()
+            if digest:
+                await loop.run_in_executor(None, self.upload_cache.put, digest, result)
+            return result
+        else:
+            logger.error("Failed to upload file %s", file_name)
+            return False
+
+    async def prepare_attachments(self, items):
+        paths = [item for item in items if not isinstance(item, dict)]
+        if not paths:
+            return list(items)
+        results = await asyncio.gather(*(self.upload_attachment(path) for path in paths), return_exceptions=True)
+        uploaded = {path: (None if isinstance(result, Exception) else result) for path, result in zip(paths, results)}
+        if not all(uploaded.values()):
+            logger.error("Failed to upload %s of %s attachments", sum(not result for result in uploaded.values()), len(paths))
+            return None
+        return [item if isinstance(item, dict) else uploaded[item] for item in items]
+
+    @timed(CLIENT_CALL_DURATION, CLIENT_CALLS_IN_FLIGHT, method="rename_chat")
+    async def rename_chat(self, title, conversation_id):
+        url, headers, payload = self._build_rename_chat_request(title, conversation_id)
+
+        logger.info("Human-like behavior: Renaming conversation %s to '%s'", conversation_id, title)
+        await self._human_pause(random.uniform(0.5, 1.5))  # Simulate human delay
+        response = await self._request("POST", url, operation="rename_chat", headers=headers, data=payload)
+
+        if response.status_code == 200:
+            logger.info("Human-like behavior: Successfully renamed conversation to '%s'", title)
+        else:
+            logger.error("Failed to rename conversation %s", conversation_id)
+
+        return response.status_code == 200
+
+# End of AsyncClient class
 
 # You might want to add some utility functions or additional classes here if needed
@@ -0,0 +1,120 @@
+import re
+
+# Markdown code fence normalization for answers: every fenced block is put on
+# lines of its own and followed by a blank line. The substitutions are done by
+# a small scanner instead of regular expressions so they can be applied to a
+# streamed answer chunk by chunk.
+
+_WORD_RUN = re.compile(r'\w*')
+_CLOSING_FENCE = "\n```"
+
+class _FencePass:
+    # Incremental form of one of the substitutions in process_code_blocks:
+    # opener, then a (possibly empty) word-character language and a newline,
+    # then the code up to the first closing fence, optionally followed by one
+    # newline that is consumed. render(language, code, block) replaces each match, block
+    # being the matched text without that newline. Matches are found in the
+    # same leftmost, non-overlapping order as re.sub.
+
+    def __init__(self, opener, render, eat_newline=False):
+        self.opener = opener
+        self.render = render
+        self.eat_newline = eat_newline
+        self._pending = ""
+        self._held = []  # Chunks after _pending, while a fence is open
+        self._tail = ""  # Last characters held, where a closing fence may begin
+        self._language_end = None  # Set while a fence is open at the start of _pending
+        self._search_from = 0  # Where to resume looking for the closing fence
+
+    def feed(self, text, final=False):
+        if self._language_end is not None and not final:
+            # Inside a code block only the new text can complete the closing
+            # fence; hold it without copying the block again
+            probe = self._tail + text
+            if _CLOSING_FENCE not in probe:
+                self._held.append(text)
+                self._tail = probe[-len(_CLOSING_FENCE):]
+                return ""
+        buffer = self._pending + "".join(self._held) + text
+        self._held = []
+        out = []
+        pos = 0
+        language_end, search_from = self._language_end, self._search_from
+        while True:
+            if language_end is None:
+                start = buffer.find(self.opener, pos)
+                if start == -1:
+                    # Hold back a tail that could be the start of an opener
+                    end = len(buffer) if final else max(pos, len(buffer) - len(self.opener) + 1)
+                    out.append(buffer[pos:end])
+                    pos = end
+                    break
+                out.append(buffer[pos:start])
+                pos = start
+                language_end = _WORD_RUN.match(buffer, start + len(self.opener)).end()
+                if language_end < len(buffer) and buffer[language_end] == "\n":
+                    search_from = language_end + 1
+                    continue
+                if language_end == len(buffer) and not final:
+                    language_end = None  # The language may go on in the next chunk
+                    break
+                # Not a fence after all; like re.sub, retry one character on
+                language_end = None
+                out.append(buffer[pos])
+                pos += 1
+                continue
+
+            close = buffer.find(_CLOSING_FENCE, search_from)
+            if close == -1:
+                if final:
+                    # Never closed, and then no later fence can close either
+                    out.append(buffer[pos:])
+                    pos = len(buffer)
+                    language_end = None
+                    break
+                search_from = max(search_from, len(buffer) - len(_CLOSING_FENCE) + 1)
+                break
+            end = close + len(_CLOSING_FENCE)
+            if self.eat_newline:
+                if end == len(buffer) and not final:
+                    search_from = close  # Wait to see whether a newline follows
+                    break
+                consumed = end + 1 if end < len(buffer) and buffer[end] == "\n" else end
+            else:
+                consumed = end
+            out.append(self.render(buffer[pos + len(self.opener):language_end], buffer[language_end + 1:close], buffer[pos:end]))
+            pos = consumed
+            language_end = None
+
+        self._pending = buffer[pos:]
+        self._tail = self._pending[-len(_CLOSING_FENCE):]
+        self._language_end = None if language_end is None else language_end - pos
+        self._search_from = search_from - pos if language_end is not None else 0
+        return "".join(out)
+
+
+class CodeBlockNormalizer:
+    # process_code_blocks for an answer that arrives in chunks: feed() each
+    # chunk and finish() at the end; the concatenated output equals
+    # process_code_blocks(answer). Text outside code blocks is passed on
+    # (almost) at once, a code block once its closing fence has arrived.
+
+    def __init__(self):
+        self._blocks = _FencePass("```", lambda language, code, block: f"\n```{language}\n{code}\n```\n")
+        self._spacing = _FencePass(_CLOSING_FENCE, lambda language, code, block: block + "\n\n", eat_newline=True)
+
+    def feed(self, chunk):
+        return self._spacing.feed(self._blocks.feed(chunk))
+
+    def finish(self):
+        return self._spacing.feed(self._blocks.feed("", final=True), final=True)
+
+
+def process_code_blocks(text):
+    # Same result as the two substitutions
+    #   re.sub(r'```(\w*)\n(.*?)\n```', r'\n```\1\n\2\n```\n', text, flags=re.DOTALL)
+    #   re.sub(r'(\n```[\w]*\n.*?\n```)\n?', r'\1\n\n', text, flags=re.DOTALL)
+    # in a single scan with str.find, several times faster than the lazy
+    # DOTALL patterns on long answers
+    normalizer = CodeBlockNormalizer()
+    return normalizer.feed(text) + normalizer.finish()
@@ -1,54 +1,203 @@
+import argparse
+import asyncio
+import json
 import os
 import logging
-from claude_api import Client
-import os
+import signal
+import sys
+import time
+from claude_api import AsyncClient, UpstreamError
+from log_config import configure_logging, truncate
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 logger = logging.getLogger(__name__)
 
 def get_cookie():
     cookie = os.getenv('COOKIE')
     if not cookie:
         raise ValueError("Please set the 'cookie' variable.")
-    logger.debug(f"Cookie retrieved: {cookie[:20]}...") # Log first 20 chars of cookie
+    logger.debug("Cookie retrieved (%s chars)", len(cookie))
     return cookie
 
-def main():
+def run_interruptible(loop, coro):
+    # Runs coro on loop. Ctrl-C cancels it and raises KeyboardInterrupt here,
+    # so the caller decides whether that ends the program.
+    task = loop.create_task(coro)
+    interrupted = False
+
+    def on_interrupt(signum, frame):
+        nonlocal interrupted
+        interrupted = True
+        loop.call_soon_threadsafe(task.cancel)
+
+    previous = signal.signal(signal.SIGINT, on_interrupt)
     try:
-        cookie = get_cookie()
-        logger.info("Initializing Claude client")
-        claude = Client(cookie)
-        logger.debug(f"Claude client initialized with organization ID: {claude.organization_id}")
-        conversation_id = None
+        return loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        if interrupted:
+            raise KeyboardInterrupt from None
+        raise
+    finally:
+        signal.signal(signal.SIGINT, previous)
 
-        print("Welcome to Claude AI Chat!")
+async def create_conversation(claude, model=None):
+    logger.info("Creating new chat conversation")
+    conversation = await claude.create_new_chat(model)
+    logger.debug("Create new chat response: %s", truncate(conversation))
+    conversation_id = conversation.get('uuid') if conversation else None
+    if not conversation_id:
+        logger.error("Failed to get conversation UUID. Full response: %s", truncate(conversation))
+        raise ValueError("Unable to create new conversation")
+    return conversation_id
 
+async def print_reply(claude, prompt, conversation_id, model=None):
+    # Prints the answer as it streams in
+    logger.info("Sending message to conversation %s", conversation_id)
+    print("Chatbot: ", end="", flush=True)
+    length = 0
+    try:
+        async for delta in claude.stream_message(prompt, conversation_id, model=model):
+            length += len(delta)
+            print(delta, end="", flush=True)
+    finally:
+        print()
+    logger.debug("Received response (length: %s)", length)
+
+def chat(cookie, model=None):
+    loop = asyncio.new_event_loop()
+    logger.info("Initializing Claude client")
+    claude = AsyncClient(cookie)
+    logger.debug("Claude client initialized with organization ID: %s", claude.organization_id)
+    conversation_id = None
+
+    print("Welcome to Claude AI Chat! Press Ctrl-C to stop an answer, type 'exit' to quit.")
+    try:
         while True:
-            user_input = input("You: ")
+            try:
+                user_input = input("You: ")
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
 
             if user_input.lower() == 'exit':
-                print("Thank you!")
                 break
+            if not user_input.strip():
+                continue
 
-            if not conversation_id:
-                logger.info("Creating new chat conversation")
-                conversation = claude.create_new_chat()
-                logger.debug(f"Create new chat response: {conversation}")
-                conversation_id = conversation.get('uuid') if conversation else None
+            try:
                 if not conversation_id:
-                    logger.error(f"Failed to get conversation UUID. Full response: {conversation}")
-                    raise ValueError("Unable to create new conversation")
+                    conversation_id = run_interruptible(loop, create_conversation(claude, model))
+                run_interruptible(loop, print_reply(claude, user_input, conversation_id, model))
+            except KeyboardInterrupt:
+                # Only the current answer is stopped; the conversation goes on
+                print("[cancelled]")
+        print("Thank you!")
+    finally:
+        loop.run_until_complete(claude.close())
+        loop.close()
 
-            logger.info(f"Sending message to conversation {conversation_id}")
-            response = claude.send_message(user_input, conversation_id)
-            logger.debug(f"Received response: {response[:100]}...") # Log first 100 chars of response
-            print("Chatbot:", response)
+def read_prompts(source):
+    # One prompt per line. A line holding a JSON object with a "prompt" key
+    # (and optionally an "id" copied to its result) is read as such.
+    lines = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    try:
+        items = []
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            item = {"prompt": line}
+            if line.lstrip().startswith('{'):
+                try:
+                    parsed = json.loads(line)
+                except ValueError:
+                    parsed = None
+                if isinstance(parsed, dict) and "prompt" in parsed:
+                    item = parsed
+            items.append(item)
+        return items
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+async def run_batch(claude, items, output, concurrency=4, model=None, keep_conversations=False):
+    # Answers every prompt in a conversation of its own, at most concurrency
+    # at a time, writing one JSON line per prompt as soon as it is done
+    # (so not necessarily in input order; "index" is the input position).
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(index, item):
+        async with semaphore:
+            start = time.perf_counter()
+            result = {"index": index}
+            if "id" in item:
+                result["id"] = item["id"]
+            result["prompt"] = item["prompt"]
+            conversation_id = None
+            try:
+                conversation_id = await create_conversation(claude, model)
+                deltas = [delta async for delta in claude.stream_message(item["prompt"], conversation_id, model=model)]
+                if deltas and isinstance(deltas[-1], UpstreamError):
+                    result["error"] = deltas[-1]
+                else:
+                    result["response"] = "".join(deltas)
+            except Exception as e:
+                logger.error("Prompt %s failed: %s", index, e)
+                result["error"] = str(e)
+            finally:
+                if conversation_id and not keep_conversations:
+                    try:
+                        await claude.delete_conversation(conversation_id)
+                    except Exception as e:
+                        logger.warning("Failed to delete conversation %s: %s", conversation_id, e)
+            if keep_conversations:
+                result["conversation_id"] = conversation_id
+            result["duration"] = round(time.perf_counter() - start, 3)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            return "error" not in result
+
+    succeeded = await asyncio.gather(*(answer(index, item) for index, item in enumerate(items)))
+    return sum(succeeded)
+
+def batch(cookie, source, output_path='-', concurrency=4, model=None, keep_conversations=False):
+    items = read_prompts(source)
+    output = sys.stdout if output_path == '-' else open(output_path, 'w', encoding='utf-8')
+    loop = asyncio.new_event_loop()
+    claude = AsyncClient(cookie)
+    start = time.perf_counter()
+    try:
+        succeeded = run_interruptible(loop, run_batch(claude, items, output, concurrency, model, keep_conversations))
+        logger.info("Batch finished: %s of %s prompts answered in %.1f seconds", succeeded, len(items), time.perf_counter() - start)
+        return succeeded == len(items)
+    except KeyboardInterrupt:
+        logger.warning("Batch cancelled")
+        return False
+    finally:
+        loop.run_until_complete(claude.close())
+        loop.close()
+        if output is not sys.stdout:
+            output.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat with Claude in the terminal, or answer a batch of prompts")
+    parser.add_argument("--batch", metavar="FILE", help="answer the prompts in FILE ('-' for stdin), one per line, instead of chatting")
+    parser.add_argument("--output", metavar="FILE", default="-", help="where batch results are written as JSON lines (default stdout)")
+    parser.add_argument("--concurrency", type=int, default=4, help="prompts answered at once in batch mode")
+    parser.add_argument("--model", help="model to use instead of the client's default")
+    parser.add_argument("--keep-conversations", action="store_true", help="don't delete the conversations created in batch mode")
+    args = parser.parse_args()
 
+    try:
+        cookie = get_cookie()
+        if args.batch:
+            sys.exit(0 if batch(cookie, args.batch, args.output, args.concurrency, args.model, args.keep_conversations) else 1)
+        chat(cookie, args.model)
     except Exception as e:
-        logger.exception(f"An error occurred: {str(e)}")
+        logger.exception("An error occurred: %s", e)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from log_config import truncate
+
+logger = logging.getLogger(__name__)
+
+class ConversationPool:
+    # Keeps a number of freshly created conversations ready so a completion
+    # request doesn't have to wait for create_new_chat. Conversations older than
+    # ttl seconds are discarded (and deleted upstream) instead of being handed out.
+
+    def __init__(self, client, size, ttl=300, model=None, refill_batch=4, name=None):
+        self.client = client
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.model = model or client.model
+        self.refill_batch = refill_batch
+        self._ready = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._pending_deletes = set()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Conversation pool started (size: %s, ttl: %ss)", self.size, self.ttl)
+
+    async def stop(self, delete_remaining=True):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if delete_remaining:
+            while self._ready:
+                conversation_id, _ = self._ready.popleft()
+                self._schedule_delete(conversation_id)
+        if self._pending_deletes:
+            await asyncio.gather(*self._pending_deletes, return_exceptions=True)
+
+    def acquire(self, model=None):
+        # Returns a ready conversation id, or None if the pool is empty or was
+        # warmed for a different model; the caller then creates one itself.
+        if model and model != self.model:
+            return None
+        self._expire()
+        self._wakeup.set()
+        if self._ready:
+            conversation_id, _ = self._ready.popleft()
+            self.hits += 1
+            logger.debug("Conversation pool hit: %s (%s left)", conversation_id, len(self._ready))
+            return conversation_id
+        self.misses += 1
+        logger.debug("Conversation pool miss")
+        return None
+
+    def conversation_ids(self):
+        return {conversation_id for conversation_id, _ in self._ready}
+
+    def stats(self):
+        return {"ready": len(self._ready), "size": self.size, "hits": self.hits, "misses": self.misses}
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._ready and self._ready[0][1] < deadline:
+            conversation_id, _ = self._ready.popleft()
+            logger.debug("Conversation pool expired: %s", conversation_id)
+            self._schedule_delete(conversation_id)
+
+    def _schedule_delete(self, conversation_id):
+        task = asyncio.create_task(self.client.delete_conversation(conversation_id))
+        self._pending_deletes.add(task)
+        task.add_done_callback(self._pending_deletes.discard)
+
+    async def _create_one(self):
+        conversation = await self.client.create_new_chat(model=self.model, name=self.name)
+        conversation_id = conversation.get('uuid') if conversation else None
+        if not conversation_id:
+            logger.error("Conversation pool failed to create conversation: %s", truncate(conversation))
+            return False
+        self._ready.append((conversation_id, time.monotonic()))
+        return True
+
+    async def _run(self):
+        while True:
+            self._expire()
+            missing = self.size - len(self._ready)
+            if missing > 0:
+                results = await asyncio.gather(
+                    *(self._create_one() for _ in range(min(missing, self.refill_batch))),
+                    return_exceptions=True
+                )
+                if not any(result is True for result in results):
+                    # Upstream is failing; back off rather than spinning
+                    await asyncio.sleep(5)
+                continue
+
+            self._wakeup.clear()
+            try:
+                # Wake up on demand, or periodically to drop stale conversations
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(self.ttl / 2, 1))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,326 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from onnx_embeddings import onnx_loader
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    # Bounded LRU of embedding vectors keyed by a hash of the input text. The
+    # vectors live in one preallocated float32 matrix (one row per slot), which
+    # is a memory-mapped .npy file when a path is given so the cache survives
+    # restarts. The key -> slot index is saved next to it by flush().
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self._slots = OrderedDict()
+        self._free = []
+        self._next_slot = 0
+        self._vectors = None
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        self._slots.move_to_end(key)
+        # Copy, as the slot may be reused before the caller is done with it
+        return self._vectors[slot].copy()
+
+    def put(self, key, vector):
+        if self._vectors is None:
+            self._allocate(vector.shape[0])
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            elif self._next_slot < self.capacity:
+                slot = self._next_slot
+                self._next_slot += 1
+            else:
+                _, slot = self._slots.popitem(last=False)
+            self._slots[key] = slot
+        self._slots.move_to_end(key)
+        self._vectors[slot] = vector
+
+    def flush(self):
+        if not self.path or self._vectors is None:
+            return
+        self._vectors.flush()
+        with open(f"{self.path}.index.json", 'w') as index_file:
+            json.dump(list(self._slots.items()), index_file)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _allocate(self, dim):
+        if self.path:
+            self._vectors = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32, shape=(self.capacity, dim))
+        else:
+            self._vectors = np.empty((self.capacity, dim), dtype=np.float32)
+
+    def _load(self):
+        try:
+            vectors = np.load(self.path, mmap_mode='r+')
+            with open(f"{self.path}.index.json") as index_file:
+                slots = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable embedding cache at %s: %s", self.path, e)
+            return
+        if vectors.shape[0] != self.capacity or vectors.dtype != np.float32:
+            logger.warning("Embedding cache at %s has a different shape, starting empty", self.path)
+            return
+        self._vectors = vectors
+        self._slots = OrderedDict((key, slot) for key, slot in slots)
+        used = set(self._slots.values())
+        self._next_slot = max(used) + 1 if used else 0
+        self._free = [slot for slot in range(self._next_slot) if slot not in used]
+        logger.info("Loaded %s cached embeddings from %s", len(self._slots), self.path)
+
+
+def sentence_transformer_loader(model_name, threads=None):
+    # sentence_transformers (and torch) are only imported when the model is
+    # first needed, so servers that never embed anything don't pay for them.
+    # threads sets torch's intra-op thread count, which is process wide.
+    def load():
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+    return load
+
+
+# Embedding backends by name: factory(source, threads, directory) -> model
+# loader for EmbeddingService. source names the SentenceTransformer model;
+# directory is where converted models are kept.
+BACKENDS = {
+    "sentence-transformers": lambda source, threads, directory: sentence_transformer_loader(source, threads),
+    "onnx": lambda source, threads, directory: onnx_loader(source, directory, quantized=False, threads=threads),
+    "onnx-int8": lambda source, threads, directory: onnx_loader(source, directory, quantized=True, threads=threads),
+}
+
+def parse_embedding_models(spec):
+    # "name=backend[:source],..." -> [(name, backend, source)]; source
+    # defaults to name
+    models = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        name, separator, target = entry.partition('=')
+        backend, _, source = target.partition(':')
+        name, backend, source = name.strip(), backend.strip(), source.strip() or name.strip()
+        if not separator or not name or backend not in BACKENDS:
+            raise ValueError(f"Invalid embedding model {entry!r}, expected name=backend[:source] with backend one of {', '.join(BACKENDS)}")
+        models.append((name, backend, source))
+    return models
+
+
+class EmbeddingRegistry:
+    # EmbeddingServices by the model name clients send in their requests.
+    # Names that aren't registered get the default model, so clients asking
+    # for e.g. "text-embedding-ada-002" keep working.
+
+    def __init__(self, default):
+        self.default = default
+        self._services = {}
+
+    def add(self, name, service):
+        self._services[name] = service
+
+    def get(self, name):
+        return self._services.get(name) or self._services[self.default]
+
+    def names(self):
+        return list(self._services)
+
+    def stats(self):
+        return {name: service.stats() for name, service in self._services.items()}
+
+    async def load(self):
+        await asyncio.gather(*(service.load() for service in self._services.values()))
+
+    async def close(self):
+        for service in self._services.values():
+            await service.close()
+
+
+class EmbeddingService:
+    # Runs model.encode off the event loop. Concurrent embed() calls are
+    # micro-batched: requests arriving within max_wait seconds of each other
+    # (up to max_batch_size texts) are merged, deduplicated against each other
+    # and the cache, and encoded with a single encode() call on a worker thread.
+    # Texts already being encoded for another request are not queued again;
+    # the request waits for that result instead.
+    # The model is created by model_loader on first use (or by load()).
+
+    def __init__(self, model_loader, max_batch_size=64, max_wait=0.005, cache_size=10000, cache_path=None, workers=1):
+        self._model_loader = model_loader
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = EmbeddingCache(cache_size, cache_path) if cache_size > 0 else None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+        self._workers = workers
+        self._queue = None
+        self._slots = None
+        self._task = None
+        self._batches = set()
+        self._in_flight = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    logger.info("Loading embedding model")
+                    self._model = self._model_loader()
+                    logger.info("Embedding model loaded")
+        return self._model
+
+    async def load(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, lambda: self.model)
+
+    async def embed(self, texts):
+        # Returns a (len(texts), dim) float32 array
+        if not texts:
+            raise ValueError("At least one input text is required")
+        self._ensure_started()
+        keys = [EmbeddingCache.key(text) for text in texts]
+        vectors = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            vector = self.cache.get(key) if self.cache is not None else None
+            if vector is not None:
+                vectors[key] = vector
+            else:
+                missing[key] = text
+        self.cache_hits += len(texts) - len(missing)
+        self.cache_misses += len(missing)
+
+        if missing:
+            # key -> future of a batch result containing it
+            waiting = {key: self._in_flight[key] for key in missing if key in self._in_flight}
+            submit = {key: text for key, text in missing.items() if key not in waiting}
+            self.coalesced += len(waiting)
+            if submit:
+                future = asyncio.get_running_loop().create_future()
+                for key in submit:
+                    self._in_flight[key] = future
+                future.add_done_callback(lambda _: self._forget(submit, future))
+                await self._queue.put((submit, future))
+                waiting.update(dict.fromkeys(submit, future))
+            for future in set(waiting.values()):
+                # Shielded: cancelling this request must not fail the others
+                results = await asyncio.shield(future)
+                vectors.update((key, results[key]) for key, waited in waiting.items() if waited is future)
+
+        return np.stack([vectors[key] for key in keys])
+
+    def _forget(self, keys, future):
+        for key in keys:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def stats(self):
+        return {
+            "cache_entries": len(self.cache) if self.cache is not None else 0,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "coalesced": self.coalesced,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "model_loaded": self._model is not None,
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.flush()
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self._workers)
+            self._task = asyncio.create_task(self._run())
+
+    def _encode(self, texts):
+        return np.asarray(self.model.encode(texts, batch_size=self.max_batch_size), dtype=np.float32)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            await self._slots.acquire()
+            task = asyncio.create_task(self._encode_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _encode_batch(self, batch):
+        try:
+            unique = {}
+            for missing, _ in batch:
+                unique.update(missing)
+            keys = list(unique)
+            logger.debug("Encoding batch of %s texts from %s requests", len(keys), len(batch))
+            try:
+                encoded = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, [unique[key] for key in keys])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            results = dict(zip(keys, encoded))
+            if self.cache is not None:
+                for key, vector in results.items():
+                    self.cache.put(key, vector)
+            for missing, future in batch:
+                if not future.done():
+                    future.set_result({key: results[key] for key in missing})
+        finally:
+            self._slots.release()
+
+
+def encode_embedding(vector, encoding_format="float"):
+    # "base64" packs the raw little-endian float32 bytes, as the OpenAI API does,
+    # which is far smaller than a JSON list of floats
+    if encoding_format == "base64":
+        return base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+    return vector.tolist()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def message_text(message):
+    # Plain text of an upstream chat message, which carries either "text" or
+    # a list of content blocks
+    if message.get('text'):
+        return message['text']
+    return "\n".join(block.get('text', '') for block in message.get('content') or [] if isinstance(block, dict))
+
+
+class HistoryStore:
+    # Local SQLite mirror of the account's conversations and their messages.
+    # Client.sync_history keeps it up to date incrementally: the conversation
+    # list is fetched every time, but a conversation's messages only when its
+    # updated_at differs from the one stored with them. Listing alone
+    # (Client.list_all_conversations) refreshes only the list; the messages
+    # of changed conversations are then fetched when they are read. Messages are indexed
+    # for full-text search (FTS5). Conversations and histories are returned as
+    # the upstream dicts they were stored from.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+            -- summary: the entry of the conversation list; detail: the
+            -- conversation without its messages, as of history_updated_at
+            CREATE TABLE IF NOT EXISTS conversations (
+                uuid TEXT PRIMARY KEY, name TEXT, updated_at TEXT, summary TEXT NOT NULL,
+                detail TEXT, history_updated_at TEXT, fetched_at REAL);
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_uuid TEXT NOT NULL, position INTEGER NOT NULL, uuid TEXT, sender TEXT, created_at TEXT,
+                text TEXT, data TEXT NOT NULL, PRIMARY KEY (conversation_uuid, position));
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='rowid');
+            CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+            END;
+        """)
+        self._db.commit()
+
+    def save_listing(self, conversations):
+        # Stores the full conversation list, forgets conversations no longer
+        # in it, and returns the ids whose messages need fetching
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO conversations (uuid, name, updated_at, summary) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (uuid) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at, summary = excluded.summary",
+                [(conversation['uuid'], conversation.get('name'), conversation.get('updated_at'), json.dumps(conversation))
+                 for conversation in conversations])
+            self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('last_listing', ?)", (str(time.time()),))
+            listed = {conversation['uuid'] for conversation in conversations}
+            removed = [uuid for (uuid,) in self._db.execute("SELECT uuid FROM conversations") if uuid not in listed]
+            self._delete(removed)
+            stale = [uuid for (uuid,) in self._db.execute(
+                "SELECT uuid FROM conversations WHERE history_updated_at IS NOT updated_at OR detail IS NULL")]
+        if removed:
+            logger.debug("History store dropped %s conversations deleted upstream", len(removed))
+        return stale
+
+    def save_history(self, history):
+        # Replaces a conversation's messages with those of history, the
+        # upstream conversation dict including chat_messages
+        messages = history.get('chat_messages') or []
+        detail = {key: value for key, value in history.items() if key != 'chat_messages'}
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO conversations (uuid, name, updated_at, summary, detail, history_updated_at, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (uuid) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at, detail = excluded.detail, "
+                "history_updated_at = excluded.history_updated_at, fetched_at = excluded.fetched_at",
+                (history['uuid'], history.get('name'), history.get('updated_at'), json.dumps(detail), json.dumps(detail),
+                 history.get('updated_at'), time.time()))
+            self._db.execute("DELETE FROM messages WHERE conversation_uuid = ?", (history['uuid'],))
+            self._db.executemany(
+                "INSERT INTO messages (conversation_uuid, position, uuid, sender, created_at, text, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(history['uuid'], position, message.get('uuid'), message.get('sender'), message.get('created_at'),
+                  message_text(message), json.dumps(message)) for position, message in enumerate(messages)])
+
+    def remove(self, conversation_id):
+        with self._lock, self._db:
+            self._delete([conversation_id])
+
+    def mark_synced(self):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('last_sync', ?)", (str(time.time()),))
+
+    def last_sync(self):
+        # Time of the last complete sync, or None
+        return self._info_time('last_sync')
+
+    def last_listing(self):
+        # Time the conversation list was last stored, or None
+        return self._info_time('last_listing')
+
+    def is_fresh(self, max_age):
+        # Whether the conversation list is at most max_age seconds old
+        last_listing = self.last_listing()
+        return last_listing is not None and time.time() - last_listing <= max_age
+
+    def conversations(self):
+        # The conversation list as of the last sync, most recently updated first
+        with self._lock:
+            rows = self._db.execute("SELECT summary FROM conversations ORDER BY updated_at DESC").fetchall()
+        return [json.loads(summary) for (summary,) in rows]
+
+    def history(self, conversation_id, max_age=None):
+        # The stored conversation with its chat_messages, or None if it isn't
+        # stored or (with max_age) may be outdated: it is current if it was
+        # fetched within max_age seconds, or if a listing within max_age found
+        # it unchanged
+        with self._lock:
+            row = self._db.execute("SELECT detail, history_updated_at, updated_at, fetched_at FROM conversations WHERE uuid = ?",
+                                   (conversation_id,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            detail, history_updated_at, updated_at, fetched_at = row
+            if max_age is not None and time.time() - fetched_at > max_age:
+                last_listing = self._db.execute("SELECT value FROM info WHERE key = 'last_listing'").fetchone()
+                if history_updated_at != updated_at or last_listing is None or time.time() - float(last_listing[0]) > max_age:
+                    return None
+            messages = self._db.execute("SELECT data FROM messages WHERE conversation_uuid = ? ORDER BY position",
+                                        (conversation_id,)).fetchall()
+        history = json.loads(detail)
+        history['chat_messages'] = [json.loads(data) for (data,) in messages]
+        return history
+
+    def search(self, query, limit=20, conversation_id=None):
+        # Messages matching an FTS5 query (words, "phrases", AND/OR/NOT,
+        # prefix*), best match first
+        sql = ("SELECT m.conversation_uuid, c.name, m.uuid, m.sender, m.created_at, "
+               "snippet(messages_fts, 0, '[', ']', '...', 16), bm25(messages_fts) "
+               "FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid JOIN conversations c ON c.uuid = m.conversation_uuid "
+               "WHERE messages_fts MATCH ?")
+        parameters = [query]
+        if conversation_id:
+            sql += " AND m.conversation_uuid = ?"
+            parameters.append(conversation_id)
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        parameters.append(limit)
+        try:
+            with self._lock:
+                rows = self._db.execute(sql, parameters).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Invalid search query {query!r}: {e}") from e
+        return [{"conversation_id": conversation_id, "conversation_name": name, "message_id": message_id, "sender": sender,
+                 "created_at": created_at, "snippet": snippet, "score": -score}
+                for conversation_id, name, message_id, sender, created_at, snippet, score in rows]
+
+    def stats(self):
+        with self._lock:
+            conversations = self._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+            messages = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return {"conversations": conversations, "messages": messages, "last_sync": self.last_sync(), "last_listing": self.last_listing()}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _info_time(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return float(row[0]) if row else None
+
+    def _delete(self, conversation_ids):
+        self._db.executemany("DELETE FROM messages WHERE conversation_uuid = ?", [(uuid,) for uuid in conversation_ids])
+        self._db.executemany("DELETE FROM conversations WHERE uuid = ?", [(uuid,) for uuid in conversation_ids])
+
+
+def main():
+    # Command line access to the store: sync it, search it, print a conversation
+    from claude_api import Client
+    from log_config import configure_logging
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Mirror your Claude conversations locally and search them")
+    parser.add_argument("--db", default=os.getenv('HISTORY_DB_PATH', 'history.sqlite'), help="SQLite file of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync = commands.add_parser("sync", help="fetch conversations changed since the last sync")
+    sync.add_argument("--concurrency", type=int, default=4)
+    search = commands.add_parser("search", help="full-text search over the stored messages")
+    search.add_argument("query")
+    search.add_argument("--limit", type=int, default=20)
+    show = commands.add_parser("show", help="print a stored conversation")
+    show.add_argument("conversation_id")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.db)
+    try:
+        if args.command == "sync":
+            with Client(os.getenv('COOKIE'), history_store=store) as client:
+                fetched = client.sync_history(concurrency=args.concurrency)
+            print(f"{fetched} conversations fetched; {store.stats()}" if fetched is not None else "Sync failed")
+        elif args.command == "search":
+            for hit in store.search(args.query, limit=args.limit):
+                print(f"{hit['conversation_id']}  {hit['conversation_name'] or ''}  [{hit['sender']}] {hit['snippet']}")
+        else:
+            history = store.history(args.conversation_id)
+            if history is None:
+                raise SystemExit(f"Conversation {args.conversation_id} is not in the store")
+            for message in history['chat_messages']:
+                print(f"{message.get('sender')}: {message_text(message)}\n")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
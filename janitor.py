@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class ConversationJanitor:
+    # Periodically deletes the conversations this proxy created (recognised by
+    # their name) once they have been idle for max_age seconds. Conversations
+    # still in use, as reported by the coroutine in_use(), are left alone.
+    # Deletions run through client.delete_conversations with bounded
+    # concurrency and rate.
+
+    def __init__(self, client, name, interval=600, max_age=3600, concurrency=4, rate=2.0, in_use=None):
+        self.client = client
+        self.name = name
+        self.interval = interval
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self.rate = rate
+        self.in_use = in_use
+        self._task = None
+        self.runs = 0
+        self.deleted = 0
+        self.failed = 0
+        self.last_run = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Conversation janitor started (interval: %ss, max age: %ss)", self.interval, self.max_age)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def purge(self):
+        # One sweep; returns {conversation id: deleted}
+        conversations = await self.client.list_conversations(name=self.name, idle_for=self.max_age)
+        if not conversations:
+            return {}
+        in_use = await self.in_use() if self.in_use else set()
+        conversation_ids = [conversation['uuid'] for conversation in conversations if conversation['uuid'] not in in_use]
+        if not conversation_ids:
+            return {}
+        results = await self.client.delete_conversations(conversation_ids, self.concurrency, self.rate)
+        deleted = sum(results.values())
+        self.deleted += deleted
+        self.failed += len(results) - deleted
+        return results
+
+    def stats(self):
+        return {"runs": self.runs, "deleted": self.deleted, "failed": self.failed, "last_run": self.last_run}
+
+    async def _run(self):
+        while True:
+            try:
+                results = await self.purge()
+                if results:
+                    logger.info("Conversation janitor deleted %s of %s idle conversations", sum(results.values()), len(results))
+            except Exception:
+                logger.exception("Conversation janitor sweep failed")
+            self.runs += 1
+            self.last_run = time.time()
+            await asyncio.sleep(self.interval)
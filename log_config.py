@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import random
+import uuid
+from contextvars import ContextVar
+
+# Logging setup shared by the console chat and the server. Libraries
+# (claude_api, sse, ...) only create loggers; the entry points call
+# configure_logging(), which reads its settings from the environment:
+#
+#   LOG_LEVEL               DEBUG, INFO (default), WARNING, ...
+#   LOG_FORMAT              "text" (default) or "json" (one object per line)
+#   LOG_MAX_LENGTH          characters kept by truncate() (default 500)
+#   LOG_DEBUG_SAMPLE_RATE   fraction of DEBUG records written (default 1.0)
+#
+# Log calls pass arguments rather than f-strings, so nothing is formatted
+# unless the record is actually written; large values (payloads, bodies,
+# answers) are wrapped in truncate() so a written record stays small.
+
+request_id = ContextVar('request_id', default='-')
+
+_max_length = 500
+
+SENSITIVE_HEADERS = frozenset(('cookie', 'authorization', 'x-api-key'))
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+class truncate:
+    # Lazy "%s" argument: the value is only converted to a string, and cut to
+    # limit characters, if the record is formatted. Strings and bytes are
+    # sliced before conversion so their cost doesn't depend on their size.
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        limit = self.limit or _max_length
+        value = self.value
+        if isinstance(value, (str, bytes)):
+            total = len(value)
+            text = value[:limit]
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', errors='replace')
+        else:
+            text = str(value)
+            total = len(text)
+            text = text[:limit]
+        if total > limit:
+            return f"{text}... ({total} chars)"
+        return text
+
+
+class redact(truncate):
+    # Like truncate, for header mappings, with credentials masked
+    __slots__ = ()
+
+    def __str__(self):
+        headers = {key: ('<redacted>' if key.lower() in SENSITIVE_HEADERS else value)
+                   for key, value in dict(self.value or {}).items()}
+        return str(truncate(headers, self.limit))
+
+
+class RequestIdFilter(logging.Filter):
+    # Stamps each record with the request id of the context that logged it
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class DebugSampler(logging.Filter):
+    # Lets through only a fraction of DEBUG (and lower) records
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, 'request_id', '-'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level=None):
+    # Like logging.basicConfig: does nothing to the handlers if the root
+    # logger already has some (e.g. configured by uvicorn or the embedding
+    # application), only the level is applied
+    global _max_length
+    _max_length = int(os.getenv('LOG_MAX_LENGTH', 500))
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    if root.handlers:
+        return
+
+    handler = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s'))
+    handler.addFilter(RequestIdFilter())
+    sample_rate = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1.0))
+    if sample_rate < 1:
+        handler.addFilter(DebugSampler(sample_rate))
+    root.addHandler(handler)
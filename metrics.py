@@ -0,0 +1,240 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus-style metrics: counters, gauges and histograms with
+# labels, rendered in the text exposition format by Registry.render(). Thread
+# safe, since the blocking Client may be used from several threads.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # collector() is called before every render, e.g. to refresh gauges
+        # from a component's stats()
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        for collector in list(self._collectors):
+            collector()
+
+    def render(self, peers=()):
+        # peers are snapshot()s of the same metrics in other processes, which
+        # are added to this process's values
+        self.collect()
+        lines = []
+        for metric in list(self._metrics):
+            lines.extend(metric.render([peer[metric.name][1] for peer in peers if metric.name in peer]))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        # JSON-serializable values of every metric: {name: [type, [[labels, value], ...]]}
+        self.collect()
+        return {metric.name: [metric.type, metric.snapshot()] for metric in list(self._metrics)}
+
+
+REGISTRY = Registry()
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _label_key(values):
+    # Label values as rendered, so values merged from a snapshot (where they
+    # went through JSON) match local ones
+    return tuple(str(value) for value in values)
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self, peers=()):
+        with self._lock:
+            values = {_label_key(key): value for key, value in self._values.items()}
+        for peer in peers:
+            for key, value in peer:
+                key = _label_key(key)
+                values[key] = values.get(key, 0) + value
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(state[0]), state[1], state[2]]] for key, state in self._values.items()]
+
+    def render(self, peers=()):
+        with self._lock:
+            values = {_label_key(key): (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        for peer in peers:
+            for key, (bucket_counts, total, count) in peer:
+                key = _label_key(key)
+                if key in values:
+                    mine = values[key]
+                    bucket_counts = [a + b for a, b in zip(mine[0], bucket_counts)]
+                    total, count = mine[1] + total, mine[2] + count
+                values[key] = (bucket_counts, total, count)
+        lines = self._header()
+        for key, (bucket_counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def timed(histogram, in_flight=None, **labels):
+    # Decorator recording a call's duration in histogram (and, optionally, the
+    # number of running calls in a gauge). Works for plain functions,
+    # coroutines and (async) generators; generators are timed until exhausted
+    # or closed.
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                with _tracked(histogram, in_flight, labels):
+                    try:
+                        async for item in generator:
+                            yield item
+                    finally:
+                        # Close the inner generator right away (async
+                        # generators are otherwise only finalized later)
+                        await generator.aclose()
+        elif inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with _tracked(histogram, in_flight, labels):
+                    return await func(*args, **kwargs)
+        elif inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with _tracked(histogram, in_flight, labels):
+                    yield from func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with _tracked(histogram, in_flight, labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def _tracked(histogram, in_flight, labels):
+    if in_flight is not None:
+        in_flight.inc(**labels)
+    try:
+        with histogram.time(**labels):
+            yield
+    finally:
+        if in_flight is not None:
+            in_flight.dec(**labels)
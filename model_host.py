@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+# Messages are pickled (numpy arrays travel as raw buffers) and prefixed with
+# their length. The socket only accepts connections from the same user, who
+# could read the model and the collections directly anyway.
+_LENGTH = struct.Struct('!Q')
+
+def _frame(message):
+    data = pickle.dumps(message, protocol=5)
+    return _LENGTH.pack(len(data)) + data
+
+
+class ModelHost:
+    # Serves the embedding models and vector collections of a multi-worker
+    # server from one process, so the models are loaded (and the collections
+    # opened) once instead of in every worker. Embed calls from all workers
+    # go through the same EmbeddingServices, and so share their micro-batches
+    # and caches.
+
+    COLLECTION_METHODS = {"upsert", "delete", "query", "stats", "__len__"}
+
+    def __init__(self, embedding_models, vector_store=None):
+        self.embedding_models = embedding_models
+        self.vector_store = vector_store
+        self.requests = 0
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self._handle, path)
+        os.chmod(path, 0o600)
+        logger.info("Model host listening on %s", path)
+        return server
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    length = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))[0]
+                    method, args, kwargs = pickle.loads(await reader.readexactly(length))
+                except asyncio.IncompleteReadError:
+                    break
+                self.requests += 1
+                try:
+                    reply = (True, await self._dispatch(method, args, kwargs))
+                except Exception as e:
+                    reply = (False, e)
+                try:
+                    data = _frame(reply)
+                except Exception:
+                    # Not every exception can be pickled
+                    data = _frame((False, RuntimeError(f"{type(reply[1]).__name__}: {reply[1]}")))
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, args, kwargs):
+        if method == "embed":
+            name, texts = args
+            return await self.embedding_models.get(name).embed(texts)
+        if method == "embedding_names":
+            return self.embedding_models.names()
+        if method == "embedding_stats":
+            return self.embedding_models.stats()
+        if method == "load_embeddings":
+            return await self.embedding_models.load()
+        if self.vector_store is None:
+            raise ValueError("Collections are disabled on this server")
+        # Collection work holds locks and does matrix products; run it off the loop
+        if method == "collection_open":
+            # (exists, model)
+            collection = await self._in_thread(self.vector_store.get, *args, **kwargs)
+            return (True, collection.model) if collection is not None else (False, None)
+        if method == "collection":
+            name, attribute, args = args[0], args[1], args[2:]
+            if attribute not in self.COLLECTION_METHODS:
+                raise ValueError(f"Unknown collection method {attribute}")
+            collection = await self._in_thread(self.vector_store.get, name)
+            if collection is None:
+                raise ValueError(f"Collection {name} not found")
+            return await self._in_thread(getattr(collection, attribute), *args, **kwargs)
+        if method in ("names", "drop", "stats"):
+            return await self._in_thread(getattr(self.vector_store, method), *args, **kwargs)
+        raise ValueError(f"Unknown model host method {method}")
+
+    @staticmethod
+    async def _in_thread(func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+class ModelHostClient:
+    # Blocking client of a ModelHost, safe to use from several threads: each
+    # call borrows a connection from a pool, opening one when none is idle.
+    # acall() runs a call on the default executor.
+
+    def __init__(self, path, timeout=300):
+        self.path = path
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.path)
+        try:
+            connection.sendall(_frame((method, args, kwargs)))
+            length = _LENGTH.unpack(self._receive(connection, _LENGTH.size))[0]
+            ok, value = pickle.loads(self._receive(connection, length))
+        except BaseException:
+            connection.close()
+            raise
+        with self._lock:
+            self._idle.append(connection)
+        if not ok:
+            raise value
+        return value
+
+    async def acall(self, method, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(self.call, method, *args, **kwargs))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    @staticmethod
+    def _receive(connection, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while view:
+            received = connection.recv_into(view)
+            if not received:
+                raise ConnectionError("Model host closed the connection")
+            view = view[received:]
+        return buffer
+
+
+class RemoteEmbeddingService:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    async def embed(self, texts):
+        return await self.client.acall("embed", self.name, texts)
+
+
+class RemoteEmbeddingRegistry:
+    # EmbeddingRegistry of a worker process, forwarding to the ModelHost
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, name):
+        return RemoteEmbeddingService(self.client, name)
+
+    def names(self):
+        return self.client.call("embedding_names")
+
+    def stats(self):
+        try:
+            return self.client.call("embedding_stats")
+        except (OSError, ConnectionError) as e:
+            logger.warning("Model host unavailable: %s", e)
+            return {}
+
+    async def load(self):
+        await self.client.acall("load_embeddings")
+
+    async def close(self):
+        self.client.close()
+
+
+class RemoteCollection:
+    def __init__(self, client, name, model):
+        self.client = client
+        self.name = name
+        self.model = model
+
+    def __len__(self):
+        return self.client.call("collection", self.name, "__len__")
+
+    def __getattr__(self, attribute):
+        if attribute not in ModelHost.COLLECTION_METHODS:
+            raise AttributeError(attribute)
+        return partial(self.client.call, "collection", self.name, attribute)
+
+
+class RemoteVectorStore:
+    # VectorStore of a worker process, forwarding to the ModelHost
+
+    def __init__(self, client):
+        self.client = client
+
+    def names(self):
+        return self.client.call("names")
+
+    def get(self, name, model=None, create=False):
+        exists, model = self.client.call("collection_open", name, model=model, create=create)
+        return RemoteCollection(self.client, name, model) if exists else None
+
+    def drop(self, name):
+        return self.client.call("drop", name)
+
+    def stats(self):
+        try:
+            return self.client.call("stats")
+        except (OSError, ConnectionError) as e:
+            logger.warning("Model host unavailable: %s", e)
+            return {}
+
+    def close(self):
+        pass
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Files written by export_onnx into a model directory, next to the tokenizer
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model-int8.onnx"
+PIPELINE_FILE = "pipeline.json"
+
+def export_onnx(model_name, directory, quantize=True):
+    # One-off conversion of a SentenceTransformer model: the transformer is
+    # exported to ONNX (and dynamically quantized to int8 weights), and the
+    # tokenizer and pooling settings are saved so OnnxEncoder needs neither
+    # torch nor sentence_transformers at run time
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling = next((module for module in model if isinstance(module, models.Pooling)), None)
+    pooling_mode = pooling.get_pooling_mode_str() if pooling else "mean"
+    if pooling_mode not in ("mean", "cls", "max"):
+        raise ValueError(f"Unsupported pooling mode for ONNX export: {pooling_mode}")
+
+    os.makedirs(directory, exist_ok=True)
+    sample = transformer.tokenizer(["an example sentence"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs)))[0]
+
+    path = os.path.join(directory, MODEL_FILE)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(transformer.auto_model).eval(), tuple(sample[name] for name in input_names), path,
+                          input_names=input_names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes,
+                          opset_version=14)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(path, os.path.join(directory, QUANTIZED_MODEL_FILE), weight_type=QuantType.QInt8)
+
+    transformer.tokenizer.save_pretrained(directory)
+    with open(os.path.join(directory, PIPELINE_FILE), 'w') as pipeline_file:
+        json.dump({
+            "model": model_name,
+            "pooling": pooling_mode,
+            "normalize": any(isinstance(module, models.Normalize) for module in model),
+            "max_length": model.max_seq_length,
+            "inputs": input_names,
+        }, pipeline_file)
+    logger.info("Exported %s to ONNX in %s", model_name, directory)
+
+
+class OnnxEncoder:
+    # SentenceTransformer-compatible encode() running an exported model with
+    # ONNX Runtime on the CPU. threads bounds the intra-op thread pool (None
+    # leaves it to ONNX Runtime, which uses every core). Like
+    # SentenceTransformer, texts are encoded sorted by length so batches need
+    # little padding.
+
+    def __init__(self, directory, quantized=True, threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(directory, PIPELINE_FILE)) as pipeline_file:
+            pipeline = json.load(pipeline_file)
+        self.pooling = pipeline["pooling"]
+        self.normalize = pipeline["normalize"]
+        self.max_length = pipeline["max_length"]
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        path = os.path.join(directory, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def encode(self, texts, batch_size=32):
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        vectors = [None] * len(texts)
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            tokens = self.tokenizer([texts[i] for i in indices], padding=True, truncation=True, max_length=self.max_length,
+                                    return_tensors="np")
+            hidden = self.session.run(None, {name: tokens[name].astype(np.int64) for name in self.input_names})[0]
+            pooled = self._pool(hidden, tokens["attention_mask"])
+            for i, vector in zip(indices, pooled):
+                vectors[i] = vector
+        return np.stack(vectors).astype(np.float32)
+
+    def _pool(self, hidden, attention_mask):
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        elif self.pooling == "max":
+            pooled = np.where(attention_mask[..., None].astype(bool), hidden, -np.inf).max(axis=1)
+        else:
+            mask = attention_mask[..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+
+def onnx_loader(model_name, directory, quantized=True, threads=None):
+    # Model loader for EmbeddingService; the model is exported on first use
+    # if directory doesn't hold it yet
+    def load():
+        if not os.path.exists(os.path.join(directory, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)):
+            logger.info("Exporting %s to ONNX in %s", model_name, directory)
+            export_onnx(model_name, directory, quantize=quantized)
+        return OnnxEncoder(directory, quantized=quantized, threads=threads)
+    return load
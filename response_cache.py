@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    # Answers to completed chat requests keyed by a canonical hash of model +
+    # messages, so an identical request can be answered without a new
+    # conversation or generation. An in-memory LRU sits in front of an
+    # optional SQLite file that keeps answers across restarts. Entries expire
+    # ttl seconds after they were stored (wall clock, so persisted entries
+    # age across restarts too). With a file, which other processes may be
+    # writing, async code calls get and put through run(), and a locked
+    # database counts as a miss.
+
+    def __init__(self, max_entries=1000, ttl=3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._executor = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._open()
+
+    @staticmethod
+    def key(model, messages):
+        canonical = json.dumps([model, messages], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    async def run(self, func, *args):
+        # Awaits func(*args), on the database thread when there is a file
+        if self._executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+
+    def get(self, key):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+        if self._db is not None:
+            try:
+                with self._lock:
+                    row = self._db.execute("SELECT answer, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.OperationalError as e:
+                logger.warning("Response cache unavailable: %s", e)
+                row = None
+            if row and now - row[1] < self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, answer, model=None):
+        created_at = time.time()
+        self._remember(key, answer, created_at)
+        if self._db is not None:
+            try:
+                with self._lock:
+                    self._db.execute("INSERT OR REPLACE INTO responses (key, model, answer, created_at) VALUES (?, ?, ?, ?)",
+                                     (key, model, answer, created_at))
+                    self._db.commit()
+                    self._writes += 1
+                    if self._writes % 1000 == 0:
+                        self._purge_expired()
+            except sqlite3.OperationalError as e:
+                # Still cached in memory
+                logger.warning("Response cache unavailable, answer not persisted: %s", e)
+                with self._lock:
+                    self._db.rollback()
+
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, key, answer, created_at):
+        self._entries[key] = (answer, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _open(self):
+        # Wait briefly for another process's write, then give up on the entry
+        self._db = sqlite3.connect(self.path, timeout=1, check_same_thread=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        # WAL with synchronous=NORMAL: commits don't wait for an fsync
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, answer TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        with self._lock:
+            self._purge_expired()
+
+    def _purge_expired(self):
+        deleted = self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        self._db.commit()
+        if deleted:
+            logger.debug("Response cache purged %s expired entries", deleted)
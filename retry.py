@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from curl_cffi import requests
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth another attempt: timeouts, rate limiting and server-side
+# failures. Any other status is returned to the caller straight away.
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524, 529})
+
+
+def parse_retry_after(value):
+    # Retry-After header (delay in seconds or an HTTP date) -> seconds to wait
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter: the delay before retry n is drawn
+    # from [0, min(max_delay, base_delay * 2**n)]. A Retry-After sent by the
+    # upstream is honored instead when it is longer. No attempt is started
+    # once deadline seconds have passed since the first one.
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=30.0, deadline=60.0, retryable_statuses=RETRYABLE_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_statuses = retryable_statuses
+
+    def is_retryable(self, status_code):
+        return status_code in self.retryable_statuses
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def next_delay(self, attempt, max_attempts, started, response=None):
+        # Seconds to wait before retrying after attempt (0-based) failed, or
+        # None when the caller should give up: the failure is terminal, the
+        # attempts are used up or the wait would overrun the deadline
+        if response is not None and not self.is_retryable(response.status_code):
+            return None
+        if attempt + 1 >= max_attempts:
+            return None
+        retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+        delay = self.backoff(attempt, retry_after)
+        if time.monotonic() - started + delay > self.deadline:
+            logger.warning("Retry budget of %ss exhausted after %s attempts", self.deadline, attempt + 1)
+            return None
+        return delay
+
+
+class CircuitOpenError(requests.RequestsError):
+    # Raised instead of sending a request while the circuit breaker is open
+
+    def __init__(self, retry_after):
+        super().__init__(f"Upstream unavailable, circuit open for another {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # Stops calls to an upstream that keeps failing. After failure_threshold
+    # consecutive failures (transport errors, 429 and 5xx responses) the
+    # circuit opens and requests fail immediately for reset_timeout seconds.
+    # Then a single probe request is let through: success closes the circuit,
+    # failure opens it again.
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_failure(status_code):
+        return status_code == 429 or status_code >= 500
+
+    def retry_after(self):
+        # Seconds until the circuit lets a request through again (0 if closed)
+        if self.state == self.CLOSED:
+            return 0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def is_open(self):
+        # True while requests would be rejected; doesn't claim the probe
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at < self.reset_timeout
+            return self.state == self.HALF_OPEN and self._probing
+
+    def before_request(self):
+        # Raises CircuitOpenError unless a request may be sent now
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+                logger.info("Circuit half open, probing the upstream")
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            if self.state == self.CLOSED:
+                return
+            self.rejected += 1
+        raise CircuitOpenError(max(self.retry_after(), 1))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed, upstream recovered")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opened += 1
+                logger.warning("Circuit open after %s consecutive upstream failures, shedding requests for %ss",
+                               self.failures, self.reset_timeout)
+
+    def cancel(self):
+        # The request was abandoned before an outcome; let another probe through
+        with self._lock:
+            self._probing = False
+
+    def record(self, status_code):
+        if self.is_failure(status_code):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def stats(self):
+        return {"state": self.state, "open": int(self.is_open()), "failures": self.failures, "opened": self.opened, "rejected": self.rejected}
@@ -1,15 +1,39 @@
 import asyncio
+import base64
+import binascii
 import json
+import math
+import mimetypes
+import multiprocessing
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import time
-import re
-from typing import List, Optional, Union
-from fastapi import FastAPI, HTTPException, Depends, Security
+import uuid
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, List, Literal, Optional, Union
+from fastapi import FastAPI, HTTPException, Depends, Request, Security
 from fastapi.security.api_key import APIKeyHeader
 from pydantic import BaseModel
-from starlette.responses import StreamingResponse
-from claude_api import Client as ClaudeClient
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Match
+from claude_api import AsyncClient as ClaudeClient, UpstreamError
+from conversation_pool import ConversationPool
+from session_cache import SessionCache
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from code_blocks import CodeBlockNormalizer, process_code_blocks
+from admission import AdmissionController, AdmissionRejected
+from janitor import ConversationJanitor
+from embeddings import BACKENDS, EmbeddingRegistry, EmbeddingService, encode_embedding, parse_embedding_models
+from vector_store import VectorStore
+from model_host import ModelHost, ModelHostClient, RemoteEmbeddingRegistry, RemoteVectorStore
+from shared_state import SharedSessionCache, SharedState, try_lock
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from log_config import configure_logging, new_request_id, request_id, truncate
 import logging
-from sentence_transformers import SentenceTransformer
 import os
 from dotenv import load_dotenv
 
@@ -18,21 +42,88 @@ load_dotenv()
 app = FastAPI(title="Claude-compatible OpenAI API")
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # You'll need to set these values appropriately
 COOKIE =os.getenv('COOKIE')# Replace with actual cookie value
 API_KEY = os.getenv('API_KEY')  # Set this to your desired API key
+WORKERS = int(os.getenv('WORKERS', 1))  # Server processes started by `python server.py`
+STATE_DIR = os.getenv('STATE_DIR', 'state')  # State shared by the workers when WORKERS > 1
+MODEL_HOST_SOCKET = os.getenv('MODEL_HOST_SOCKET')  # Set for the workers when a model host process serves the embeddings
+CONVERSATION_POOL_SIZE = int(os.getenv('CONVERSATION_POOL_SIZE', 0))  # 0 disables the warm pool
+CONVERSATION_POOL_TTL = float(os.getenv('CONVERSATION_POOL_TTL', 300))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 0))  # 0 disables conversation reuse
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 1800))
+MAX_CONCURRENT_COMPLETIONS = int(os.getenv('MAX_CONCURRENT_COMPLETIONS', 0))  # 0 = no limit
+MAX_QUEUED_COMPLETIONS = int(os.getenv('MAX_QUEUED_COMPLETIONS', 100))
+QUEUE_TIMEOUT = float(os.getenv('QUEUE_TIMEOUT', 30))  # Seconds a request may wait for an upstream slot
+COALESCE_REQUESTS = os.getenv('COALESCE_REQUESTS', 'true').lower() in ('1', 'true', 'yes')  # Share one upstream call between identical concurrent requests
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 0))  # 0 disables the response cache
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join(STATE_DIR, 'responses.sqlite') if WORKERS > 1 else None)  # Also keep cached answers in this SQLite file
+CONVERSATION_NAME = os.getenv('CONVERSATION_NAME', 'OpenAI API proxy')  # Name given to conversations created by the server
+DELETE_ABANDONED_CONVERSATIONS = os.getenv('DELETE_ABANDONED_CONVERSATIONS', 'true').lower() in ('1', 'true', 'yes')  # Delete a conversation once its client disconnects mid-completion
+JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', 0))  # Seconds between sweeps, 0 disables the janitor
+JANITOR_MAX_AGE = float(os.getenv('JANITOR_MAX_AGE', 3600))  # Delete conversations idle for longer than this
+JANITOR_CONCURRENCY = int(os.getenv('JANITOR_CONCURRENCY', 4))
+JANITOR_RATE = float(os.getenv('JANITOR_RATE', 2))  # Deletions per second
+EMBEDDINGS_ENABLED = os.getenv('EMBEDDINGS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')  # Default model, used for unregistered model names
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'sentence-transformers')  # Backend running the default model
+EMBEDDING_MODELS = os.getenv('EMBEDDING_MODELS', '')  # More models: name=backend[:source],...
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', 0))  # CPU threads per encode call, 0 = runtime default
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR', 'onnx_models')  # Where models converted to ONNX are kept
+EMBEDDING_PRELOAD = os.getenv('EMBEDDING_PRELOAD', 'false').lower() in ('1', 'true', 'yes')  # Load at startup instead of on first use
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv('EMBEDDING_BATCH_WAIT_MS', 5))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 10000))  # 0 disables the cache
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH')  # Persist cached vectors to this .npy file
+EMBEDDING_WORKERS = int(os.getenv('EMBEDDING_WORKERS', 1))
+VECTOR_STORE_DIR = os.getenv('VECTOR_STORE_DIR', 'collections')  # Where /v1/collections are kept, empty disables them
+VECTOR_INDEX_THRESHOLD = int(os.getenv('VECTOR_INDEX_THRESHOLD', 100000))  # Search larger collections approximately, 0 = always exact
+VECTOR_INDEX_PROBES = int(os.getenv('VECTOR_INDEX_PROBES', 8))  # Clusters scanned by an approximate search
+METRICS_PUBLISH_INTERVAL = 5  # Seconds between metric snapshots written to the shared state by each worker
+CONTROL_CALL_SLOTS = 32  # Client slots kept for non-completion calls on top of the admitted completions
 
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 
 claude_client = None
-embedding_model = None
+embedding_models = None
+vector_store = None
+model_host = None
+shared_state = None
+janitor_lock = None
+background_tasks = set()
+conversation_pool = None
+session_cache = None
+response_cache = None
+flights = SingleFlight() if COALESCE_REQUESTS else None
+# Limits and pool sizes are totals; every worker gets its share of them
+admission = AdmissionController(math.ceil(MAX_CONCURRENT_COMPLETIONS / WORKERS), math.ceil(MAX_QUEUED_COMPLETIONS / WORKERS),
+                                QUEUE_TIMEOUT) if MAX_CONCURRENT_COMPLETIONS > 0 else None
+janitor = None
+pending_deletes = set()
+
+REQUESTS = Counter("server_requests_total", "HTTP requests handled, by route and status code", ["path", "status"])
+REQUEST_DURATION = Histogram("server_request_duration_seconds", "Time until the response starts, by route", ["path"])
+REQUESTS_IN_FLIGHT = Gauge("server_requests_in_flight", "Requests currently being handled, by route", ["path"])
+STAGE_DURATION = Histogram("server_stage_duration_seconds", "Time spent in each stage of request handling", ["stage"])
+COMPONENT_STATS = Gauge("server_component_stat", "Counters and sizes reported by the server's pools and caches", ["component", "stat"])
+
+class FileData(BaseModel):
+    filename: Optional[str] = None
+    file_data: Optional[str] = None  # base64, optionally as a data: URL
+    file_id: Optional[str] = None
+
+class ContentPart(BaseModel):
+    type: Literal["text", "file"]
+    text: Optional[str] = None
+    file: Optional[FileData] = None
 
 class ChatMessage(BaseModel):
     role: str
-    content: str
+    content: Union[str, List[ContentPart]]
 
 class ChatCompletionRequest(BaseModel):
     model: str = "claude-3-5-sonnet-20240620"
@@ -44,6 +135,25 @@ class ChatCompletionRequest(BaseModel):
 class EmbeddingRequest(BaseModel):
     model: str
     input: Union[str, List[str]]
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+
+class CollectionItem(BaseModel):
+    id: Optional[str] = None  # Generated when missing
+    text: str
+    metadata: Optional[dict] = None
+
+class CollectionUpsertRequest(BaseModel):
+    items: List[CollectionItem]
+    model: Optional[str] = None  # Embedding model, fixed by the first upsert into a collection
+
+class CollectionQueryRequest(BaseModel):
+    input: Optional[Union[str, List[str]]] = None
+    vector: Optional[List[float]] = None  # Query with a vector instead of embedding input
+    top_k: int = 10
+    exact: bool = False  # Score every vector even when the collection is large enough for the approximate index
+
+class CollectionDeleteRequest(BaseModel):
+    ids: List[str]
 
 async def get_api_key(api_key_header: str = Security(api_key_header)):
     if api_key_header and api_key_header.startswith("Bearer "):
@@ -52,17 +162,221 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
             return key
     raise HTTPException(status_code=401, detail="Invalid or missing API Key")
 
+def route_path(request: Request):
+    # Label requests by route template rather than raw path to bound cardinality
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    path = route_path(request)
+    status = 500
+    start = time.perf_counter()
+    try:
+        with REQUESTS_IN_FLIGHT.track_in_progress(path=path):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUEST_DURATION.observe(time.perf_counter() - start, path=path)
+        REQUESTS.inc(path=path, status=str(status))
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    # Every record logged while handling the request, the client's included,
+    # carries the same id; callers can supply their own with X-Request-ID
+    token = request_id.set(request.headers.get("x-request-id", "")[:64] or new_request_id())
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id.get()
+        return response
+    finally:
+        request_id.reset(token)
+
+def collect_component_stats():
+    components = {
+        "upstream_pool": claude_client.pool_stats() if claude_client else None,
+        "conversation_pool": conversation_pool.stats() if conversation_pool else None,
+        "session_cache": session_cache.stats() if session_cache else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "coalescing": flights.stats() if flights else None,
+        "admission": admission.stats() if admission else None,
+        "circuit_breaker": claude_client.circuit_breaker.stats() if claude_client else None,
+        "janitor": janitor.stats() if janitor else None,
+    }
+    # With a model host, it reports the embedding and collection statistics
+    if not model_host:
+        components["vector_store"] = vector_store.stats() if vector_store else None
+        for model, stats in (embedding_models.stats() if embedding_models else {}).items():
+            components[f"embeddings/{model}"] = stats
+    for component, stats in components.items():
+        for stat, value in (stats or {}).items():
+            if isinstance(value, (int, float)):
+                COMPONENT_STATS.set(value, component=component, stat=stat)
+
+REGISTRY.add_collector(collect_component_stats)
+
 @app.on_event("startup")
 async def startup_event():
-    global claude_client, embedding_model
-    claude_client = ClaudeClient(COOKIE, model="claude-3-5-sonnet-20240620")
-    logger.debug(f"Claude client initialized with organization ID: {claude_client.organization_id}")
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-    logger.debug("Embedding model initialized")
+    global claude_client, embedding_models, vector_store, model_host, shared_state, janitor_lock
+    global conversation_pool, session_cache, response_cache, janitor
+    claude_client = ClaudeClient(COOKIE, model="claude-3-5-sonnet-20240620", max_concurrency=upstream_concurrency())
+    logger.debug("Claude client initialized with organization ID: %s", claude_client.organization_id)
+    if WORKERS > 1:
+        shared_state = open_shared_state(f"worker-{os.getpid()}")
+        start_background_task(publish_state())
+    if CONVERSATION_POOL_SIZE > 0:
+        conversation_pool = ConversationPool(claude_client, math.ceil(CONVERSATION_POOL_SIZE / WORKERS), ttl=CONVERSATION_POOL_TTL,
+                                             name=CONVERSATION_NAME)
+        conversation_pool.start()
+    if SESSION_CACHE_SIZE > 0:
+        if shared_state:
+            # Its methods run on the shared state's thread (see session_call)
+            loop = asyncio.get_running_loop()
+            session_cache = SharedSessionCache(shared_state, SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL,
+                                               on_evict=lambda conversation_id: loop.call_soon_threadsafe(schedule_conversation_delete, conversation_id))
+        else:
+            session_cache = SessionCache(SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL, on_evict=schedule_conversation_delete)
+    if RESPONSE_CACHE_SIZE > 0:
+        response_cache = ResponseCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH)
+    if JANITOR_INTERVAL > 0:
+        # Only one worker sweeps
+        janitor_lock = try_lock(os.path.join(STATE_DIR, "janitor.lock")) if shared_state else None
+        if janitor_lock or not shared_state:
+            janitor = ConversationJanitor(claude_client, CONVERSATION_NAME, interval=JANITOR_INTERVAL, max_age=JANITOR_MAX_AGE,
+                                          concurrency=JANITOR_CONCURRENCY, rate=JANITOR_RATE, in_use=conversations_in_use)
+            janitor.start()
+    if EMBEDDINGS_ENABLED:
+        if MODEL_HOST_SOCKET:
+            model_host = ModelHostClient(MODEL_HOST_SOCKET)
+            embedding_models = RemoteEmbeddingRegistry(model_host)
+            vector_store = RemoteVectorStore(model_host) if VECTOR_STORE_DIR else None
+            logger.debug("Using the model host at %s", MODEL_HOST_SOCKET)
+            return
+        embedding_models = create_embedding_registry()
+        if EMBEDDING_PRELOAD:
+            await embedding_models.load()
+        logger.debug("Embedding models initialized: %s", ", ".join(embedding_models.names()))
+        if VECTOR_STORE_DIR:
+            vector_store = VectorStore(VECTOR_STORE_DIR, index_threshold=VECTOR_INDEX_THRESHOLD, probes=VECTOR_INDEX_PROBES)
+
+def upstream_concurrency():
+    # Admitted completions must not queue again inside the client, where no
+    # deadline, priority or metric applies: give it a slot for each of them,
+    # plus room for the conversation, history and janitor calls alongside
+    configured = int(os.getenv('CLAUDE_MAX_CONCURRENCY', 100))
+    if admission:
+        return max(configured, admission.max_in_flight + CONTROL_CALL_SLOTS)
+    return configured
+
+def create_embedding_registry():
+    registry = EmbeddingRegistry(EMBEDDING_MODEL)
+    for name, backend, source in parse_embedding_models(f"{EMBEDDING_MODEL}={EMBEDDING_BACKEND},{EMBEDDING_MODELS}"):
+        registry.add(name, EmbeddingService(
+            BACKENDS[backend](source, EMBEDDING_THREADS or None, os.path.join(EMBEDDING_ONNX_DIR, source.replace('/', '--'))),
+            max_batch_size=EMBEDDING_BATCH_SIZE,
+            max_wait=EMBEDDING_BATCH_WAIT_MS / 1000,
+            cache_size=EMBEDDING_CACHE_SIZE,
+            cache_path=embedding_cache_path(name),
+            workers=EMBEDDING_WORKERS
+        ))
+    return registry
+
+def open_shared_state(worker):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return SharedState(os.path.join(STATE_DIR, "shared.sqlite"), worker=worker)
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def publish_state():
+    # Lets any worker's /metrics report the totals of all of them, and the
+    # janitor's worker leave alone the conversations pooled by the others
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            await shared_state.run(shared_state.publish_metrics, REGISTRY.snapshot())
+            if conversation_pool:
+                await shared_state.run(shared_state.publish_in_use, conversation_pool.conversation_ids())
+        except sqlite3.Error as e:
+            logger.warning("Failed to publish the shared state: %s", e)
+
+def embedding_cache_path(model):
+    # Every model caches its vectors in a file of its own
+    if not EMBEDDING_CACHE_PATH or model == EMBEDDING_MODEL:
+        return EMBEDDING_CACHE_PATH
+    root, extension = os.path.splitext(EMBEDDING_CACHE_PATH)
+    return f"{root}.{model.replace('/', '--')}{extension}"
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in list(background_tasks):
+        task.cancel()
+    if janitor:
+        await janitor.stop()
+    if conversation_pool:
+        await conversation_pool.stop()
+    if session_cache:
+        session_cache.clear()
+    if pending_deletes:
+        await asyncio.gather(*pending_deletes, return_exceptions=True)
+    if response_cache:
+        response_cache.close()
+    if vector_store:
+        vector_store.close()
+    if embedding_models:
+        await embedding_models.close()
+    if claude_client:
+        await claude_client.close()
+    if shared_state:
+        shared_state.close()
+    if janitor_lock:
+        janitor_lock.close()
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    health = {"status": "healthy"}
+    if WORKERS > 1:
+        health["worker"] = os.getpid()
+    if claude_client:
+        health["upstream_pool"] = claude_client.pool_stats()
+        health["circuit_breaker"] = claude_client.circuit_breaker.stats()
+        if claude_client.circuit_breaker.is_open():
+            health["status"] = "degraded"
+    if conversation_pool:
+        health["conversation_pool"] = conversation_pool.stats()
+    if session_cache:
+        health["session_cache"] = session_cache.stats()
+    if response_cache:
+        health["response_cache"] = response_cache.stats()
+    if flights:
+        health["coalescing"] = flights.stats()
+    if admission:
+        health["admission"] = admission.stats()
+    if janitor:
+        health["janitor"] = janitor.stats()
+    if embedding_models:
+        health["embeddings"] = embedding_models.stats()
+    if vector_store:
+        health["vector_store"] = vector_store.stats()
+    return health
+
+@app.get("/metrics")
+async def metrics():
+    peers = ()
+    if shared_state:
+        try:
+            await shared_state.run(shared_state.publish_metrics, REGISTRY.snapshot())
+            peers = await shared_state.run(shared_state.peer_metrics, max_age=3 * METRICS_PUBLISH_INTERVAL)
+        except sqlite3.Error as e:
+            # Report this worker's own metrics rather than nothing
+            logger.warning("Failed to read the other workers' metrics: %s", e)
+    return PlainTextResponse(REGISTRY.render(peers), media_type="text/plain; version=0.0.4")
 
 @app.get("/v1/models")
 async def get_models(api_key: str = Depends(get_api_key)):
@@ -71,73 +385,362 @@ async def get_models(api_key: str = Depends(get_api_key)):
     return {"data": claude_client.get_available_models()}
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, api_key: str = Depends(get_api_key)):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request, api_key: str = Depends(get_api_key)):
     if not claude_client:
         raise HTTPException(status_code=500, detail="Claude API not initialized")
 
     try:
-        claude_client.set_model(request.model)
-        
-        # Prepare the message for Claude
-        claude_message = "\n".join([f"{msg.role}: {msg.content}" for msg in request.messages])
-
-        # Create a new conversation
-        logger.info("Creating new chat conversation")
-        conversation = claude_client.create_new_chat()
-        logger.debug(f"Create new chat response: {conversation}")
-        conversation_id = conversation.get('uuid')
-        if not conversation_id:
-            logger.error(f"Failed to get conversation UUID. Full response: {conversation}")
-            raise HTTPException(status_code=500, detail="Failed to create new conversation")
-
-        # Send message
-        logger.info(f"Sending message to conversation {conversation_id}")
-        response = claude_client.send_message(claude_message, conversation_id)
-        logger.debug(f"Received response: {response[:100]}...")  # Log first 100 chars of response
+        model = claude_client.validate_model(request.model)
+
+        # Identical requests are answered from the response cache. Cache-Control:
+        # no-cache skips the lookup (and joining an identical in-flight
+        # request), no-store also keeps the answer out of the cache.
+        cache_control = http_request.headers.get("cache-control", "").lower()
+        request_key = ResponseCache.key(model, transcript(request.messages)) if response_cache or flights else None
+        cache_key, cache_status = None, "BYPASS"
+        if response_cache and "no-store" not in cache_control:
+            cache_key = request_key
+            cached = None if "no-cache" in cache_control else await response_cache.run(response_cache.get, cache_key)
+            if cached is not None:
+                return cached_response(cached, request)
+            cache_status = "MISS"
+        cache_headers = {"X-Cache": cache_status} if response_cache else None
+
+        async def prepare():
+            # Continue the conversation that already holds the start of this
+            # transcript, if any, so only the new messages are sent upstream
+            conversation_id, known_messages = None, 0
+            if session_cache:
+                conversation_id, known_messages = await session_call(session_cache.take, model, transcript(request.messages))
+
+            # Prepare the message for Claude. Files travel as attachments rather
+            # than inside the prompt, and are uploaded before a conversation is
+            # created so a bad or failed file doesn't leave an empty one behind.
+            new_messages = request.messages[known_messages:]
+            claude_message = "\n".join([f"{msg.role}: {message_text(msg)}" for msg in new_messages])
+            attachments = None
+            files = [part.file for msg in new_messages if not isinstance(msg.content, str) for part in msg.content if part.type == "file"]
+            if files:
+                try:
+                    with STAGE_DURATION.time(stage="upload_attachments"):
+                        attachments = await upload_file_parts(files)
+                except BaseException:
+                    # Nothing was sent to the continued conversation; hand it back
+                    if conversation_id:
+                        await session_call(session_cache.store, model, transcript(request.messages[:known_messages]), conversation_id)
+                    raise
+            if not conversation_id:
+                with STAGE_DURATION.time(stage="get_conversation"):
+                    conversation_id = await get_conversation(model)
+
+            async def remember(answer, content=None):
+                # content is the answer as returned to the client, which is
+                # what it sends back in its next request
+                if isinstance(answer, UpstreamError):
+                    # Nothing can continue a conversation that holds a failed
+                    # answer; delete it as the session cache would on eviction
+                    if session_cache:
+                        schedule_conversation_delete(conversation_id)
+                    return
+                if session_cache:
+                    await session_call(session_cache.store, model, transcript(request.messages) + [("assistant", content or answer)], conversation_id)
+                if cache_key:
+                    await response_cache.run(response_cache.put, cache_key, answer, model)
+
+            return conversation_id, claude_message, attachments, remember
+
+        priority = request_priority(http_request)
+
+        async def start_stream():
+            # The upstream slot is held until the stream has been consumed
+            release = await admit(priority)
+            conversation_id = None
+            try:
+                conversation_id, claude_message, attachments, remember = await prepare()
+                logger.info("Streaming message to conversation %s", conversation_id)
+                deltas = claude_client.stream_message(claude_message, conversation_id, model=model, attachments=attachments)
+            except BaseException as e:
+                release()
+                if isinstance(e, asyncio.CancelledError):
+                    abandon_conversation(conversation_id)
+                raise
+            return collect_stream(deltas, on_complete=lambda answer: remember(answer, process_code_blocks(answer)), on_close=release,
+                                  on_abandon=lambda: abandon_conversation(conversation_id))
 
+        async def complete():
+            release = await admit(priority)
+            conversation_id = None
+            try:
+                conversation_id, claude_message, attachments, remember = await prepare()
+                logger.info("Sending message to conversation %s", conversation_id)
+                with STAGE_DURATION.time(stage="upstream_completion"):
+                    response = await claude_client.send_message(claude_message, conversation_id, model=model, attachments=attachments)
+            except asyncio.CancelledError:
+                abandon_conversation(conversation_id)
+                raise
+            finally:
+                release()
+            logger.debug("Received response: %s", truncate(response, 100))
+            await remember(response, process_code_blocks(response))
+            return response
+
+        # Concurrent identical requests share one upstream call (and stream)
+        flight_key = None
+        if flights and "no-cache" not in cache_control and "no-store" not in cache_control:
+            flight_key = f"{request_key}:{'stream' if request.stream else 'complete'}"
+
+        # Upstream work is cancelled as soon as the client disconnects (for
+        # coalesced calls, once every client waiting for it has)
         if request.stream:
-            return StreamingResponse(stream_claude_response(response, request), media_type="text/event-stream")
-        else:
-            return format_claude_response(response, request)
+            deltas = await cancel_on_disconnect(http_request, flights.stream(flight_key, start_stream) if flight_key else start_stream())
+            deltas = stream_until_disconnect(http_request, deltas)
+            return StreamingResponse(stream_claude_response(deltas, request), media_type="text/event-stream", headers=cache_headers)
+
+        response = await cancel_on_disconnect(http_request, flights.do(flight_key, complete) if flight_key else complete())
+        return JSONResponse(format_claude_response(response, request), headers=cache_headers)
+    except HTTPException:
+        raise
+    except ClientDisconnected:
+        logger.info("Client disconnected before the completion was ready")
+        return Response(status_code=499)
+    except AdmissionRejected as e:
+        logger.warning("Rejected completion: %s", e)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except ValueError as e:
-        logger.error(f"Invalid model specified: {str(e)}")
+        logger.error("Invalid request: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.exception(f"An error occurred: {str(e)}")
+        logger.exception("An error occurred: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-def process_code_blocks(text):
-    def replace_code_block(match):
-        language = match.group(1) or ""
-        code = match.group(2)
-        return f"\n```{language}\n{code}\n```\n"
+async def replay(answer):
+    yield answer
 
-    # Replace code blocks
-    text = re.sub(r'```(\w*)\n(.*?)\n```', replace_code_block, text, flags=re.DOTALL)
-    
-    # Ensure proper spacing around code blocks
-    text = re.sub(r'(\n```[\w]*\n.*?\n```)\n?', r'\1\n\n', text, flags=re.DOTALL)
-    
-    return text
+async def collect_stream(deltas: AsyncIterator[str], on_complete: Callable[[str], Awaitable[None]], on_close: Optional[Callable[[], None]] = None,
+                         on_abandon: Optional[Callable[[], None]] = None):
+    # on_complete gets the whole answer, as an UpstreamError if the upstream
+    # broke the stream off
+    parts = []
+    failed = False
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            failed = isinstance(delta, UpstreamError)
+            yield delta
+        answer = "".join(parts)
+        await on_complete(UpstreamError(answer) if failed else answer)
+    except (GeneratorExit, asyncio.CancelledError):
+        # Closed or cancelled before the end: close the upstream stream now
+        # rather than whenever the generator is garbage collected
+        await deltas.aclose()
+        if on_abandon:
+            on_abandon()
+        raise
+    finally:
+        if on_close:
+            on_close()
 
-async def stream_claude_response(response: str, request: ChatCompletionRequest):
-    processed_response = process_code_blocks(response)
-    words = processed_response.split()
-    
-    for i, word in enumerate(words):
+class ClientDisconnected(Exception):
+    pass
+
+async def wait_for_disconnect(http_request: Request):
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def cancel_on_disconnect(http_request: Request, awaitable):
+    # Awaits awaitable, cancelling it and raising ClientDisconnected if the
+    # client goes away first
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait((work, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not work.done():
+        work.cancel()
+        raise ClientDisconnected()
+    return work.result()
+
+async def stream_until_disconnect(http_request: Request, deltas: AsyncIterator[str]):
+    # Yields deltas until the client goes away, then closes the upstream
+    # stream. Each delta is awaited in a task so a disconnect is noticed even
+    # while the upstream is silent, not only when the next write fails.
+    watcher = asyncio.ensure_future(wait_for_disconnect(http_request))
+    step = None
+    try:
+        while True:
+            step = asyncio.ensure_future(deltas.__anext__())
+            await asyncio.wait((step, watcher), return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                logger.info("Client disconnected mid-stream, cancelling the upstream request")
+                return
+            try:
+                delta = step.result()
+            except StopAsyncIteration:
+                return
+            yield delta
+    finally:
+        watcher.cancel()
+        if step is not None and not step.done():
+            step.cancel()
+            await asyncio.wait((step,))
+        await deltas.aclose()
+
+def abandon_conversation(conversation_id):
+    # The client went away mid-completion, so nothing will continue the
+    # conversation; it isn't left behind for the janitor
+    if conversation_id and DELETE_ABANDONED_CONVERSATIONS:
+        logger.info("Deleting abandoned conversation %s", conversation_id)
+        schedule_conversation_delete(conversation_id)
+
+def request_priority(http_request: Request):
+    # Higher X-Priority values are admitted first when completions are queued
+    try:
+        return max(-10, min(10, int(http_request.headers.get("x-priority", 0))))
+    except ValueError:
+        return 0
+
+async def admit(priority):
+    # Waits for an upstream slot; returns the function releasing it. While the
+    # client's circuit breaker is open requests are shed straight away instead
+    # of queueing for an upstream that is failing.
+    if claude_client and claude_client.circuit_breaker.is_open():
+        raise AdmissionRejected("Upstream is failing, try again later", 503, math.ceil(max(claude_client.circuit_breaker.retry_after(), 1)))
+    if not admission:
+        return lambda: None
+    with STAGE_DURATION.time(stage="admission_wait"):
+        return await admission.acquire(priority)
+
+def cached_response(answer, request: ChatCompletionRequest):
+    logger.info("Answering from the response cache")
+    headers = {"X-Cache": "HIT"}
+    if request.stream:
+        return StreamingResponse(stream_claude_response(replay(answer), request, observe_stages=False), media_type="text/event-stream", headers=headers)
+    return JSONResponse(format_claude_response(answer, request), headers=headers)
+
+def transcript(messages):
+    return [(msg.role, msg.content if isinstance(msg.content, str) else [part.model_dump(exclude_none=True) for part in msg.content])
+            for msg in messages]
+
+def message_text(msg):
+    if isinstance(msg.content, str):
+        return msg.content
+    return "\n".join(part.text for part in msg.content if part.type == "text" and part.text)
+
+def write_file_parts(files, directory):
+    # Decodes base64 file parts into directory (one subdirectory each, so the
+    # file names are kept as given) and returns their paths
+    paths = []
+    for index, file in enumerate(files):
+        if not file or not file.file_data:
+            raise ValueError("File content parts need file_data; file_id is not supported")
+        data, media_type = file.file_data, None
+        if data.startswith("data:"):
+            header, _, data = data.partition(",")
+            media_type = header[5:].split(";")[0] or None
+        try:
+            content = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError(f"Invalid base64 file_data for file {index}")
+        name = os.path.basename(file.filename or "")
+        if not name:
+            name = "document" + ((mimetypes.guess_extension(media_type) if media_type else None) or "")
+        path = os.path.join(directory, str(index), name)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as output:
+            output.write(content)
+        paths.append(path)
+    return paths
+
+async def upload_file_parts(files):
+    # Uploads the files in parallel (upload_attachment reads text files
+    # locally and reuses cached conversions) and returns the attachments
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = await loop.run_in_executor(None, write_file_parts, files, directory)
+        attachments = await claude_client.prepare_attachments(paths)
+    if attachments is None:
+        raise HTTPException(status_code=502, detail="Failed to upload attachments")
+    return attachments
+
+def schedule_conversation_delete(conversation_id):
+    task = asyncio.create_task(claude_client.delete_conversation(conversation_id))
+    pending_deletes.add(task)
+    task.add_done_callback(pending_deletes.discard)
+
+async def session_call(method, *args):
+    # The shared session cache waits on SQLite, and so on the other workers'
+    # writes; keep that off the event loop
+    if shared_state:
+        return await shared_state.run(method, *args)
+    return method(*args)
+
+async def conversations_in_use():
+    # Conversations the janitor must keep: ready in the pool or cached for reuse
+    in_use = set()
+    if conversation_pool:
+        in_use |= conversation_pool.conversation_ids()
+    if session_cache:
+        in_use |= await session_call(session_cache.conversation_ids)
+    if shared_state:
+        # Raises rather than let the sweep go ahead without the other workers'
+        in_use |= await shared_state.run(shared_state.peer_in_use, max_age=3 * METRICS_PUBLISH_INTERVAL)
+    return in_use
+
+async def get_conversation(model):
+    # Take a pre-created conversation from the warm pool when available
+    if conversation_pool:
+        conversation_id = conversation_pool.acquire(model)
+        if conversation_id:
+            return conversation_id
+
+    # Create a new conversation
+    logger.info("Creating new chat conversation")
+    conversation = await claude_client.create_new_chat(model=model, name=CONVERSATION_NAME)
+    logger.debug("Create new chat response: %s", truncate(conversation))
+    conversation_id = conversation.get('uuid') if conversation else None
+    if not conversation_id:
+        logger.error("Failed to get conversation UUID. Full response: %s", truncate(conversation))
+        raise HTTPException(status_code=500, detail="Failed to create new conversation")
+    return conversation_id
+
+async def stream_claude_response(deltas: AsyncIterator[str], request: ChatCompletionRequest, observe_stages: bool = True):
+    # Forward each delta as soon as the upstream produces it, with code blocks
+    # normalized as in non-streamed answers (a block is sent once it's closed)
+    completion_id = f"chatcmpl-{int(time.time())}"
+    normalizer = CodeBlockNormalizer()
+    first = True
+    start = time.perf_counter()
+
+    def content_chunk(content):
         chunk = {
-            "id": f"chatcmpl-{i}",
+            "id": completion_id,
             "object": "chat.completion.chunk",
             "created": int(time.time()),
             "model": request.model,
-            "choices": [{"delta": {"content": word + " "}, "index": 0, "finish_reason": None}],
+            "choices": [{"delta": {"content": content}, "index": 0, "finish_reason": None}],
         }
-        yield f"data: {json.dumps(chunk)}\n\n"
-        await asyncio.sleep(0.1)  # Simulate streaming delay
-    
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    async for delta in deltas:
+        if first and observe_stages:
+            STAGE_DURATION.observe(time.perf_counter() - start, stage="upstream_first_delta")
+        first = False
+        content = normalizer.feed(delta)
+        if content:
+            yield content_chunk(content)
+    content = normalizer.finish()
+    if content:
+        yield content_chunk(content)
+
     # Send the final chunk
     final_chunk = {
-        "id": f"chatcmpl-{len(words)}",
+        "id": completion_id,
         "object": "chat.completion.chunk",
         "created": int(time.time()),
         "model": request.model,
@@ -145,9 +748,12 @@ async def stream_claude_response(response: str, request: ChatCompletionRequest):
     }
     yield f"data: {json.dumps(final_chunk)}\n\n"
     yield "data: [DONE]\n\n"
+    if observe_stages:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage="upstream_stream")
 
 def format_claude_response(response: str, request: ChatCompletionRequest):
-    processed_response = process_code_blocks(response)
+    with STAGE_DURATION.time(stage="process_code_blocks"):
+        processed_response = process_code_blocks(response)
     
     return {
         "id": f"chatcmpl-{int(time.time())}",
@@ -163,42 +769,191 @@ def format_claude_response(response: str, request: ChatCompletionRequest):
             "finish_reason": "stop"
         }],
         "usage": {
-            "prompt_tokens": sum(len(msg.content.split()) for msg in request.messages),
+            "prompt_tokens": sum(len(message_text(msg).split()) for msg in request.messages),
             "completion_tokens": len(processed_response.split()),
-            "total_tokens": sum(len(msg.content.split()) for msg in request.messages) + len(processed_response.split())
+            "total_tokens": sum(len(message_text(msg).split()) for msg in request.messages) + len(processed_response.split())
         }
     }
 
 @app.post("/v1/embeddings")
 async def create_embedding(request: EmbeddingRequest, api_key: str = Depends(get_api_key)):
-    if not embedding_model:
+    if not EMBEDDINGS_ENABLED:
+        raise HTTPException(status_code=501, detail="Embeddings are disabled on this server")
+    if not embedding_models:
         raise HTTPException(status_code=500, detail="Embedding model not initialized")
 
+    texts = [request.input] if isinstance(request.input, str) else request.input
     try:
-        if isinstance(request.input, str):
-            embeddings = embedding_model.encode([request.input]).tolist()
-        else:
-            embeddings = embedding_model.encode(request.input).tolist()
+        embedding_service = embedding_models.get(request.model)
+        # An empty input gets an empty list, as EmbeddingService.embed needs a text
+        embeddings = []
+        if texts:
+            with STAGE_DURATION.time(stage="embedding_encode"):
+                embeddings = await embedding_service.embed(texts)
 
         return {
             "object": "list",
             "data": [
                 {
                     "object": "embedding",
-                    "embedding": embedding,
+                    "embedding": encode_embedding(embedding, request.encoding_format),
                     "index": i
                 } for i, embedding in enumerate(embeddings)
             ],
             "model": request.model,
             "usage": {
-                "prompt_tokens": sum(len(text.split()) for text in (request.input if isinstance(request.input, list) else [request.input])),
-                "total_tokens": sum(len(text.split()) for text in (request.input if isinstance(request.input, list) else [request.input]))
+                "prompt_tokens": sum(len(text.split()) for text in texts),
+                "total_tokens": sum(len(text.split()) for text in texts)
             }
         }
+    except ValueError as e:
+        logger.error("Invalid embedding request: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.exception(f"An error occurred during embedding: {str(e)}")
+        logger.exception("An error occurred during embedding: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def get_collection(name, model=None, create=False):
+    if not vector_store:
+        raise HTTPException(status_code=501, detail="Collections are disabled on this server")
+    collection = await in_thread(vector_store.get, name, model=model, create=create)
+    if collection is None:
+        raise HTTPException(status_code=404, detail=f"Collection {name} not found")
+    return collection
+
+async def in_thread(func, *args, **kwargs):
+    # Collection reads and writes hold a lock and do matrix work (or are calls
+    # to the model host); keep them off the event loop
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/v1/collections")
+async def list_collections(api_key: str = Depends(get_api_key)):
+    if not vector_store:
+        raise HTTPException(status_code=501, detail="Collections are disabled on this server")
+    return {"object": "list", "data": vector_store.names()}
+
+@app.get("/v1/collections/{name}")
+async def describe_collection(name: str, api_key: str = Depends(get_api_key)):
+    return {"object": "collection", "name": name, **await in_thread((await get_collection(name)).stats)}
+
+@app.delete("/v1/collections/{name}")
+async def delete_collection(name: str, api_key: str = Depends(get_api_key)):
+    await get_collection(name)
+    await in_thread(vector_store.drop, name)
+    return {"object": "collection", "name": name, "deleted": True}
+
+@app.post("/v1/collections/{name}/items")
+async def upsert_collection_items(name: str, request: CollectionUpsertRequest, api_key: str = Depends(get_api_key)):
+    # Embeds the texts with the collection's model and stores them, replacing
+    # items with the same id
+    if not embedding_models:
+        raise HTTPException(status_code=501, detail="Embeddings are disabled on this server")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="At least one item is required")
+    collection = await get_collection(name, model=request.model or EMBEDDING_MODEL, create=True)
+    if request.model and collection.model and request.model != collection.model:
+        raise HTTPException(status_code=400, detail=f"Collection {name} is embedded with {collection.model}, not {request.model}")
+    ids = [item.id or uuid.uuid4().hex for item in request.items]
+    texts = [item.text for item in request.items]
+    with STAGE_DURATION.time(stage="embedding_encode"):
+        vectors = await embedding_models.get(collection.model).embed(texts)
+    await in_thread(collection.upsert, ids, texts, vectors, [item.metadata for item in request.items])
+    return {"object": "list", "data": ids, "count": await in_thread(len, collection), "model": collection.model}
+
+@app.post("/v1/collections/{name}/query")
+async def query_collection(name: str, request: CollectionQueryRequest, api_key: str = Depends(get_api_key)):
+    # Top-k items by cosine similarity, one result list per query
+    collection = await get_collection(name)
+    if (request.input is None) == (request.vector is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of input and vector")
+    if request.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1")
+    if request.vector is not None:
+        queries = [request.vector]
+    else:
+        if not embedding_models:
+            raise HTTPException(status_code=501, detail="Embeddings are disabled on this server")
+        with STAGE_DURATION.time(stage="embedding_encode"):
+            queries = await embedding_models.get(collection.model).embed([request.input] if isinstance(request.input, str) else request.input)
+    with STAGE_DURATION.time(stage="vector_search"):
+        results = await in_thread(collection.query, queries, request.top_k, exact=request.exact)
+    return {"object": "list", "data": [{"index": i, "matches": matches} for i, matches in enumerate(results)]}
+
+@app.post("/v1/collections/{name}/delete")
+async def delete_collection_items(name: str, request: CollectionDeleteRequest, api_key: str = Depends(get_api_key)):
+    collection = await get_collection(name)
+    deleted = await in_thread(collection.delete, request.ids)
+    return {"object": "list", "deleted": deleted, "count": await in_thread(len, collection)}
+
+def run_model_host(path):
+    # Entry point of the model host process of a multi-worker server
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C stops the workers; the supervisor then stops this process
+    asyncio.run(serve_models(path))
+
+async def serve_models(path):
+    global embedding_models, vector_store, shared_state
+    embedding_models = create_embedding_registry()
+    if VECTOR_STORE_DIR:
+        vector_store = VectorStore(VECTOR_STORE_DIR, index_threshold=VECTOR_INDEX_THRESHOLD, probes=VECTOR_INDEX_PROBES)
+    shared_state = open_shared_state("model-host")
+    start_background_task(publish_state())
+    if EMBEDDING_PRELOAD:
+        await embedding_models.load()
+    server = await ModelHost(embedding_models, vector_store).serve(path)
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        server.close()
+        for task in list(background_tasks):
+            task.cancel()
+        if vector_store:
+            vector_store.close()
+        await embedding_models.close()
+        shared_state.close()
+
+def serve_workers(host, port):
+    # Runs WORKERS server processes, plus a model host process holding the
+    # embedding models and collections for all of them
+    state = open_shared_state("supervisor")
+    state.reset_metrics()
+    state.close()
+    env = dict(os.environ)
+    model_process = None
+    if EMBEDDINGS_ENABLED:
+        path = os.path.join(tempfile.mkdtemp(prefix="claude-proxy-"), "models.sock")
+        model_process = multiprocessing.get_context("spawn").Process(target=run_model_host, args=(path,), name="model-host", daemon=True)
+        model_process.start()
+        while not os.path.exists(path):
+            if not model_process.is_alive():
+                raise RuntimeError("The model host process failed to start")
+            time.sleep(0.05)
+        env['MODEL_HOST_SOCKET'] = path
+    # Through the uvicorn command rather than uvicorn.run(), whose spawned
+    # workers would import this module a second time as __mp_main__
+    workers = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", host, "--port", str(port),
+                                "--workers", str(WORKERS), "--app-dir", os.path.dirname(os.path.abspath(__file__))], env=env)
+    signal.signal(signal.SIGTERM, lambda signum, frame: workers.terminate())
+    try:
+        while workers.poll() is None:
+            try:
+                workers.wait()
+            except KeyboardInterrupt:
+                pass  # uvicorn got the Ctrl-C too and is shutting its workers down
+    finally:
+        if model_process:
+            model_process.terminate()
+            model_process.join(30)
+    return workers.returncode
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8008)
\ No newline at end of file
+    host, port = os.getenv('HOST', "0.0.0.0"), int(os.getenv('PORT', 8008))
+    if WORKERS > 1:
+        sys.exit(serve_workers(host, port))
+    else:
+        import uvicorn
+        uvicorn.run(app, host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class SessionCache:
+    # Maps a hash of an OpenAI message list (the transcript a conversation
+    # already contains) to the upstream conversation holding it. A request that
+    # extends a known transcript can then send only its new messages to the
+    # existing conversation instead of replaying the whole history.
+    #
+    # Entries are used exclusively: take() removes the entry, and the caller
+    # stores it again under the extended transcript once the reply is in.
+
+    def __init__(self, max_entries=1000, ttl=1800, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def prefix_keys(model, messages):
+        # Chained hash: keys[i] identifies model + messages[:i + 1], so every
+        # prefix key is computed in a single pass over the transcript.
+        keys = []
+        digest = hashlib.sha256(model.encode('utf-8')).digest()
+        for role, content in messages:
+            message = json.dumps([role, content], ensure_ascii=False).encode('utf-8')
+            digest = hashlib.sha256(digest + message).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def take(self, model, messages):
+        # Returns (conversation_id, number of messages already in it) for the
+        # longest known prefix of messages, or (None, 0). The last message is
+        # never matched, since there must be something new to send.
+        self._expire()
+        keys = self.prefix_keys(model, messages[:-1])
+        for length in range(len(keys), 0, -1):
+            entry = self._entries.pop(keys[length - 1], None)
+            if entry:
+                self.hits += 1
+                logger.debug("Session cache hit: conversation %s holds %s messages", entry[0], length)
+                return entry[0], length
+        self.misses += 1
+        return None, 0
+
+    def store(self, model, messages, conversation_id):
+        key = self.prefix_keys(model, messages)[-1]
+        replaced = self._entries.pop(key, None)
+        if replaced and replaced[0] != conversation_id:
+            # The same transcript was answered in another conversation, which
+            # nothing can reach any more
+            logger.debug("Session cache replaced conversation %s", replaced[0])
+            self._evict(replaced[0])
+        self._entries[key] = (conversation_id, time.monotonic())
+        while len(self._entries) > self.max_entries:
+            _, (evicted_id, _) = self._entries.popitem(last=False)
+            logger.debug("Session cache evicted conversation %s", evicted_id)
+            self._evict(evicted_id)
+
+    def clear(self):
+        while self._entries:
+            _, (conversation_id, _) = self._entries.popitem(last=False)
+            self._evict(conversation_id)
+
+    def conversation_ids(self):
+        return {conversation_id for conversation_id, _ in self._entries.values()}
+
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        # Entries are kept in insertion order, so the oldest ones come first
+        while self._entries:
+            key, (conversation_id, stored_at) = next(iter(self._entries.items()))
+            if stored_at >= deadline:
+                break
+            del self._entries[key]
+            logger.debug("Session cache expired conversation %s", conversation_id)
+            self._evict(conversation_id)
+
+    def _evict(self, conversation_id):
+        if self.on_evict:
+            self.on_evict(conversation_id)
@@ -0,0 +1,210 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+class SharedState:
+    # SQLite database (in WAL mode, so readers never wait for the writer)
+    # through which the worker processes of a multi-worker server share
+    # state: the session cache, every process's metrics and the conversations
+    # each one has in its warm pool. A statement can
+    # wait on another process's write, so async code runs them through run(),
+    # on a thread of their own, rather than on the event loop.
+
+    def __init__(self, path, worker=None):
+        self.path = path
+        self.worker = worker or str(os.getpid())
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        # Workers write concurrently; wait briefly for the write lock, then fail
+        # rather than hold up the callers queued behind this one
+        self._db = sqlite3.connect(path, timeout=1, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, stored_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_stored_at ON sessions (stored_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS metrics (worker TEXT PRIMARY KEY, snapshot TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS in_use (worker TEXT PRIMARY KEY, conversation_ids TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._db.commit()
+
+    def execute(self, sql, parameters=()):
+        # Runs one statement in its own transaction and returns all rows
+        return self.transaction([(sql, parameters)])[0]
+
+    def transaction(self, statements):
+        # Runs (sql, parameters) statements in one transaction and returns the
+        # rows of each
+        with self._lock:
+            try:
+                results = [self._db.execute(sql, parameters).fetchall() for sql, parameters in statements]
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            return results
+
+    async def run(self, func, *args, **kwargs):
+        # Awaits func(*args, **kwargs) on the database thread
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def publish_metrics(self, snapshot):
+        self.execute("INSERT OR REPLACE INTO metrics (worker, snapshot, updated_at) VALUES (?, ?, ?)",
+                     (self.worker, json.dumps(snapshot), time.time()))
+
+    def peer_metrics(self, max_age):
+        # Metric snapshots of the other processes. Counters and histograms of
+        # processes that stopped publishing more than max_age seconds ago are
+        # kept, so totals don't go backwards when a worker is replaced; their
+        # gauges are dropped, as they no longer describe anything.
+        peers = []
+        now = time.time()
+        for snapshot, updated_at in self.execute("SELECT snapshot, updated_at FROM metrics WHERE worker != ?", (self.worker,)):
+            snapshot = json.loads(snapshot)
+            if now - updated_at > max_age:
+                snapshot = {name: metric for name, metric in snapshot.items() if metric[0] != "gauge"}
+            peers.append(snapshot)
+        return peers
+
+    def publish_in_use(self, conversation_ids):
+        self.execute("INSERT OR REPLACE INTO in_use (worker, conversation_ids, updated_at) VALUES (?, ?, ?)",
+                     (self.worker, json.dumps(sorted(conversation_ids)), time.time()))
+
+    def peer_in_use(self, max_age):
+        # Conversations the other processes published as in use within max_age
+        # seconds; those of a process that stopped publishing are free to go
+        in_use = set()
+        for (conversation_ids,) in self.execute("SELECT conversation_ids FROM in_use WHERE worker != ? AND updated_at >= ?",
+                                                (self.worker, time.time() - max_age)):
+            in_use.update(json.loads(conversation_ids))
+        return in_use
+
+    def reset_metrics(self):
+        # Called before the workers start, so totals start from zero on every run
+        self.execute("DELETE FROM metrics")
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            self._db.close()
+
+
+class SharedSessionCache:
+    # SessionCache kept in SharedState, so a chat continued through any worker
+    # finds its conversation. take() deletes the entry it returns in the same
+    # statement, so a conversation is still handed to a single request at a
+    # time. Entries outlive the worker that stored them (clear() leaves them
+    # alone), and expire on the wall clock. The methods block on the
+    # database, and on_evict is called on the calling thread. When the
+    # database stays locked, take() reports a miss and store() evicts the
+    # conversation rather than fail the request.
+
+    def __init__(self, state, max_entries=1000, ttl=1800, on_evict=None):
+        self.state = state
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.entries = 0  # As of this worker's last store
+
+    prefix_keys = staticmethod(SessionCache.prefix_keys)
+
+    def take(self, model, messages):
+        try:
+            return self._take(model, messages)
+        except sqlite3.OperationalError as e:
+            logger.warning("Session cache unavailable: %s", e)
+            self.misses += 1
+            return None, 0
+
+    def _take(self, model, messages):
+        self._expire()
+        keys = self.prefix_keys(model, messages[:-1])
+        while keys:
+            placeholders = ",".join("?" * len(keys))
+            found = dict(self.state.execute(f"SELECT key, conversation_id FROM sessions WHERE key IN ({placeholders})", keys))
+            length = next((length for length in range(len(keys), 0, -1) if keys[length - 1] in found), 0)
+            if not length:
+                break
+            taken = self.state.execute("DELETE FROM sessions WHERE key = ? RETURNING conversation_id", (keys[length - 1],))
+            if taken:
+                self.hits += 1
+                logger.debug("Session cache hit: conversation %s holds %s messages", taken[0][0], length)
+                return taken[0][0], length
+            # Another worker took it first; look again
+        self.misses += 1
+        return None, 0
+
+    def store(self, model, messages, conversation_id):
+        key = self.prefix_keys(model, messages)[-1]
+        try:
+            replaced, _ = self.state.transaction([
+                ("DELETE FROM sessions WHERE key = ? RETURNING conversation_id", (key,)),
+                ("INSERT INTO sessions (key, conversation_id, stored_at) VALUES (?, ?, ?)", (key, conversation_id, time.time()))])
+        except sqlite3.OperationalError as e:
+            logger.warning("Session cache unavailable, not keeping conversation %s: %s", conversation_id, e)
+            self._evict(conversation_id)
+            return
+        for (replaced_id,) in replaced:
+            if replaced_id != conversation_id:
+                logger.debug("Session cache replaced conversation %s", replaced_id)
+                self._evict(replaced_id)
+        try:
+            self._trim()
+        except sqlite3.OperationalError as e:
+            # The next store trims instead
+            logger.warning("Session cache unavailable: %s", e)
+
+    def _trim(self):
+        self.entries = self.state.execute("SELECT COUNT(*) FROM sessions")[0][0]
+        excess = self.entries - self.max_entries
+        if excess > 0:
+            evicted = self.state.execute("DELETE FROM sessions WHERE key IN (SELECT key FROM sessions ORDER BY stored_at LIMIT ?) "
+                                         "RETURNING conversation_id", (excess,))
+            self.entries -= len(evicted)
+            for (evicted_id,) in evicted:
+                logger.debug("Session cache evicted conversation %s", evicted_id)
+                self._evict(evicted_id)
+
+    def clear(self):
+        pass
+
+    def conversation_ids(self):
+        return {conversation_id for (conversation_id,) in self.state.execute("SELECT conversation_id FROM sessions")}
+
+    def stats(self):
+        # Doesn't query the database, so it is safe to call on the event loop
+        return {"entries": self.entries, "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+    def _expire(self):
+        for (conversation_id,) in self.state.execute("DELETE FROM sessions WHERE stored_at < ? RETURNING conversation_id",
+                                                     (time.time() - self.ttl,)):
+            logger.debug("Session cache expired conversation %s", conversation_id)
+            self._evict(conversation_id)
+
+    def _evict(self, conversation_id):
+        if self.on_evict:
+            self.on_evict(conversation_id)
+
+
+def try_lock(path):
+    # Exclusive lock on path held for the life of the process (or until the
+    # returned file is closed), or None if another process holds it. Used to
+    # elect the one worker that runs a singleton task such as the janitor.
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
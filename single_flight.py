@@ -0,0 +1,149 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Broadcast:
+    # Deltas produced once and replayed to any number of subscribers. Each
+    # subscriber gets every delta from the start, however late it subscribes.
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.started = asyncio.get_running_loop().create_future()
+        self.task = None  # The producing task, referenced so it isn't garbage collected
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, delta):
+        self.parts.append(delta)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # Wake current waiters; later waits use a fresh event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            while index < len(self.parts):
+                yield self.parts[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    # Coalesces concurrent calls with the same key into one. do() shares the
+    # result of a coroutine; stream() shares an async iterator of deltas as a
+    # Broadcast. Keys are forgotten once the call completes, so later requests
+    # start a new call. A call is cancelled once every caller has gone away
+    # before it finished.
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self._waiters = {}  # call task -> number of callers awaiting it
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+
+    async def do(self, key, call):
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(self._calls, key, task))
+        else:
+            self.followers += 1
+            logger.debug("Joining in-flight call %s", key[:12])
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # Shielded, so a caller going away doesn't cancel the call for the others
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    self._cancel(self._calls, key, task, task)
+
+    async def stream(self, key, start):
+        # start() sets the call up and returns its async iterator of deltas;
+        # errors raised by start() reach every caller. Returns an iterator
+        # over all of the call's deltas.
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.leaders += 1
+            broadcast = Broadcast()
+            self._streams[key] = broadcast
+            task = asyncio.create_task(self._pump(key, broadcast, start))
+            broadcast.task = task
+        else:
+            self.followers += 1
+            logger.debug("Joining in-flight stream %s", key[:12])
+        broadcast.subscribers += 1
+        try:
+            await asyncio.shield(broadcast.started)
+        except BaseException:
+            self._leave(key, broadcast)
+            raise
+        return self._follow(key, broadcast)
+
+    def stats(self):
+        return {"in_flight": len(self._calls) + len(self._streams), "leaders": self.leaders, "followers": self.followers,
+                "cancelled": self.cancelled}
+
+    async def _follow(self, key, broadcast):
+        try:
+            async for delta in broadcast.subscribe():
+                yield delta
+        finally:
+            self._leave(key, broadcast)
+
+    def _leave(self, key, broadcast):
+        broadcast.subscribers -= 1
+        if not broadcast.subscribers and not broadcast.done:
+            self._cancel(self._streams, key, broadcast, broadcast.task)
+
+    def _cancel(self, calls, key, call, task):
+        # Nobody is waiting for the call any more. It is forgotten right away
+        # so new callers start afresh instead of joining a dying call.
+        logger.info("All callers of %s went away, cancelling it", key[:12])
+        self.cancelled += 1
+        self._forget(calls, key, call)
+        task.cancel()
+
+    async def _pump(self, key, broadcast, start):
+        try:
+            deltas = await start()
+            broadcast.started.set_result(None)
+            async for delta in deltas:
+                broadcast.publish(delta)
+            broadcast.finish()
+        except asyncio.CancelledError as e:
+            broadcast.started.cancel()
+            broadcast.finish(e)
+            raise
+        except Exception as e:
+            if not broadcast.started.done():
+                broadcast.started.set_exception(e)
+            broadcast.finish(e)
+        finally:
+            self._forget(self._streams, key, broadcast)
+
+    @staticmethod
+    def _forget(calls, key, call):
+        if calls.get(key) is call:
+            del calls[key]
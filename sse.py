@@ -0,0 +1,150 @@
+import codecs
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+_json_decoder = json.JSONDecoder()
+
+class SSEEvent:
+    __slots__ = ('event', 'data', 'id')
+
+    def __init__(self, event, data, id=None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+
+class SSEParser:
+    # Incremental text/event-stream parser. feed() takes raw byte chunks as they
+    # come off the socket, in any split, and returns the events completed by
+    # that chunk. Follows the SSE spec: CR, LF or CRLF line endings, multi-line
+    # data fields joined with "\n", event/id fields and ":" comments.
+    # Chunks are decoded incrementally (a UTF-8 sequence may be split across
+    # chunks), once per chunk rather than once per line.
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer = ""
+        self._event = None
+        self._data = []
+        self.last_event_id = None
+
+    def feed(self, chunk):
+        chunk = self._decoder.decode(chunk)
+        if self._buffer:
+            chunk = self._buffer + chunk
+        held = ""
+        if "\r" in chunk:
+            # A trailing CR may be the first half of a CRLF split across chunks
+            if chunk.endswith("\r"):
+                chunk, held = chunk[:-1], "\r"
+            chunk = chunk.replace("\r\n", "\n").replace("\r", "\n")
+        lines = chunk.split("\n")
+        # The last piece is an unterminated line (or b"" if the chunk ended
+        # with a newline) and is kept until the next chunk arrives
+        self._buffer = lines.pop() + held
+
+        events = []
+        data = self._data
+        for line in lines:
+            # The common fields are handled inline; this loop runs once per line
+            if not line:
+                if data:
+                    events.append(SSEEvent(self._event or "message", data[0] if len(data) == 1 else "\n".join(data), self.last_event_id))
+                    data = self._data = []
+                self._event = None
+            elif line.startswith("data:"):
+                data.append(line[6:] if line[5:6] == " " else line[5:])
+            elif line.startswith("event:"):
+                self._event = line[7:] if line[6:7] == " " else line[6:]
+            else:
+                self._process_field(line)
+        return events
+
+    def flush(self):
+        # Call at end of stream to dispatch a final event with no trailing blank line
+        line, self._buffer = (self._buffer + self._decoder.decode(b"", final=True)).rstrip("\r"), ""
+        if line:
+            self._process_field(line)
+        if self._data:
+            return [self._dispatch()]
+        return []
+
+    def _process_field(self, line):
+        if line[0] == ":":  # comment
+            return
+
+        field, sep, value = line.partition(":")
+        if sep and value[:1] == " ":
+            value = value[1:]
+
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id" and "\0" not in value:
+            self.last_event_id = value
+
+    def _dispatch(self):
+        event_type, data = self._event, self._data
+        self._event = None
+        self._data = []
+        return SSEEvent(event_type or "message", data[0] if len(data) == 1 else "\n".join(data), self.last_event_id)
+
+
+class CompletionParser:
+    # Turns the completion endpoint's event stream into text deltas. Handles both
+    # the legacy "completion" events and the newer message/content_block events,
+    # records the stop reason, and surfaces "error" events through .error.
+
+    SKIPPED_EVENTS = frozenset(("ping", "message_start", "message_stop", "content_block_start", "content_block_stop"))
+
+    def __init__(self):
+        self._sse = SSEParser()
+        self.stop_reason = None
+        self.error = None
+
+    def feed(self, chunk):
+        return self._completions(self._sse.feed(chunk))
+
+    def flush(self):
+        return self._completions(self._sse.flush())
+
+    def _completions(self, events):
+        completions = []
+        for event in events:
+            if event.event in self.SKIPPED_EVENTS:
+                continue
+            try:
+                # raw_decode skips the json.loads wrapper and whitespace checks
+                payload = _json_decoder.raw_decode(event.data)[0]
+            except ValueError:
+                logger.warning("Failed to parse JSON in %s event (%s bytes)", event.event, len(event.data))
+                continue
+            if not isinstance(payload, dict):
+                continue
+
+            kind = payload.get('type')
+            if kind == 'completion':
+                text = payload.get('completion')
+                if text:
+                    completions.append(text)
+                if payload.get('stop_reason'):
+                    self.stop_reason = payload['stop_reason']
+            elif kind == 'content_block_delta':
+                text = (payload.get('delta') or {}).get('text')
+                if text:
+                    completions.append(text)
+            elif kind == 'message_delta':
+                stop_reason = (payload.get('delta') or {}).get('stop_reason')
+                if stop_reason:
+                    self.stop_reason = stop_reason
+            elif kind == 'error' or event.event == 'error':
+                error = payload.get('error')
+                self.error = error.get('message', str(error)) if isinstance(error, dict) else str(error or payload)
+                logger.error("Upstream reported an error in the completion stream: %s", self.error)
+        return completions
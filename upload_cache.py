@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+def file_digest(file_path, chunk_size=1 << 20):
+    # sha256 of a file's contents, read in chunks so large files aren't loaded whole
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    # On-disk cache of convert_document results keyed by the uploaded file's
+    # content hash, so uploading the same document again costs nothing. One
+    # JSON file per entry; the least recently used entries (by mtime, which
+    # get() refreshes) are evicted once the cache exceeds max_bytes or
+    # max_entries.
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_entries=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, digest):
+        path = self._path(digest)
+        try:
+            with open(path, encoding='utf-8') as entry:
+                result = json.load(entry)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, digest, result):
+        data = json.dumps(result).encode('utf-8')
+        if len(data) > self.max_bytes:
+            logger.debug("Not caching %s byte upload result for %s", len(data), digest)
+            return
+        # Write to a temporary file first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(data)
+            os.replace(temp_path, self._path(digest))
+        except OSError as e:
+            logger.warning("Failed to cache upload result for %s: %s", digest, e)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def stats(self):
+        entries = self._entries()
+        return {"entries": len(entries), "bytes": sum(size for _, size, _ in entries), "hits": self.hits, "misses": self.misses}
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for item in scan:
+                if item.name.endswith('.json'):
+                    try:
+                        stat = item.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            while entries and (total > self.max_bytes or len(entries) > self.max_entries):
+                _, size, path = entries.pop(0)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+                logger.debug("Upload cache evicted %s", path)
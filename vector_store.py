@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_NAME = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+def top_k(scores, k):
+    # Indices of the k highest scores, best first, without sorting them all
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+class IvfIndex:
+    # Approximate nearest neighbour search for large collections: the vectors
+    # are clustered with spherical k-means and each query only scores the
+    # vectors in the probes clusters whose centroids are closest to it.
+    # Slots added or changed after build() are kept in a list that is always
+    # scanned in full; the collection rebuilds the index once that grows.
+
+    def __init__(self, lists=None, probes=8, iterations=10, sample_size=65536, seed=0):
+        self.lists = lists
+        self.probes = probes
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.seed = seed
+        self.centroids = None
+        self._order = None  # Slots grouped by cluster
+        self._offsets = None  # Cluster c holds _order[_offsets[c]:_offsets[c + 1]]
+        self._extra = []
+        self.size = 0
+
+    def build(self, vectors, slots):
+        rng = np.random.default_rng(self.seed)
+        lists = self.lists or int(np.clip(np.sqrt(len(slots)), 16, 4096))
+        sample = vectors[np.sort(rng.choice(slots, min(len(slots), max(self.sample_size, lists)), replace=False))]
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(self.iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=lists) == 0
+            sums[empty] = centroids[empty]  # Keep the old centroid of an empty cluster
+            centroids = normalize_rows(sums)
+
+        assignment = np.concatenate([np.argmax(vectors[slots[i:i + 65536]] @ centroids.T, axis=1)
+                                     for i in range(0, len(slots), 65536)])
+        order = np.argsort(assignment, kind="stable")
+        self.centroids = centroids
+        self._order = slots[order]
+        self._offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=lists))))
+        self._extra = []
+        self.size = len(slots)
+
+    def add(self, slots):
+        self._extra.extend(slots)
+
+    @property
+    def stale(self):
+        return len(self._extra) > max(1000, self.size // 10)
+
+    def candidates(self, query):
+        probes = min(self.probes, len(self.centroids))
+        clusters = top_k(self.centroids @ query, probes)
+        parts = [self._order[self._offsets[c]:self._offsets[c + 1]] for c in clusters]
+        parts.append(np.asarray(self._extra, dtype=np.int64))
+        return np.unique(np.concatenate(parts))
+
+    def stats(self):
+        return {"lists": len(self.centroids) if self.centroids is not None else 0, "indexed": self.size,
+                "unindexed": len(self._extra), "probes": self.probes}
+
+
+class VectorCollection:
+    # Texts and their embedding vectors, searchable by cosine similarity. The
+    # vectors are normalized and kept in one contiguous float32 matrix
+    # memory-mapped from <name>.npy (one row per slot, grown by doubling), so
+    # a query is a single matrix-vector product. Ids, texts and metadata live
+    # in <name>.sqlite, which also records the embedding model and dimension.
+    # Collections with at least index_threshold vectors are searched through
+    # an IvfIndex unless the query asks for an exact search.
+
+    def __init__(self, name, directory, model=None, dim=None, index_threshold=100000, probes=8):
+        self.name = name
+        self.model = model
+        self.dim = dim
+        self.index_threshold = index_threshold
+        self.probes = probes
+        self._vectors_path = os.path.join(directory, f"{name}.npy")
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._live = np.zeros(0, dtype=bool)
+        self._slot_ids = []
+        self._slots = {}
+        self._free = []
+        self._index = None
+        self._db = sqlite3.connect(os.path.join(directory, f"{name}.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, slot INTEGER NOT NULL UNIQUE, text TEXT, metadata TEXT)")
+        self._load()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def upsert(self, ids, texts, vectors, metadata=None):
+        # Adds the items, replacing those whose id already exists
+        vectors = normalize_rows(vectors)
+        metadata = metadata or [None] * len(ids)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.executemany("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                                     [("model", self.model), ("dim", str(self.dim))])
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Collection {self.name} holds {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+            slots = []
+            for item_id in ids:
+                slot = self._slots.get(item_id)
+                if slot is None:
+                    slot = self._free.pop() if self._free else len(self._slot_ids)
+                    if slot == len(self._slot_ids):
+                        self._slot_ids.append(None)
+                    self._slots[item_id] = slot
+                    self._slot_ids[slot] = item_id
+                slots.append(slot)
+            self._ensure_capacity(len(self._slot_ids))
+            self._vectors[slots] = vectors
+            self._live[slots] = True
+            if self._index is not None:
+                self._index.add(slots)
+            self._db.executemany("INSERT OR REPLACE INTO items (id, slot, text, metadata) VALUES (?, ?, ?, ?)",
+                                 [(item_id, slot, text, json.dumps(meta) if meta is not None else None)
+                                  for item_id, slot, text, meta in zip(ids, slots, texts, metadata)])
+            self._commit()
+
+    def delete(self, ids):
+        with self._lock:
+            slots = [self._slots.pop(item_id) for item_id in ids if item_id in self._slots]
+            for slot in slots:
+                self._slot_ids[slot] = None
+            self._live[slots] = False
+            self._free.extend(slots)
+            self._db.executemany("DELETE FROM items WHERE slot = ?", [(slot,) for slot in slots])
+            self._commit()
+            return len(slots)
+
+    def query(self, vectors, k=10, exact=False):
+        # For each query vector, the k most similar items as
+        # [{"id", "score", "text", "metadata"}], best first
+        queries = normalize_rows(np.atleast_2d(vectors))
+        with self._lock:
+            if self.dim is not None and queries.shape[1] != self.dim:
+                raise ValueError(f"Collection {self.name} holds {self.dim}-dimensional vectors, got {queries.shape[1]}")
+            if not self._slots:
+                return [[] for _ in queries]
+            if exact or len(self._slots) < self.index_threshold or self.index_threshold <= 0:
+                hits = self._exact(queries, k)
+            else:
+                hits = [self._approximate(query, k) for query in queries]
+            return self._describe(hits)
+
+    def stats(self):
+        return {
+            "count": len(self._slots),
+            "capacity": len(self._vectors) if self._vectors is not None else 0,
+            "dim": self.dim,
+            "model": self.model,
+            "index": self._index.stats() if self._index is not None else None,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+            self._db.close()
+
+    def _exact(self, queries, k):
+        used = len(self._slot_ids)
+        # (slots, queries) scores in one product; free slots can never win
+        scores = self._vectors[:used] @ queries.T
+        scores[~self._live[:used]] = -np.inf
+        k = min(k, len(self._slots))
+        return [[(slot, column[slot]) for slot in top_k(column, k)] for column in scores.T]
+
+    def _approximate(self, query, k):
+        if self._index is None or self._index.stale:
+            self._index = IvfIndex(probes=self.probes)
+            self._index.build(self._vectors, np.flatnonzero(self._live))
+            logger.info("Built vector index for collection %s: %s", self.name, self._index.stats())
+        candidates = self._index.candidates(query)
+        candidates = candidates[self._live[candidates]]
+        scores = self._vectors[candidates] @ query
+        return [(candidates[i], scores[i]) for i in top_k(scores, min(k, len(candidates)))]
+
+    def _describe(self, hits):
+        ids = {self._slot_ids[slot] for query_hits in hits for slot, _ in query_hits}
+        rows = {}
+        placeholders = ",".join("?" * len(ids))
+        if ids:
+            for item_id, text, metadata in self._db.execute(f"SELECT id, text, metadata FROM items WHERE id IN ({placeholders})", list(ids)):
+                rows[item_id] = (text, json.loads(metadata) if metadata is not None else None)
+        return [[{"id": self._slot_ids[slot], "score": float(score), "text": rows[self._slot_ids[slot]][0],
+                  "metadata": rows[self._slot_ids[slot]][1]} for slot, score in query_hits] for query_hits in hits]
+
+    def _commit(self):
+        if self._vectors is not None:
+            self._vectors.flush()
+        self._db.commit()
+
+    def _ensure_capacity(self, size):
+        capacity = len(self._vectors) if self._vectors is not None else 0
+        if size <= capacity:
+            return
+        capacity = max(1024, capacity)
+        while capacity < size:
+            capacity *= 2
+        # Grow into a new file and swap it in, so a crash leaves the old one intact
+        temporary = f"{self._vectors_path}.tmp"
+        vectors = np.lib.format.open_memmap(temporary, mode='w+', dtype=np.float32, shape=(capacity, self.dim))
+        if self._vectors is not None:
+            vectors[:len(self._vectors)] = self._vectors
+            vectors.flush()
+            del self._vectors
+        os.replace(temporary, self._vectors_path)
+        self._vectors = vectors
+        live = np.zeros(capacity, dtype=bool)
+        live[:len(self._live)] = self._live
+        self._live = live
+
+    def _load(self):
+        info = dict(self._db.execute("SELECT key, value FROM info"))
+        self.model = info.get("model", self.model)
+        self.dim = int(info["dim"]) if "dim" in info else self.dim
+        rows = self._db.execute("SELECT id, slot FROM items").fetchall()
+        if not rows:
+            return
+        try:
+            self._vectors = np.load(self._vectors_path, mmap_mode='r+')
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Vectors of collection {self.name} are unreadable: {e}") from e
+        self._live = np.zeros(len(self._vectors), dtype=bool)
+        used = max(slot for _, slot in rows) + 1
+        self._slot_ids = [None] * used
+        for item_id, slot in rows:
+            self._slots[item_id] = slot
+            self._slot_ids[slot] = item_id
+            self._live[slot] = True
+        self._free = [slot for slot in range(used) if self._slot_ids[slot] is None]
+        logger.info("Loaded collection %s with %s vectors", self.name, len(rows))
+
+
+class VectorStore:
+    # The collections in a directory, opened on first use
+
+    def __init__(self, directory, index_threshold=100000, probes=8):
+        self.directory = directory
+        self.index_threshold = index_threshold
+        self.probes = probes
+        self._collections = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def names(self):
+        on_disk = {file[:-len(".sqlite")] for file in os.listdir(self.directory) if file.endswith(".sqlite")}
+        return sorted(on_disk | set(self._collections))
+
+    def get(self, name, model=None, create=False):
+        # The collection called name, or None if it doesn't exist and create is false
+        if not COLLECTION_NAME.match(name):
+            raise ValueError(f"Invalid collection name {name!r}: use up to 64 letters, digits, '_', '.' or '-'")
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                if not create and not os.path.exists(os.path.join(self.directory, f"{name}.sqlite")):
+                    return None
+                collection = VectorCollection(name, self.directory, model=model, index_threshold=self.index_threshold, probes=self.probes)
+                self._collections[name] = collection
+            return collection
+
+    def drop(self, name):
+        collection = self.get(name)
+        if collection is None:
+            return False
+        with self._lock:
+            self._collections.pop(name, None)
+            collection.close()
+            for suffix in (".npy", ".sqlite", ".sqlite-wal", ".sqlite-shm"):
+                path = os.path.join(self.directory, f"{name}{suffix}")
+                if os.path.exists(path):
+                    os.remove(path)
+        return True
+
+    def stats(self):
+        return {"collections": len(self.names()), "open": len(self._collections),
+                "vectors": sum(len(collection) for collection in self._collections.values())}
+
+    def close(self):
+        with self._lock:
+            for collection in self._collections.values():
+                collection.close()
+            self._collections.clear()